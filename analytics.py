@@ -0,0 +1,314 @@
+# analytics.py
+import hashlib
+from datetime import date, datetime, timedelta
+
+from firebase_admin import firestore
+
+ROLLUP_COLLECTION = 'analytics_rollups'
+# An invoice touches the day and month rollups of its issue date and its due date
+ROLLUP_WRITES_PER_INVOICE = 4
+OUTSTANDING_STATUSES = ('sent', 'overdue')
+# Invoice fields the rollups are built from
+ROLLUP_FIELDS = ('invoiceDate', 'createdAt', 'dueDate', 'dueAt', 'status', 'total',
+                 'clientId', 'clientEmail', 'clientName')
+# Days past the due date: (label, first day, last day)
+AGEING_BUCKETS = (('0-30', 1, 30), ('31-60', 31, 60), ('61-90', 61, 90), ('90+', 91, None))
+
+
+def to_date(value):
+    """A date from a YYYY-MM-DD string or a (possibly UTC) datetime"""
+    if isinstance(value, str):
+        try:
+            return datetime.strptime(value, '%Y-%m-%d').date()
+        except ValueError:
+            return None
+    if isinstance(value, datetime):
+        # Stored datetimes come back in UTC; bucket them in local time
+        return (value.astimezone() if value.tzinfo else value).date()
+    if isinstance(value, date):
+        return value
+    return None
+
+
+def issue_date(invoice):
+    return to_date(invoice.get('invoiceDate')) or to_date(invoice.get('createdAt'))
+
+
+def due_date(invoice):
+    return to_date(invoice.get('dueDate')) or to_date(invoice.get('dueAt'))
+
+
+def month_key(day):
+    return day.strftime('%Y-%m')
+
+
+def first_of_next_month(day):
+    return (day.replace(day=28) + timedelta(days=4)).replace(day=1)
+
+
+def rollup_id(user_id, period, start):
+    return f"{user_id}:{period}:{start}".replace('/', '_')
+
+
+def client_key(invoice):
+    """Stable map key for an invoice's client"""
+    if invoice.get('clientId'):
+        return invoice['clientId']
+    identity = (invoice.get('clientEmail') or invoice.get('clientName') or '').strip().lower()
+    return 'h' + hashlib.sha1(identity.encode()).hexdigest()[:16] if identity else 'unknown'
+
+
+def invoice_total(invoice):
+    try:
+        return float(invoice.get('total') or 0)
+    except (TypeError, ValueError):
+        return 0
+
+
+def empty_rollup(user_id, period, start):
+    return {'userId': user_id, 'period': period, 'start': start, 'invoices': 0, 'billed': 0,
+            'statuses': {}, 'clients': {}, 'outstanding': {'count': 0, 'amount': 0}}
+
+
+def add_to_rollups(rollups, user_id, invoice, sign):
+    """Add (sign=1) or remove (sign=-1) one invoice from plain rollup dicts keyed by id"""
+    def rollups_for(day):
+        for period, start in (('day', day.isoformat()), ('month', month_key(day))):
+            key = rollup_id(user_id, period, start)
+            if key not in rollups:
+                rollups[key] = empty_rollup(user_id, period, start)
+            yield rollups[key]
+
+    amount = invoice_total(invoice)
+    issued = issue_date(invoice)
+    if issued:
+        status = invoice.get('status', 'draft')
+        client = client_key(invoice)
+        for rollup in rollups_for(issued):
+            rollup['invoices'] += sign
+            rollup['billed'] += sign * amount
+            counts = rollup['statuses'].setdefault(status, {'count': 0, 'amount': 0})
+            counts['count'] += sign
+            counts['amount'] += sign * amount
+            totals = rollup['clients'].setdefault(client, {'count': 0, 'amount': 0})
+            totals['count'] += sign
+            totals['amount'] += sign * amount
+            if invoice.get('clientName'):
+                totals['name'] = invoice['clientName']
+
+    due = due_date(invoice)
+    if due and invoice.get('status') in OUTSTANDING_STATUSES:
+        for rollup in rollups_for(due):
+            rollup['outstanding']['count'] += sign
+            rollup['outstanding']['amount'] += sign * amount
+
+
+def accumulate_rollups(user_id, changes):
+    """Plain rollup dicts for (removed, added) invoice pairs"""
+    rollups = {}
+    for removed, added in changes:
+        if removed:
+            add_to_rollups(rollups, user_id, removed, -1)
+        if added:
+            add_to_rollups(rollups, user_id, added, 1)
+    return rollups
+
+
+def as_increments(values):
+    """Turn the numbers in a rollup into Increment transforms, dropping zeros"""
+    increments = {}
+    for key, value in values.items():
+        if isinstance(value, dict):
+            nested = as_increments(value)
+            if nested:
+                increments[key] = nested
+        elif isinstance(value, (int, float)) and not isinstance(value, bool):
+            if value:
+                increments[key] = firestore.Increment(value)
+        else:
+            increments[key] = value
+    return increments
+
+
+def day_number(day):
+    """A date as a number like 20261017, so Maximum transforms can keep the latest"""
+    return day.year * 10000 + day.month * 100 + day.day
+
+
+def format_day_number(number):
+    return f"{number // 10000:04d}-{number // 100 % 100:02d}-{number % 100:02d}"
+
+
+def add_to_client_stats(stats_by_client, invoice, sign, new=False):
+    """Add or remove one invoice from plain per-client stats keyed by clientId"""
+    client_id = invoice.get('clientId')
+    if not client_id:
+        return
+    stats = stats_by_client.setdefault(client_id, {'invoiceCount': 0, 'billed': 0, 'outstanding': 0})
+    amount = invoice_total(invoice)
+    stats['invoiceCount'] += sign
+    stats['billed'] += sign * amount
+    if invoice.get('status') in OUTSTANDING_STATUSES:
+        stats['outstanding'] += sign * amount
+    issued = issue_date(invoice)
+    if new and issued:
+        stats['lastInvoiceDate'] = max(stats.get('lastInvoiceDate', 0), day_number(issued))
+
+
+def client_stats_updates(changes):
+    """{clientId: update} for (removed, added) invoice pairs, merged into client documents.
+
+    Counts and amounts are Increments; lastInvoiceDate is a Maximum, so it
+    only moves forward here and deletes are handled separately.
+    """
+    stats_by_client = {}
+    for removed, added in changes:
+        if removed:
+            add_to_client_stats(stats_by_client, removed, -1)
+        if added:
+            add_to_client_stats(stats_by_client, added, 1, new=removed is None)
+
+    updates = {}
+    for client_id, stats in stats_by_client.items():
+        update = as_increments({field: stats[field] for field in ('invoiceCount', 'billed', 'outstanding')})
+        if stats.get('lastInvoiceDate'):
+            update['lastInvoiceDate'] = firestore.Maximum(stats['lastInvoiceDate'])
+        if update:
+            updates[client_id] = {'stats': update}
+    return updates
+
+
+def client_stats_view(stats):
+    """Client stats as returned by the API, with lastInvoiceDate as YYYY-MM-DD"""
+    view = {'invoiceCount': 0, 'billed': 0, 'outstanding': 0, 'lastInvoiceDate': None, **(stats or {})}
+    view['billed'] = round(view['billed'], 2)
+    view['outstanding'] = round(view['outstanding'], 2)
+    if isinstance(view['lastInvoiceDate'], int):
+        view['lastInvoiceDate'] = format_day_number(view['lastInvoiceDate'])
+    return view
+
+
+def merge_rollup(target, rollup):
+    """Add the numbers of one rollup into a running total"""
+    for key, value in rollup.items():
+        if isinstance(value, dict):
+            merge_rollup(target.setdefault(key, {}), value)
+        elif isinstance(value, (int, float)) and not isinstance(value, bool):
+            target[key] = target.get(key, 0) + value
+        elif key == 'name':
+            target[key] = value
+
+
+class AnalyticsRollups:
+    """Per user day and month rollups of invoice revenue, kept on write.
+
+    Each rollup document holds invoice counts and billed amounts for the
+    invoices issued in its period, split by status and by client, plus the
+    outstanding (sent or overdue) amount falling due in it. Any date range
+    is answered from the month documents it covers fully and the day
+    documents at its edges.
+    """
+
+    def __init__(self, db):
+        self.db = db
+
+    def collection(self):
+        return self.db.collection(ROLLUP_COLLECTION)
+
+    def write_changes(self, writer, user_id, changes):
+        """Add Increment updates for (removed, added) invoice pairs to a batch or transaction"""
+        for key, rollup in accumulate_rollups(user_id, changes).items():
+            update = as_increments(rollup)
+            if set(update) - {'userId', 'period', 'start'}:
+                writer.set(self.collection().document(key), {**update, 'updatedAt': datetime.now()}, merge=True)
+
+    def range_ids(self, user_id, start, end):
+        """Rollup ids covering start..end inclusive, using whole months where possible"""
+        ids = []
+        day = start
+        while day <= end:
+            next_month = first_of_next_month(day)
+            if day.day == 1 and next_month - timedelta(days=1) <= end:
+                ids.append(rollup_id(user_id, 'month', month_key(day)))
+                day = next_month
+            else:
+                ids.append(rollup_id(user_id, 'day', day.isoformat()))
+                day += timedelta(days=1)
+        return ids
+
+    def get_rollups(self, ids):
+        refs = [self.collection().document(key) for key in dict.fromkeys(ids)]
+        if not refs:
+            return {}
+        return {snapshot.id: snapshot.to_dict() for snapshot in self.db.get_all(refs) if snapshot.exists}
+
+    def months_before(self, user_id, month):
+        """Month rollups before `month`, for the open-ended oldest ageing bucket"""
+        query = self.collection() \
+            .where('userId', '==', user_id) \
+            .where('period', '==', 'month') \
+            .where('start', '<', month)
+        return [doc.to_dict() for doc in query.select(['outstanding']).stream()]
+
+    def ageing(self, user_id, today, outstanding_total=None):
+        """Outstanding amounts by days past due, as of `today`"""
+        ranges = {}
+        for label, first, last in AGEING_BUCKETS:
+            if last is not None:
+                ranges[label] = self.range_ids(user_id, today - timedelta(days=last), today - timedelta(days=first))
+        # The oldest bucket is the cutoff's month up to the cutoff, plus every earlier month
+        cutoff = today - timedelta(days=AGEING_BUCKETS[-1][1])
+        oldest_days = self.range_ids(user_id, cutoff.replace(day=1), cutoff)
+        rollups = self.get_rollups([key for ids in ranges.values() for key in ids] + oldest_days)
+
+        buckets = {}
+        for label, _, last in AGEING_BUCKETS:
+            bucket = {'count': 0, 'amount': 0}
+            docs = [rollups[key] for key in ranges[label] if key in rollups] if last is not None else \
+                [rollups[key] for key in oldest_days if key in rollups] + self.months_before(user_id, month_key(cutoff))
+            for rollup in docs:
+                merge_rollup(bucket, rollup.get('outstanding', {}))
+            buckets[label] = {'count': bucket['count'], 'amount': round(bucket['amount'], 2)}
+        if outstanding_total is not None:
+            overdue = sum(bucket['amount'] for bucket in buckets.values())
+            # Not yet due, or without a due date
+            buckets['current'] = {'amount': round(outstanding_total - overdue, 2)}
+        return buckets
+
+    def report(self, user_id, start, end, today=None, outstanding_total=None, client_limit=20):
+        """Revenue by month, status and client for start..end, plus ageing as of today"""
+        ids = self.range_ids(user_id, start, end)
+        rollups = self.get_rollups(ids)
+
+        totals = {'invoices': 0, 'billed': 0, 'statuses': {}, 'clients': {}}
+        months = {}
+        for key in ids:
+            rollup = rollups.get(key)
+            if not rollup:
+                continue
+            revenue = {field: rollup[field] for field in ('invoices', 'billed', 'statuses') if field in rollup}
+            merge_rollup(totals, {**revenue, 'clients': rollup.get('clients', {})})
+            merge_rollup(months.setdefault(rollup['start'][:7], {'invoices': 0, 'billed': 0, 'statuses': {}}),
+                         revenue)
+
+        clients = sorted(({'key': key, 'name': values.get('name', ''), 'count': values.get('count', 0),
+                           'amount': round(values.get('amount', 0), 2)}
+                          for key, values in totals['clients'].items() if values.get('count')),
+                         key=lambda client: client['amount'], reverse=True)
+        return {
+            'from': start.isoformat(),
+            'to': end.isoformat(),
+            'invoices': totals['invoices'],
+            'billed': round(totals['billed'], 2),
+            'byMonth': [{'month': month, 'invoices': values['invoices'], 'billed': round(values['billed'], 2),
+                         'byStatus': rounded_statuses(values['statuses'])}
+                        for month, values in sorted(months.items())],
+            'byStatus': rounded_statuses(totals['statuses']),
+            'byClient': clients[:client_limit],
+            'ageing': self.ageing(user_id, today or date.today(), outstanding_total)
+        }
+
+
+def rounded_statuses(statuses):
+    return {status: {'count': values.get('count', 0), 'amount': round(values.get('amount', 0), 2)}
+            for status, values in sorted(statuses.items()) if values.get('count')}
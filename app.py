@@ -1,20 +1,129 @@
 # app.py
-from flask import Flask, render_template, request, jsonify, session, redirect, url_for
+import logging
+import os
+import time
+from dotenv import load_dotenv
+from startup import Startup
+
+# Startup is timed from here, so the import phase covers every module below
+startup = Startup()
+
+# Load environment variables before modules that read settings at import time
+load_dotenv()
+
+# LOG_LEVEL=WARNING turns off per-request logs; DEBUG adds request payloads
+logging.basicConfig(level=os.getenv('LOG_LEVEL', 'INFO').upper(),
+                    format='%(asctime)s %(levelname)s %(name)s: %(message)s')
+
+from flask import (Flask, render_template, request, jsonify, session, redirect, url_for, send_file, Response,
+                   stream_with_context, g, before_render_template, template_rendered)
 import uuid
-from datetime import datetime
-from firebase_config import db
+from datetime import date, datetime, timedelta
+from firebase_config import db, DatastoreUnavailable
+from firebase_admin import firestore
+from storage import STORAGE_BACKEND, transactional
+from cache import create_cache, cache_key, cached
+from pdf_renderer import render_invoice_pdf, render_invoice_pdfs, invalidate_invoice_pdf, PdfRendererBusy
+from exports import (stream_zip, stream_csv, stream_jsonl, invoice_export_rows, export_columns, ExportProgress,
+                     INVOICE_EXPORT_COLUMNS)
+from email_outbox import EmailOutbox, build_invoice_email
+from events import EventHub, ChangeFeed, TooManyStreams
+from numbering import InvoiceNumberAllocator, fiscal_year
+from totals import TOTALS_CHUNK_SIZE, compute_totals, recompute_totals
+from analytics import (AnalyticsRollups, ROLLUP_FIELDS, ROLLUP_WRITES_PER_INVOICE, accumulate_rollups,
+                       add_to_rollups, add_to_client_stats, client_stats_updates, client_stats_view,
+                       day_number, issue_date)
+from importer import (IMPORT_FORMATS, ImportReport, ImportRowError, BatchCommitter, detect_format,
+                      iter_rows, parse_client_row, parse_invoice_row)
+import click
+import heapq
+import itertools
+import threading
 import json
+import random
+import base64
 import hashlib
+import re
 from functools import wraps
-import os
-from dotenv import load_dotenv
+import metrics
+from concurrency import gather, read_pool
+from http_cache import make_etag, conditional_json, compress_response
+from search import (INVOICE_SEARCH_COLLECTION, INVOICE_SEARCH_FIELDS, MAX_SEARCH_TOKEN_LENGTH, MIN_INVOICE_TOKEN_LENGTH,
+                    build_invoice_search_entry, prefix_tokens, score_invoice_match, search_terms)
+from archive import (ARCHIVE_AFTER_DAYS, ARCHIVE_INDEX_COLLECTION, ARCHIVE_SEGMENTS_COLLECTION,
+                     build_archive_entry, build_archive_segment, decode_segment, group_by_segment,
+                     is_archivable, new_segment_id)
+from recurring import (RECURRING_COLLECTION, RecurringReport, build_recurring_invoice, due_run_dates,
+                       next_run_date, parse_run_date, parse_template, recurring_invoice_id, schedule_changed)
 
-# Load environment variables
-load_dotenv()
+logger = logging.getLogger(__name__)
 
 app = Flask(__name__)
 app.secret_key = 'your-secret-key-change-this'  # Change this in production
 
+# Dashboard and /api/invoices page sizes
+INVOICE_PAGE_SIZE = 10
+MAX_INVOICE_PAGE_SIZE = 100
+# Query arguments of the invoice list that carry over to its next page
+INVOICE_LIST_ARGS = ('status', 'client', 'from', 'to', 'limit', 'search')
+
+# Invoices read per Firestore query when walking a whole filtered set
+INVOICE_BATCH_SIZE = 200
+
+# Firestore allows at most 500 writes per batch or transaction
+BATCH_WRITE_LIMIT = 500
+MAX_BATCH_INVOICE_IDS = 5000
+# Invoices per commit when each one also updates its search entry, its owner's
+# stats, its client's stats and analytics rollups, leaving two writes for the
+# invoices and clients version counters
+INVOICES_PER_COMMIT = (BATCH_WRITE_LIMIT - 2) // (4 + ROLLUP_WRITES_PER_INVOICE)
+INVOICE_STATUSES = ('draft', 'sent', 'paid', 'overdue')
+# Wrong invoices listed by recompute-totals; the rest are only counted
+MAX_REPORTED_DISCREPANCIES = 1000
+# Longest date range /api/analytics answers, and clients it ranks by default
+MAX_ANALYTICS_DAYS = 3660
+ANALYTICS_CLIENT_LIMIT = 20
+
+# Field names accepted in ?columns= for invoice exports
+EXPORT_COLUMN_PATTERN = re.compile(r'^[A-Za-z_][A-Za-z0-9_]*$')
+
+# Client search: indexed fields, and how many candidates to rank per query
+CLIENT_SEARCH_FIELDS = ('name', 'email', 'company', 'phone')
+CLIENT_SEARCH_CANDIDATES = 200
+# Invoice search entries ranked per query, and results per page
+INVOICE_SEARCH_CANDIDATES = 500
+INVOICE_SEARCH_PAGE_SIZE = 20
+
+# Per collection write counters that version list ETags, each spread over
+# shards since a document sustains about one write a second; reading a
+# version costs one read per shard
+VERSIONS_COLLECTION = 'collection_versions'
+VERSION_SHARDS = int(os.getenv('COLLECTION_VERSION_SHARDS', '10'))
+
+# Writes per generated recurring invoice: the invoice, its search entry, its
+# outbox entry, its client's stats and its rollups. The template and the
+# owner's stats add two per template.
+RECURRING_WRITES_PER_INVOICE = 4 + ROLLUP_WRITES_PER_INVOICE
+
+# Invoices archived per commit: each deletes the invoice and writes its index
+# entry, and may start a segment, leaving one write for the version counter
+ARCHIVE_INVOICES_PER_COMMIT = (BATCH_WRITE_LIMIT - 1) // 3
+
+# Recently updated invoices loaded into the cache by warm-up
+WARM_UP_INVOICES = int(os.getenv('WARM_UP_INVOICES', '50'))
+# Probe endpoints, answered without touching the datastore once ready
+HEALTH_ENDPOINTS = ('healthz', 'readyz')
+
+# Read-through cache for single invoices, clients and user profiles, and the
+# collection whose write counter tells workers their cached entries are stale
+cache = create_cache(versions=lambda: cache_versions())
+CACHED_COLLECTIONS = {'invoice': 'invoices', 'client': 'clients', 'profile': 'user_profiles'}
+
+# Progress of running bulk exports, polled by /api/exports/<export_id>
+export_progress = ExportProgress(db)
+number_allocator = InvoiceNumberAllocator(db)
+analytics = AnalyticsRollups(db)
+
 # Simple user storage (in production, use database)
 users = {
     'admin': hashlib.sha256('password123'.encode()).hexdigest()  # Change this!
@@ -24,7 +133,7 @@ users = {
 def get_invoices_from_firebase():
     """Get all invoices from Firestore"""
     try:
-        if db is None:
+        if not db:
             return []
         
         invoices_ref = db.collection('invoices').order_by('createdAt', direction='DESCENDING')
@@ -36,59 +145,831 @@ def get_invoices_from_firebase():
             invoices.append(invoice)
         return invoices
     except Exception as e:
-        print(f"Error getting invoices: {e}")
+        logger.error("Error getting invoices: %s", e)
         return []
 
-def save_invoice_to_firebase(invoice_data):
-    """Save invoice to Firestore"""
+def encode_invoice_cursor(invoice, field='createdAt'):
+    """Encode an invoice's sort field and id as an opaque page cursor"""
+    value = invoice.get(field)
+    if isinstance(value, datetime):
+        value = value.isoformat()
+    payload = json.dumps({field: value, 'id': invoice['id']})
+    return base64.urlsafe_b64encode(payload.encode()).decode()
+
+def decode_invoice_cursor(cursor, field='createdAt'):
+    """Decode a page cursor into Firestore start_after field values"""
+    try:
+        payload = json.loads(base64.urlsafe_b64decode(cursor.encode()).decode())
+        return {
+            field: datetime.fromisoformat(payload[field]),
+            '__name__': payload['id']
+        }
+    except Exception:
+        return None
+
+def parse_date_arg(value, end_of_day=False):
+    """Parse a YYYY-MM-DD query argument, returning None if missing or invalid"""
+    if not value:
+        return None
+    try:
+        parsed = datetime.strptime(value, '%Y-%m-%d')
+    except ValueError:
+        return None
+    if end_of_day:
+        parsed = parsed + timedelta(days=1)
+    return parsed
+
+def build_invoice_query(status=None, client=None, date_from=None, date_to=None, client_id=None,
+                        collection='invoices'):
+    """Invoices query with the listing filters applied, or the archive index query with `collection`"""
+    query = db.collection(collection)
+    if client_id:
+        query = query.where('clientId', '==', client_id)
+    if status:
+        query = query.where('status', '==', status)
+    if client:
+        query = query.where('clientEmail', '==', client)
+    if date_from:
+        query = query.where('createdAt', '>=', date_from)
+    if date_to:
+        query = query.where('createdAt', '<', date_to)
+    return query
+
+def count_invoices_in_firebase(status=None, client=None, date_from=None, date_to=None, include_archived=False):
+    """Count invoices matching the listing filters without reading them"""
+    try:
+        if not db:
+            return 0
+        collections = ('invoices', ARCHIVE_INDEX_COLLECTION) if include_archived else ('invoices',)
+        return sum(build_invoice_query(status, client, date_from, date_to, collection=collection)
+                   .count().get()[0][0].value for collection in collections)
+    except Exception as e:
+        logger.error("Error counting invoices: %s", e)
+        return 0
+
+def iter_invoices_from_firebase(status=None, client=None, date_from=None, date_to=None, fields=None,
+                                include_archived=False):
+    """Yield every invoice matching the filters, newest first.
+
+    Reads INVOICE_BATCH_SIZE documents per query rather than holding one
+    stream open, so slow consumers don't hit stream timeouts. With
+    `include_archived`, archived invoices are merged in by creation time.
+    """
+    if include_archived:
+        yield from heapq.merge(iter_invoices_from_firebase(status, client, date_from, date_to, fields),
+                               iter_archived_invoices(status, client, date_from, date_to),
+                               key=lambda invoice: invoice['createdAt'], reverse=True)
+        return
+
+    cursor = None
+    while True:
+        # Errors propagate, so a failed read aborts an export instead of truncating it
+        invoices, next_cursor = query_invoices_page(
+            INVOICE_BATCH_SIZE, cursor, status, client, date_from, date_to, fields)
+        yield from invoices
+        if not next_cursor:
+            return
+        cursor = decode_invoice_cursor(next_cursor)
+
+def query_invoices_page(limit=INVOICE_PAGE_SIZE, cursor=None, status=None,
+                        client=None, date_from=None, date_to=None, fields=None, client_id=None):
+    """Read one page of invoices, newest first, raising on datastore errors.
+
+    Filters and the cursor are pushed down into the query so only `limit`
+    documents are read. `fields` limits which fields are fetched. Returns
+    (invoices, next_cursor); next_cursor is None on the last page.
+    """
+    query = build_invoice_query(status, client, date_from, date_to, client_id)
+    query = query.order_by('createdAt', direction='DESCENDING') \
+                 .order_by('__name__', direction='DESCENDING')
+    if cursor:
+        query = query.start_after(cursor)
+    if fields:
+        # createdAt is always needed for the next cursor
+        query = query.select(sorted(set(fields) | {'createdAt'}))
+
+    # Read one extra document to find out whether another page exists
+    docs = query.limit(limit + 1).stream()
+    invoices = []
+    for doc in docs:
+        invoice = doc.to_dict()
+        invoice['id'] = doc.id
+        invoices.append(invoice)
+
+    next_cursor = None
+    if len(invoices) > limit:
+        invoices = invoices[:limit]
+        next_cursor = encode_invoice_cursor(invoices[-1])
+    return invoices, next_cursor
+
+def get_invoices_page_from_firebase(limit=INVOICE_PAGE_SIZE, cursor=None, status=None,
+                                    client=None, date_from=None, date_to=None, fields=None, client_id=None):
+    """One page of invoices for listings, or an empty last page when the datastore fails"""
+    try:
+        if not db:
+            return [], None
+        return query_invoices_page(limit, cursor, status, client, date_from, date_to, fields, client_id)
+    except Exception as e:
+        logger.error("Error getting invoice page: %s", e)
+        return [], None
+
+def get_invoice_filter_args():
+    """Read invoice filter arguments (status, client, from, to) from the request"""
+    return {
+        'status': request.args.get('status') or None,
+        'client': request.args.get('client') or None,
+        'date_from': parse_date_arg(request.args.get('from')),
+        'date_to': parse_date_arg(request.args.get('to'), end_of_day=True)
+    }
+
+def get_invoice_page_args():
+    """Read pagination and filter arguments for invoice listings from the request"""
     try:
-        if db is None:
+        limit = int(request.args.get('limit', INVOICE_PAGE_SIZE))
+    except ValueError:
+        limit = INVOICE_PAGE_SIZE
+    limit = max(1, min(limit, MAX_INVOICE_PAGE_SIZE))
+
+    cursor = request.args.get('cursor') or request.args.get('start_after')
+
+    return {
+        'limit': limit,
+        'cursor': decode_invoice_cursor(cursor) if cursor else None,
+        **get_invoice_filter_args()
+    }
+
+def invoice_template_data(invoice):
+    """Copy of an invoice ready for templates"""
+    # Rename 'items' to 'invoice_items' to avoid conflict with dict.items() method
+    template_data = invoice.copy()
+    if 'items' in template_data:
+        template_data['invoice_items'] = template_data.pop('items')
+    return template_data
+
+def serialize_invoice(invoice):
+    """Return a JSON serializable copy of an invoice"""
+    serialized = invoice.copy()
+    for key in ('createdAt', 'updatedAt', 'dueAt'):
+        if isinstance(serialized.get(key), datetime):
+            serialized[key] = serialized[key].isoformat()
+    return serialized
+
+def save_invoice_to_firebase(invoice_data, user_id=None):
+    """Save invoice to Firestore and count it in the owner's and client's stats"""
+    try:
+        if not db:
             return None
-            
+
         invoice_ref = db.collection('invoices').document()
-        invoice_data['createdAt'] = datetime.now()
-        invoice_ref.set(invoice_data)
+        # updatedAt is set on every write so change listeners see new invoices too
+        invoice_data['createdAt'] = invoice_data['updatedAt'] = datetime.now()
+        due_at = parse_due_date(invoice_data.get('dueDate'))
+        if due_at:
+            invoice_data['dueAt'] = due_at
+        if user_id:
+            invoice_data['userId'] = user_id
+        client_id = find_invoice_client_id(invoice_data)
+        if client_id:
+            invoice_data['clientId'] = client_id
+        else:
+            invoice_data.pop('clientId', None)
+
+        if not invoice_data.get('invoiceNumber'):
+            if number_allocator.block_size == 1:
+                invalidate_clients(create_invoice_in_transaction(db.transaction(), invoice_ref, invoice_data, user_id))
+                return invoice_ref.id
+            invoice_data['invoiceNumber'] = number_allocator.allocate(invoice_data, user_id)
+
+        # Write the invoice, its search entry and its stats delta atomically
+        batch = db.batch()
+        batch.set(invoice_ref, invoice_data)
+        write_invoice_search_entry(batch, invoice_ref.id, invoice_data)
+        changed_clients = write_invoice_changes(batch, user_id, [(None, invoice_data)])
+        bump_invoice_versions(batch, changed_clients)
+        batch.commit()
+        invalidate_clients(changed_clients)
         return invoice_ref.id
     except Exception as e:
-        print(f"Error saving invoice: {e}")
+        logger.error("Error saving invoice: %s", e)
+        return None
+
+def find_client_id_by_email(email):
+    """Id of the client with this email, or None"""
+    email = (email or '').strip()
+    if not email:
         return None
+    for candidate in dict.fromkeys((email, email.lower())):
+        docs = list(db.collection('clients').where('email', '==', candidate).select([]).limit(1).stream())
+        if docs:
+            return docs[0].id
+    return None
+
+def find_invoice_client_id(invoice_data):
+    """The client an invoice belongs to: its clientId if that client exists, else by clientEmail"""
+    client_id = invoice_data.get('clientId')
+    if client_id and get_client_from_firebase(str(client_id)):
+        return str(client_id)
+    return find_client_id_by_email(invoice_data.get('clientEmail'))
 
+@transactional
+def create_invoice_in_transaction(transaction, invoice_ref, invoice_data, user_id=None):
+    """Number and write a new invoice in one transaction, so numbers have no gaps.
+    Returns the ids of clients whose stats changed."""
+    invoice_data['invoiceNumber'] = number_allocator.next_in_transaction(transaction, invoice_data, user_id)
+    transaction.set(invoice_ref, invoice_data)
+    write_invoice_search_entry(transaction, invoice_ref.id, invoice_data)
+    changed_clients = write_invoice_changes(transaction, user_id, [(None, invoice_data)])
+    bump_invoice_versions(transaction, changed_clients)
+    return changed_clients
+
+@cached(cache, 'invoice')
 def get_invoice_from_firebase(invoice_id):
     """Get single invoice from Firestore"""
     try:
-        if db is None:
+        if not db:
             return None
             
         doc = db.collection('invoices').document(invoice_id).get()
         if doc.exists:
             invoice = doc.to_dict()
             invoice['id'] = doc.id
-            
-            # Debug: Print the invoice structure
-            print("Invoice data:", invoice)
-            print("Items type:", type(invoice.get('items', 'N/A')))
-            print("Items content:", invoice.get('items', 'N/A'))
-            
             return invoice
+        return get_archived_invoice(invoice_id)
+    except Exception as e:
+        logger.error("Error getting invoice: %s", e)
+        return None
+
+@transactional
+def update_invoice_status_in_transaction(transaction, invoice_ref, status, only_from=None):
+    """Update an invoice's status and move it between stats buckets.
+
+    When `only_from` is given the update is skipped unless the invoice still
+    has that status. Returns the updated invoice, or None if nothing changed.
+    """
+    snapshot = invoice_ref.get(transaction=transaction)
+    if not snapshot.exists:
+        return None
+
+    invoice = snapshot.to_dict()
+    if only_from and invoice.get('status', 'draft') != only_from:
+        return None
+
+    updated_at = datetime.now()
+    transaction.update(invoice_ref, {
+        'status': status,
+        'updatedAt': updated_at
+    })
+    update_invoice_search_entry(transaction, invoice_ref.id, {'status': status})
+
+    user_id = invoice.get('userId')
+    changed_clients = set()
+    if invoice.get('status', 'draft') != status:
+        changed_clients = write_invoice_changes(transaction, user_id, [(invoice, {**invoice, 'status': status})])
+    bump_invoice_versions(transaction, changed_clients)
+    return {**invoice, 'id': invoice_ref.id, 'status': status, 'updatedAt': updated_at}
+
+def update_invoice_status_firebase(invoice_id, status, only_from=None):
+    """Update invoice status in Firestore, returning the updated invoice"""
+    try:
+        if not db:
+            return None
+
+        invoice_ref = db.collection('invoices').document(invoice_id)
+        invoice = update_invoice_status_in_transaction(db.transaction(), invoice_ref, status, only_from)
+        cache.delete(cache_key('invoice', invoice_id))
+        if invoice:
+            invalidate_clients([invoice.get('clientId')])
+        return invoice
+    except Exception as e:
+        logger.error("Error updating invoice: %s", e)
+        return None
+
+def chunked(items, size):
+    """Split a list into lists of at most `size` items"""
+    return [items[i:i + size] for i in range(0, len(items), size)]
+
+@transactional
+def apply_invoice_batch_in_transaction(transaction, invoice_refs, action, status=None, deleted_clients=None,
+                                       changed_clients=None):
+    """Set the status of, or delete, a chunk of invoices with their stats deltas.
+
+    Reads every invoice in one get_all call, then writes the invoice changes
+    and one combined stats update per owner. Clients of deleted invoices are
+    added to `deleted_clients`, and clients whose stats changed to
+    `changed_clients`. Returns {invoice_id: result}.
+    """
+    results = {}
+    stats_changes = {}
+    updated_at = datetime.now()
+
+    for snapshot in db.get_all(invoice_refs, transaction=transaction):
+        if not snapshot.exists:
+            results[snapshot.id] = {'success': False, 'error': 'Invoice not found'}
+            continue
+
+        invoice = snapshot.to_dict()
+        if action == 'delete':
+            transaction.delete(snapshot.reference)
+            transaction.delete(invoice_search_ref(snapshot.id))
+            change = (invoice, None)
+            results[snapshot.id] = {'success': True, 'deleted': True}
+            if deleted_clients is not None and invoice.get('clientId'):
+                deleted_clients.add(invoice['clientId'])
+        else:
+            transaction.update(snapshot.reference, {'status': status, 'updatedAt': updated_at})
+            update_invoice_search_entry(transaction, snapshot.id, {'status': status})
+            change = (invoice, {**invoice, 'status': status}) if invoice.get('status', 'draft') != status else None
+            results[snapshot.id] = {'success': True, 'status': status}
+
+        if change:
+            stats_changes.setdefault(invoice.get('userId'), []).append(change)
+
+    client_ids = set()
+    for user_id, changes in stats_changes.items():
+        client_ids |= write_invoice_changes(transaction, user_id, changes)
+    if changed_clients is not None:
+        changed_clients.update(client_ids)
+    if any(result['success'] for result in results.values()):
+        bump_invoice_versions(transaction, client_ids)
+    return results
+
+def batch_update_invoices_firebase(invoice_ids, action, status=None, user_id=None):
+    """Apply a status change, send or delete to many invoices.
+
+    Status changes and deletes commit in chunks, each chunk a single
+    transaction with its stats updates. Sends queue all emails through
+    batched outbox writes. Returns {invoice_id: result}.
+    """
+    results = {}
+    if not db:
+        return {invoice_id: {'success': False, 'error': 'Database unavailable'} for invoice_id in invoice_ids}
+
+    invoices_ref = db.collection('invoices')
+    deleted_clients = set()
+    for chunk in chunked(invoice_ids, INVOICES_PER_COMMIT):
+        refs = [invoices_ref.document(invoice_id) for invoice_id in chunk]
+        changed_clients = set()
+        try:
+            if action == 'send':
+                results.update(queue_invoice_emails(refs, user_id))
+                continue
+            results.update(apply_invoice_batch_in_transaction(db.transaction(), refs, action, status,
+                                                              deleted_clients, changed_clients))
+        except Exception as e:
+            logger.error("Error applying batch %s: %s", action, e)
+            results.update({invoice_id: {'success': False, 'error': str(e)} for invoice_id in chunk})
+            continue
+
+        cache.delete(*[cache_key('invoice', invoice_id) for invoice_id in chunk])
+        invalidate_clients(changed_clients)
+        if action == 'delete':
+            for invoice_id in chunk:
+                invalidate_invoice_pdf(invoice_id)
+
+    for client_id in deleted_clients:
+        try:
+            refresh_client_last_invoice_in_transaction(db.transaction(), db.collection('clients').document(client_id))
+            cache.delete(cache_key('client', client_id))
+        except Exception as e:
+            logger.error("Error refreshing client %s: %s", client_id, e)
+    return results
+
+@transactional
+def refresh_client_last_invoice_in_transaction(transaction, client_ref):
+    """Recompute a client's lastInvoiceDate, which deletes can move backwards"""
+    snapshot = client_ref.get(transaction=transaction)
+    if not snapshot.exists:
+        return
+    queries = [db.collection(collection).where('clientId', '==', client_ref.id).select(['invoiceDate', 'createdAt'])
+               for collection in ('invoices', ARCHIVE_INDEX_COLLECTION)]
+    days = [day_number(issue_date(doc.to_dict())) for query in queries for doc in query.stream(transaction=transaction)
+            if issue_date(doc.to_dict())]
+    transaction.update(client_ref, {'stats.lastInvoiceDate': max(days) if days else firestore.DELETE_FIELD,
+                                    'updatedAt': datetime.now()})
+    bump_collection_version(transaction, 'clients')
+
+def archive_entry_ref(invoice_id):
+    return db.collection(ARCHIVE_INDEX_COLLECTION).document(invoice_id)
+
+def load_archive_segments(segment_ids, loaded=None):
+    """Decompressed segments by id, reusing those in `loaded` and reading the rest in one get_all call"""
+    loaded = loaded or {}
+    segments = {segment_id: loaded[segment_id] for segment_id in segment_ids if segment_id in loaded}
+    missing = [segment_id for segment_id in dict.fromkeys(segment_ids) if segment_id not in segments]
+    if missing:
+        refs = [db.collection(ARCHIVE_SEGMENTS_COLLECTION).document(segment_id) for segment_id in missing]
+        for snapshot in db.get_all(refs):
+            segments[snapshot.id] = decode_segment(snapshot.get('data')) if snapshot.exists else {}
+    return segments
+
+def get_archived_invoice(invoice_id):
+    """An archived invoice from its segment, or None if it was never archived"""
+    entry = archive_entry_ref(invoice_id).get()
+    if not entry.exists:
+        return None
+    segment_id = entry.get('segmentId')
+    invoice = load_archive_segments([segment_id])[segment_id].get(invoice_id)
+    if invoice is None:
+        logger.error("Archived invoice %s is missing from segment %s", invoice_id, segment_id)
+        return None
+    # The index entry is kept current when the invoice's client is deleted
+    invoice.pop('clientId', None)
+    return {**invoice, **entry.to_dict(), 'id': invoice_id, 'archived': True}
+
+def iter_archived_invoices(status=None, client=None, date_from=None, date_to=None):
+    """Yield archived invoices matching the listing filters, newest first.
+
+    Filters run on the index entries. Each page of entries opens its
+    segments once, keeping those the previous page already opened.
+    """
+    query = build_invoice_query(status, client, date_from, date_to, collection=ARCHIVE_INDEX_COLLECTION)
+    query = query.order_by('createdAt', direction='DESCENDING').order_by('__name__', direction='DESCENDING')
+    cursor = None
+    segments = {}
+    while True:
+        page = query.start_after(cursor) if cursor else query
+        entries = [(doc.id, doc.to_dict()) for doc in page.limit(INVOICE_BATCH_SIZE).stream()]
+        segments = load_archive_segments([entry['segmentId'] for _, entry in entries], segments)
+        for invoice_id, entry in entries:
+            invoice = segments[entry['segmentId']].get(invoice_id)
+            if invoice is not None:
+                invoice.pop('clientId', None)
+                yield {**invoice, **entry, 'id': invoice_id, 'archived': True}
+        if len(entries) < INVOICE_BATCH_SIZE:
+            return
+        cursor = {'createdAt': entries[-1][1]['createdAt'], '__name__': entries[-1][0]}
+
+@transactional
+def archive_invoices_in_transaction(transaction, invoice_refs, cutoff):
+    """Move a chunk of settled invoices into compressed segments, one per owner and month.
+
+    Invoices are read again in the transaction and left alone unless still
+    archivable. Stats, rollups and search entries are not changed, since
+    archived invoices still count and can still be found. Returns
+    (invoices archived, segments written).
+    """
+    invoices = []
+    for snapshot in db.get_all(invoice_refs, transaction=transaction):
+        if snapshot.exists:
+            invoice = {**snapshot.to_dict(), 'id': snapshot.id}
+            if is_archivable(invoice, cutoff):
+                invoices.append(invoice)
+
+    archived_at = datetime.now()
+    groups = group_by_segment(invoices)
+    for (user_id, month), group in groups.items():
+        segment_id = new_segment_id(month)
+        transaction.set(db.collection(ARCHIVE_SEGMENTS_COLLECTION).document(segment_id),
+                        build_archive_segment(group, user_id, month, archived_at))
+        for invoice in group:
+            transaction.set(archive_entry_ref(invoice['id']), build_archive_entry(invoice, segment_id, archived_at))
+            transaction.delete(db.collection('invoices').document(invoice['id']))
+    if invoices:
+        bump_collection_version(transaction, 'invoices')
+    return len(invoices), len(groups)
+
+def archive_invoices(older_than_days=ARCHIVE_AFTER_DAYS, dry_run=False):
+    """Move paid invoices created more than `older_than_days` ago out of the invoices collection.
+
+    Listings, dashboards and scans then only read the live working set,
+    while /invoice/<id>, PDFs, exports and search still find archived
+    invoices. Returns (invoices archived, or archivable on a dry run,
+    segments written).
+    """
+    if not db:
+        return 0, 0
+
+    cutoff = datetime.now() - timedelta(days=older_than_days)
+    query = build_invoice_query(status='paid', date_to=cutoff)
+    if dry_run:
+        return query.count().get()[0][0].value, 0
+
+    query = query.order_by('createdAt', direction='DESCENDING').select([]).limit(ARCHIVE_INVOICES_PER_COMMIT)
+    archived = 0
+    segments = 0
+    while True:
+        refs = [doc.reference for doc in query.stream()]
+        if not refs:
+            break
+        try:
+            count, written = archive_invoices_in_transaction(db.transaction(), refs, cutoff)
+        except Exception as e:
+            logger.error("Error archiving invoices: %s", e)
+            break
+        cache.delete(*[cache_key('invoice', ref.id) for ref in refs])
+        if not count:
+            break
+        archived += count
+        segments += written
+    return archived, segments
+
+def queue_invoice_emails(invoice_refs, user_id):
+    """Queue emails for a chunk of invoices, reading them in one get_all call"""
+    results = {}
+    to_queue = []
+    for snapshot in db.get_all(invoice_refs):
+        if not snapshot.exists:
+            results[snapshot.id] = {'success': False, 'error': 'Invoice not found'}
+        elif not snapshot.get('clientEmail'):
+            results[snapshot.id] = {'success': False, 'error': 'Invoice has no client email'}
+        else:
+            to_queue.append((snapshot.id, user_id, snapshot.get('clientEmail')))
+
+    for (invoice_id, _, _), entry_id in zip(to_queue, outbox.enqueue_many(to_queue)):
+        results[invoice_id] = {'success': True, 'outboxId': entry_id}
+    return results
+
+def version_shard_ref(collection, shard):
+    return db.collection(VERSIONS_COLLECTION).document(f"{collection}:{shard}")
+
+def bump_collection_version(writer, collection):
+    """Count a write to a collection, which changes its list ETags.
+
+    Written in the same batch or transaction as the change, or after it
+    has committed, so a client never sees a new version with old data.
+    Each write counts on a random shard, so writers rarely contend.
+    """
+    writer.set(version_shard_ref(collection, random.randrange(VERSION_SHARDS)), {'version': firestore.Increment(1)},
+               merge=True)
+
+def bump_invoice_versions(writer, changed_clients=()):
+    """Count a write to invoices, and to clients when it changed their stats"""
+    bump_collection_version(writer, 'invoices')
+    if changed_clients:
+        bump_collection_version(writer, 'clients')
+
+def commit_collection_versions(*collections):
+    """Bump versions on their own, once bulk writes to the collections have committed"""
+    batch = db.batch()
+    for collection in collections:
+        bump_collection_version(batch, collection)
+    batch.commit()
+
+def invoice_search_ref(invoice_id):
+    return db.collection(INVOICE_SEARCH_COLLECTION).document(invoice_id)
+
+def write_invoice_search_entry(writer, invoice_id, invoice):
+    """Index a new invoice for search in the same write as the invoice"""
+    writer.set(invoice_search_ref(invoice_id), build_invoice_search_entry(invoice))
+
+def update_invoice_search_entry(writer, invoice_id, fields):
+    """Keep an invoice's search entry in step with a status or total change"""
+    writer.set(invoice_search_ref(invoice_id), fields, merge=True)
+
+def collection_version(collection):
+    """How many writes a collection has had, summed over the shards bump_collection_version counts on"""
+    shards = db.get_all([version_shard_ref(collection, shard) for shard in range(VERSION_SHARDS)])
+    return sum((snapshot.to_dict() or {}).get('version', 0) for snapshot in shards)
+
+def cache_versions():
+    """Write counters of the cached collections by cache key prefix, read in one round trip"""
+    if not db:
+        return {}
+    refs = [version_shard_ref(collection, shard) for collection in CACHED_COLLECTIONS.values()
+            for shard in range(VERSION_SHARDS)]
+    versions = dict.fromkeys(CACHED_COLLECTIONS, 0)
+    prefixes = {collection: prefix for prefix, collection in CACHED_COLLECTIONS.items()}
+    for snapshot in db.get_all(refs):
+        collection = snapshot.id.rsplit(':', 1)[0]
+        versions[prefixes[collection]] += (snapshot.to_dict() or {}).get('version', 0)
+    return versions
+
+def cached_etag(prefix, *args):
+    """ETag for a cached document from its collection's write counter, or None when that can't be read
+
+    This worker's cached entries older than the counter are dropped first,
+    so the body sent with the ETag is at least as new.
+    """
+    if not db:
         return None
+    try:
+        version = collection_version(CACHED_COLLECTIONS[prefix])
     except Exception as e:
-        print(f"Error getting invoice: {e}")
+        logger.error("Error reading %s version: %s", prefix, e)
         return None
+    cache.sync({prefix: version})
+    return make_etag(prefix, version, *args)
 
-def update_invoice_status_firebase(invoice_id, status):
-    """Update invoice status in Firestore"""
+def list_etag(collection, *args):
+    """ETag for a listing of a collection, or None when its version can't be read"""
+    if not db:
+        return None
     try:
-        if db is None:
-            return False
-            
-        db.collection('invoices').document(invoice_id).update({
-            'status': status,
-            'updatedAt': datetime.now()
-        })
-        return True
+        return make_etag(collection, collection_version(collection), *args)
     except Exception as e:
-        print(f"Error updating invoice: {e}")
-        return False
+        logger.error("Error reading %s version: %s", collection, e)
+        return None
+
+def dashboard_stats_ref(user_id):
+    """Reference to a user's persisted dashboard stats document"""
+    return db.collection('dashboard_stats').document(user_id)
+
+def write_invoice_changes(writer, user_id, changes):
+    """Apply (removed, added) invoice pairs to the owner's dashboard stats and analytics
+    rollups and to the stats of the clients involved.
+
+    Returns the ids of those clients, which callers drop from the cache once
+    the write has committed.
+    """
+    if user_id:
+        writer.set(dashboard_stats_ref(user_id), build_batch_stats_update(changes), merge=True)
+        analytics.write_changes(writer, user_id, changes)
+    client_updates = client_stats_updates(changes)
+    for client_id, update in client_updates.items():
+        writer.set(db.collection('clients').document(client_id), {**update, 'updatedAt': datetime.now()}, merge=True)
+    return set(client_updates)
+
+def invalidate_clients(client_ids):
+    """Drop clients whose stats a committed write changed from the cache"""
+    cache.delete(*[cache_key('client', client_id) for client_id in client_ids if client_id])
+
+def invoice_amount(invoice):
+    """Invoice total as a number, treating missing or bad values as zero"""
+    try:
+        return float(invoice.get('total') or 0)
+    except (TypeError, ValueError):
+        return 0
+
+def build_batch_stats_update(changes):
+    """Build Increment deltas for many (removed, added) invoice pairs"""
+    counts = {}
+    amounts = {}
+    total_invoices = 0
+    total_amount = 0
+
+    for invoice, sign in ((invoice, sign) for removed, added in changes
+                          for invoice, sign in ((removed, -1), (added, 1))):
+        if not invoice:
+            continue
+        status = invoice.get('status', 'draft')
+        amount = invoice_amount(invoice)
+        counts[status] = counts.get(status, 0) + sign
+        amounts[status] = amounts.get(status, 0) + sign * amount
+        total_invoices += sign
+        total_amount += sign * amount
+
+    return {
+        'total_invoices': firestore.Increment(total_invoices),
+        'total_amount': firestore.Increment(total_amount),
+        'counts': {status: firestore.Increment(delta) for status, delta in counts.items()},
+        'amounts': {status: firestore.Increment(delta) for status, delta in amounts.items()},
+        'updatedAt': datetime.now()
+    }
+
+def add_to_dashboard_stats(stats_by_user, owner, invoice):
+    stats = stats_by_user.setdefault(owner, {
+        'total_invoices': 0, 'total_amount': 0, 'counts': {}, 'amounts': {}
+    })
+    status = invoice.get('status', 'draft')
+    amount = invoice_amount(invoice)
+    stats['total_invoices'] += 1
+    stats['total_amount'] += amount
+    stats['counts'][status] = stats['counts'].get(status, 0) + 1
+    stats['amounts'][status] = stats['amounts'].get(status, 0) + amount
+
+def rebuild_dashboard_stats(user_id=None, assign_to=None):
+    """Recompute dashboard stats documents from the invoices collection and the archive.
+
+    Repairs drift in the incrementally maintained stats. Invoices without a
+    userId are claimed for `assign_to` when given, otherwise skipped;
+    archived ones are never claimed. Returns {user_id: stats} for every
+    document written.
+    """
+    if not db:
+        return {}
+
+    query = db.collection('invoices')
+    archived = db.collection(ARCHIVE_INDEX_COLLECTION)
+    if user_id and not assign_to:
+        query = query.where('userId', '==', user_id)
+    if user_id:
+        archived = archived.where('userId', '==', user_id)
+
+    stats_by_user = {}
+    batch = db.batch()
+    pending = 0
+    assigned = 0
+    for doc in query.select(['status', 'total', 'userId']).stream():
+        invoice = doc.to_dict()
+        owner = invoice.get('userId')
+        if not owner and assign_to:
+            owner = assign_to
+            batch.update(doc.reference, {'userId': owner, 'updatedAt': datetime.now()})
+            cache.delete(cache_key('invoice', doc.id))
+            pending += 1
+            assigned += 1
+            if pending == 500:
+                batch.commit()
+                batch = db.batch()
+                pending = 0
+        if not owner or (user_id and owner != user_id):
+            continue
+        add_to_dashboard_stats(stats_by_user, owner, invoice)
+    if pending:
+        batch.commit()
+    if assigned:
+        commit_collection_versions('invoices')
+
+    for doc in archived.select(['status', 'total', 'userId']).stream():
+        invoice = doc.to_dict()
+        if invoice.get('userId'):
+            add_to_dashboard_stats(stats_by_user, invoice['userId'], invoice)
+
+    if user_id and user_id not in stats_by_user:
+        stats_by_user[user_id] = {'total_invoices': 0, 'total_amount': 0, 'counts': {}, 'amounts': {}}
+
+    for owner, stats in stats_by_user.items():
+        dashboard_stats_ref(owner).set({**stats, 'updatedAt': datetime.now()})
+    return stats_by_user
+
+def rebuild_analytics_rollups(user_id=None):
+    """Recompute analytics rollup documents from the invoices collection and the archive.
+
+    Rollups of the users being rebuilt that no longer have invoices are
+    deleted. Returns the number of rollup documents written.
+    """
+    if not db:
+        return 0
+
+    queries = [db.collection('invoices'), db.collection(ARCHIVE_INDEX_COLLECTION)]
+    existing = analytics.collection()
+    if user_id:
+        queries = [query.where('userId', '==', user_id) for query in queries]
+        existing = existing.where('userId', '==', user_id)
+
+    rollups = {}
+    for doc in itertools.chain.from_iterable(query.select(['userId', *ROLLUP_FIELDS]).stream() for query in queries):
+        invoice = doc.to_dict()
+        if invoice.get('userId'):
+            add_to_rollups(rollups, invoice['userId'], invoice, 1)
+
+    batch = db.batch()
+    pending = 0
+    writes = [(doc.reference, None) for doc in existing.select([]).stream() if doc.id not in rollups]
+    writes += [(analytics.collection().document(key), rollup) for key, rollup in rollups.items()]
+    for ref, rollup in writes:
+        if rollup is None:
+            batch.delete(ref)
+        else:
+            batch.set(ref, {**rollup, 'updatedAt': datetime.now()})
+        pending += 1
+        if pending == BATCH_WRITE_LIMIT:
+            batch.commit()
+            batch = db.batch()
+            pending = 0
+    if pending:
+        batch.commit()
+    return len(rollups)
+
+def rebuild_client_stats():
+    """Link invoices to clients by email and recompute every client's stats.
+
+    For invoices saved before clientId was set on creation. Archived
+    invoices count towards stats by email too, but are not linked. Returns
+    (invoices linked, clients updated).
+    """
+    if not db:
+        return 0, 0
+
+    client_ids = get_client_ids_by_email()
+    stats_by_client = {}
+    links = []
+    fields = ['clientId', 'clientEmail', 'status', 'total', 'invoiceDate', 'createdAt']
+    for doc in db.collection('invoices').select(fields).stream():
+        invoice = doc.to_dict()
+        if not invoice.get('clientId'):
+            client_id = client_ids.get((invoice.get('clientEmail') or '').strip().lower())
+            if not client_id:
+                continue
+            invoice['clientId'] = client_id
+            links.append((doc.reference, client_id))
+        add_to_client_stats(stats_by_client, invoice, 1, new=True)
+    for doc in db.collection(ARCHIVE_INDEX_COLLECTION).select(fields).stream():
+        invoice = doc.to_dict()
+        if not invoice.get('clientId'):
+            invoice['clientId'] = client_ids.get((invoice.get('clientEmail') or '').strip().lower())
+        if invoice['clientId']:
+            add_to_client_stats(stats_by_client, invoice, 1, new=True)
+
+    writes = [(invoice_ref, {'clientId': client_id}) for invoice_ref, client_id in links]
+    for doc in db.collection('clients').select([]).stream():
+        stats = stats_by_client.get(doc.id, {})
+        writes.append((doc.reference, {
+            'stats.invoiceCount': stats.get('invoiceCount', 0),
+            'stats.billed': round(stats.get('billed', 0), 2),
+            'stats.outstanding': round(stats.get('outstanding', 0), 2),
+            'stats.lastInvoiceDate': stats.get('lastInvoiceDate') or firestore.DELETE_FIELD
+        }))
+    updated_at = datetime.now()
+    for chunk in chunked(writes, BATCH_WRITE_LIMIT):
+        batch = db.batch()
+        for ref, update in chunk:
+            batch.update(ref, {**update, 'updatedAt': updated_at})
+        batch.commit()
+    commit_collection_versions(*(['invoices'] if links else []), 'clients')
+    cache.delete(*[cache_key('invoice', invoice_ref.id) for invoice_ref, _ in links])
+    cache.delete(*[cache_key('client', ref.id) for ref, _ in writes[len(links):]])
+    return len(links), len(writes) - len(links)
 
 def hash_password(password):
     """Simple password hashing"""
@@ -103,173 +984,1112 @@ def login_required(f):
         return f(*args, **kwargs)
     return decorated_function
 
+def parse_due_date(value):
+    """Normalize a YYYY-MM-DD due date string to a datetime at midnight"""
+    if isinstance(value, datetime):
+        return value.replace(hour=0, minute=0, second=0, microsecond=0)
+    try:
+        return datetime.strptime(value, '%Y-%m-%d')
+    except (TypeError, ValueError):
+        return None
+
+def start_of_today():
+    """Midnight today, the cutoff for overdue due dates"""
+    return datetime.now().replace(hour=0, minute=0, second=0, microsecond=0)
+
 def is_overdue(invoice):
     """Check if invoice is overdue"""
-    try:
-        if invoice.get('status') in ['paid', 'draft']:
-            return False
-            
-        due_date_str = invoice.get('dueDate')
-        if due_date_str:
-            due_date = datetime.strptime(due_date_str, '%Y-%m-%d')
-            return datetime.now() > due_date
-        return False
-    except:
+    status = invoice.get('status')
+    if status == 'overdue':
+        return True
+    if status in ['paid', 'draft']:
         return False
 
-def get_dashboard_stats(invoices=None):
-    """Get dashboard statistics"""
+    # ISO dates order correctly as strings, so no parsing is needed per row
+    due_date = invoice.get('dueDate')
+    return bool(due_date) and str(due_date) < datetime.now().strftime('%Y-%m-%d')
+
+def get_overdue_invoices_from_firebase(limit=INVOICE_PAGE_SIZE, cursor=None):
+    """Get invoices past their due date, oldest due date first.
+
+    Uses a range query on the indexed dueAt field, covering both invoices
+    already flipped to 'overdue' and sent invoices the daily pass has not
+    reached yet. Returns (invoices, next_cursor).
+    """
     try:
-        if invoices is None:
-            invoices = get_invoices_from_firebase()
-        
-        total_invoices = len(invoices)
-        total_amount = sum(invoice.get('total', 0) for invoice in invoices)
-        
-        # Count by status
-        draft_count = sum(1 for invoice in invoices if invoice.get('status') == 'draft')
-        sent_count = sum(1 for invoice in invoices if invoice.get('status') == 'sent')
-        paid_count = sum(1 for invoice in invoices if invoice.get('status') == 'paid')
-        overdue_count = sum(1 for invoice in invoices if is_overdue(invoice))
-        
-        stats = {
-            'total_invoices': total_invoices,
-            'total_amount': total_amount,
-            'draft_count': draft_count,
-            'sent_count': sent_count,
-            'paid_count': paid_count,
-            'overdue_count': overdue_count
-        }
-        
-        return stats
+        if not db:
+            return [], None
+
+        query = db.collection('invoices') \
+            .where('status', 'in', ['sent', 'overdue']) \
+            .where('dueAt', '<', start_of_today()) \
+            .order_by('dueAt') \
+            .order_by('__name__')
+        if cursor:
+            query = query.start_after(cursor)
+
+        invoices = []
+        for doc in query.limit(limit + 1).stream():
+            invoice = doc.to_dict()
+            invoice['id'] = doc.id
+            invoices.append(invoice)
+
+        next_cursor = None
+        if len(invoices) > limit:
+            invoices = invoices[:limit]
+            next_cursor = encode_invoice_cursor(invoices[-1], field='dueAt')
+        return invoices, next_cursor
+    except Exception as e:
+        logger.error("Error getting overdue invoices: %s", e)
+        return [], None
+
+def mark_overdue_invoices():
+    """Flip sent invoices past their due date to 'overdue'.
+
+    Meant to run once a day from a scheduler. Each invoice is moved in its
+    own transaction so the dashboard stats stay consistent with concurrent
+    status changes. Returns the number of invoices flipped.
+    """
+    if not db:
+        return 0
+
+    query = db.collection('invoices') \
+        .where('status', '==', 'sent') \
+        .where('dueAt', '<', start_of_today())
+
+    flipped = 0
+    for doc in query.select([]).stream():
+        invoice = update_invoice_status_in_transaction(db.transaction(), doc.reference, 'overdue', only_from='sent')
+        if invoice:
+            cache.delete(cache_key('invoice', doc.id))
+            invalidate_clients([invoice.get('clientId')])
+            flipped += 1
+    return flipped
+
+def backfill_due_dates():
+    """Add the normalized dueAt field to invoices written before it existed"""
+    if not db:
+        return 0
+
+    batch = db.batch()
+    pending = 0
+    updated = 0
+    for doc in db.collection('invoices').select(['dueDate', 'dueAt']).stream():
+        invoice = doc.to_dict()
+        if invoice.get('dueAt'):
+            continue
+        due_at = parse_due_date(invoice.get('dueDate'))
+        if not due_at:
+            continue
+        batch.update(doc.reference, {'dueAt': due_at, 'updatedAt': datetime.now()})
+        cache.delete(cache_key('invoice', doc.id))
+        pending += 1
+        updated += 1
+        if pending == 500:
+            batch.commit()
+            batch = db.batch()
+            pending = 0
+    if pending:
+        batch.commit()
+    if updated:
+        commit_collection_versions('invoices')
+    return updated
+
+def recompute_invoice_totals(user_id=None, fix=False, apply_default_rate=False, include_issued=False):
+    """Recompute line amounts and totals of stored invoices in paise.
+
+    Invoices are checked TOTALS_CHUNK_SIZE at a time. With
+    `apply_default_rate`, drafts are re-rated with their owner's current
+    defaultTaxRate. With `fix`, wrong drafts are corrected (and sent, paid
+    or overdue ones too with `include_issued`) along with the dashboard
+    stats; otherwise they are only reported. Invoices whose amounts can't
+    be parsed are reported as invalid and left alone. Returns a report dict.
+    """
+    report = {'checked': 0, 'wrong': 0, 'invalid': 0, 'rerated': 0, 'fixed': 0, 'discrepancies': []}
+    if not db:
+        return report
+
+    query = db.collection('invoices')
+    if user_id:
+        query = query.where('userId', '==', user_id)
+    fields = ['items', 'subtotal', 'tax', 'total', 'taxRate', 'status', 'userId', 'invoiceNumber',
+              *ROLLUP_FIELDS]
+
+    def check(chunk):
+        invoices = [doc.to_dict() for doc in chunk]
+        tax_rates = None
+        if apply_default_rate:
+            tax_rates = [(get_user_profile(invoice.get('userId')) or {}).get('defaultTaxRate') or None
+                         if invoice.get('status', 'draft') == 'draft' and invoice.get('userId') else None
+                         for invoice in invoices]
+        try:
+            results = recompute_totals(invoices, tax_rates)
+        except ValueError:
+            # One unparsable legacy invoice fails the whole chunk, so check
+            # them one at a time and report the ones that can't be read
+            results = []
+            for index, invoice in enumerate(invoices):
+                try:
+                    checked = recompute_totals([invoice], tax_rates and [tax_rates[index]])
+                except ValueError as e:
+                    report['invalid'] += 1
+                    if len(report['discrepancies']) < MAX_REPORTED_DISCREPANCIES:
+                        report['discrepancies'].append({
+                            'id': chunk[index].id,
+                            'invoiceNumber': invoice.get('invoiceNumber'),
+                            'fields': ['invalid'],
+                            'error': str(e),
+                            'stored': {field: invoice.get(field) for field in ('subtotal', 'tax', 'total')},
+                            'expected': None
+                        })
+                    continue
+                results.extend((index, totals, problems) for _, totals, problems in checked)
+        fixes = []
+        for index, totals, problems in results:
+            invoice = invoices[index]
+            if tax_rates and tax_rates[index] is not None and totals.get('taxRate') != invoice.get('taxRate'):
+                # A new rate changes tax and total by design
+                report['rerated'] += 1
+                problems = [field for field in problems if field not in ('tax', 'total')]
+            if problems:
+                report['wrong'] += 1
+                if len(report['discrepancies']) < MAX_REPORTED_DISCREPANCIES:
+                    report['discrepancies'].append({
+                        'id': chunk[index].id,
+                        'invoiceNumber': invoice.get('invoiceNumber'),
+                        'fields': problems,
+                        'stored': {field: invoice.get(field) for field in ('subtotal', 'tax', 'total')},
+                        'expected': {field: totals[field] for field in ('subtotal', 'tax', 'total')}
+                    })
+            if fix and (include_issued or invoice.get('status', 'draft') == 'draft'):
+                fixes.append((chunk[index], invoice, totals))
+        report['checked'] += len(chunk)
+
+        for group in chunked(fixes, INVOICES_PER_COMMIT):
+            batch = db.batch()
+            changes_by_owner = {}
+            for doc, invoice, totals in group:
+                batch.update(doc.reference, {**totals, 'updatedAt': datetime.now()})
+                update_invoice_search_entry(batch, doc.id, {'total': totals['total']})
+                changes_by_owner.setdefault(invoice.get('userId'), []).append((invoice, {**invoice, **totals}))
+            changed_clients = set()
+            for owner, changes in changes_by_owner.items():
+                changed_clients |= write_invoice_changes(batch, owner, changes)
+            bump_invoice_versions(batch, changed_clients)
+            batch.commit()
+            invalidate_clients(changed_clients)
+            for doc, _, _ in group:
+                cache.delete(cache_key('invoice', doc.id))
+                invalidate_invoice_pdf(doc.id)
+            report['fixed'] += len(group)
+
+    chunk = []
+    for doc in query.select(fields).stream():
+        chunk.append(doc)
+        if len(chunk) == TOTALS_CHUNK_SIZE:
+            check(chunk)
+            chunk = []
+    if chunk:
+        check(chunk)
+    return report
+
+def empty_dashboard_stats():
+    """Dashboard statistics for a user with no invoices"""
+    return {
+        'total_invoices': 0,
+        'total_amount': 0,
+        'draft_count': 0,
+        'sent_count': 0,
+        'paid_count': 0,
+        'overdue_count': 0
+    }
+
+def get_dashboard_stats(user_id):
+    """Get dashboard statistics from the user's persisted stats document"""
+    try:
+        if not db:
+            return empty_dashboard_stats()
+
+        doc, overdue_sent = gather(lambda: dashboard_stats_ref(user_id).get(),
+                                   lambda: count_overdue_sent_invoices(user_id))
+        if not doc.exists:
+            return empty_dashboard_stats()
+        return dashboard_stats_from_doc(user_id, doc.to_dict(), overdue_sent)
     except Exception as e:
-        print(f"Error getting dashboard stats: {e}")
+        logger.error("Error getting dashboard stats: %s", e)
         # Return default stats to prevent errors
-        return {
-            'total_invoices': 0,
-            'total_amount': 0,
-            'draft_count': 0,
-            'sent_count': 0,
-            'paid_count': 0,
-            'overdue_count': 0
-        }
+        return empty_dashboard_stats()
+
+def count_overdue_sent_invoices(user_id):
+    """Sent invoices that fell due since the daily overdue pass last ran"""
+    overdue_query = db.collection('invoices') \
+        .where('userId', '==', user_id) \
+        .where('status', '==', 'sent') \
+        .where('dueAt', '<', start_of_today())
+    return overdue_query.count().get()[0][0].value
+
+def dashboard_stats_from_doc(user_id, data, overdue_sent=None):
+    """Dashboard statistics from the data of a user's stats document"""
+    counts = data.get('counts', {})
+    # Invoices flipped by the daily pass are counted in the stats document;
+    # sent invoices that fell due since then are counted by range query
+    if overdue_sent is None:
+        overdue_sent = count_overdue_sent_invoices(user_id)
+    overdue_count = counts.get('overdue', 0) + overdue_sent
+
+    return {
+        'total_invoices': data.get('total_invoices', 0),
+        'total_amount': data.get('total_amount', 0),
+        'draft_count': counts.get('draft', 0),
+        'sent_count': counts.get('sent', 0),
+        'paid_count': counts.get('paid', 0),
+        'overdue_count': overdue_count
+    }
 
-def send_invoice_email(invoice_data):
-    """Send invoice via email using Gmail SMTP"""
+def get_analytics_from_firebase(user_id, date_from, date_to, client_limit=ANALYTICS_CLIENT_LIMIT):
+    """Revenue and ageing for a date range, merged from the analytics rollups"""
     try:
-        # Get email credentials from environment variables
-        sender_email = os.getenv('SENDER_EMAIL')
-        sender_password = os.getenv('SENDER_PASSWORD')
-        
-        if not sender_email or not sender_password:
-            print("Email credentials not configured")
-            return False
-        
-        # For now, just print email details (implement real email later)
-        print(f"Would send email to {invoice_data.get('clientEmail')}")
-        print(f"Invoice: {invoice_data.get('invoiceNumber')}")
-        return True
-        
+        if not db:
+            return None
+
+        stats = dashboard_stats_ref(user_id).get()
+        amounts = (stats.to_dict() or {}).get('amounts', {}) if stats.exists else {}
+        outstanding = sum(amounts.get(status, 0) for status in ('sent', 'overdue'))
+        return analytics.report(user_id, date_from, date_to, outstanding_total=outstanding,
+                                client_limit=client_limit)
     except Exception as e:
-        print(f"Error sending email: {e}")
-        return False
+        logger.error("Error getting analytics: %s", e)
+        return None
+
+def load_outbox_message(entry):
+    """Build the email for an outbox entry with the invoice PDF attached"""
+    sender_email = os.getenv('SENDER_EMAIL')
+    if not sender_email:
+        raise ValueError("Email credentials not configured")
+
+    invoice, profile = gather(lambda: get_invoice_from_firebase(entry['invoiceId']),
+                              lambda: get_user_profile(entry.get('userId')))
+    if not invoice:
+        raise ValueError(f"Invoice {entry['invoiceId']} not found")
+    profile = profile or {}
+
+    with app.app_context():
+        html = render_template('invoice_pdf.html', invoice=invoice_template_data(invoice), profile=profile)
+    with open(render_invoice_pdf(invoice['id'], html), 'rb') as f:
+        pdf_bytes = f.read()
+
+    filename = f"{invoice.get('invoiceNumber') or invoice['id']}.pdf"
+    return build_invoice_email(sender_email, invoice, profile, (filename, pdf_bytes))
+
+def mark_invoice_delivered(entry):
+    """Flip a draft invoice to sent once its email has been delivered"""
+    update_invoice_status_firebase(entry['invoiceId'], 'sent', only_from='draft')
+
+# Invoice emails are queued and sent by background workers
+outbox = EmailOutbox(db, load_outbox_message, mark_invoice_delivered)
+
+# Fields sent to dashboards when an invoice changes
+INVOICE_EVENT_FIELDS = ('invoiceNumber', 'clientId', 'clientName', 'clientEmail', 'total', 'status',
+                        'invoiceDate', 'dueDate', 'createdAt', 'updatedAt')
+
+def publish_invoice_change(change):
+    if change.type.name == 'REMOVED':
+        event_hub.publish('invoice_removed', {'id': change.document.id})
+        return
+    invoice = change.document.to_dict()
+    summary = {field: invoice[field] for field in INVOICE_EVENT_FIELDS if field in invoice}
+    event_hub.publish('invoice', serialize_invoice({**summary, 'id': change.document.id,
+                                                    'overdue': is_overdue(invoice)}))
+
+def publish_client_change(change):
+    if change.type.name == 'REMOVED':
+        event_hub.publish('client_removed', {'id': change.document.id})
+        return
+    client = client_from_doc(change.document)
+    for key in ('createdAt', 'updatedAt'):
+        if isinstance(client.get(key), datetime):
+            client[key] = client[key].isoformat()
+    event_hub.publish('client', client)
+
+# Latest stats document per user waiting to be published, and its lock
+pending_stats = {}
+pending_stats_lock = threading.Lock()
+
+def publish_stats_change(change):
+    user_id = change.document.id
+    # The overdue count costs a query, so only run it for users with a dashboard
+    # open, and off the listener thread so it doesn't hold up other changes
+    if change.type.name == 'REMOVED' or not event_hub.has_subscribers(user_id):
+        return
+    with pending_stats_lock:
+        queued = user_id in pending_stats
+        pending_stats[user_id] = change.document.to_dict()
+    if not queued:
+        read_pool().submit(publish_pending_stats, user_id)
+
+def publish_pending_stats(user_id):
+    """Publish a user's latest stats, again if they changed meanwhile, so events stay in order"""
+    while True:
+        with pending_stats_lock:
+            data = pending_stats[user_id]
+        try:
+            event_hub.publish('stats', dashboard_stats_from_doc(user_id, data), user_id=user_id)
+        except Exception as e:
+            logger.error("Error publishing stats for %s: %s", user_id, e)
+        with pending_stats_lock:
+            if pending_stats[user_id] is data:
+                del pending_stats[user_id]
+                return
+
+def updated_since(collection):
+    return lambda since: db.collection(collection).where('updatedAt', '>=', since)
+
+# Invoice, client and dashboard stats changes are pushed to open dashboards
+# from one set of listeners per process
+event_hub = EventHub()
+change_feed = ChangeFeed([
+    ('invoices', updated_since('invoices'), publish_invoice_change),
+    ('clients', updated_since('clients'), publish_client_change),
+    ('dashboard_stats', updated_since('dashboard_stats'), publish_stats_change),
+])
+
+
+def phone_search_terms(phone):
+    """Digits of a phone number, with and without the country code"""
+    digits = re.sub(r'\D', '', str(phone or ''))
+    if not digits:
+        return []
+    return list({digits, digits[-10:]})
+
+def build_search_tokens(client):
+    """Prefix tokens for a client's name, email, company and phone.
+
+    Stored on the client document so a search is a single array_contains
+    query instead of a scan over every client.
+    """
+    words = []
+    for field in ('name', 'email', 'company'):
+        words.extend(search_terms(client.get(field)))
+    words.extend(phone_search_terms(client.get('phone')))
+    return prefix_tokens(words)
+
+def score_client_match(client, terms):
+    """Rank a client for a search, or return 0 if any term does not match"""
+    name_words = search_terms(client.get('name'))
+    other_words = search_terms(client.get('email')) + search_terms(client.get('company'))
+    phone_words = phone_search_terms(client.get('phone'))
 
+    score = 0
+    for term in terms:
+        if term in name_words:
+            score += 4
+        elif any(word.startswith(term) for word in name_words):
+            score += 3
+        elif any(word.startswith(term) for word in other_words):
+            score += 2
+        elif any(word.startswith(term) for word in phone_words):
+            score += 1
+        else:
+            return 0
+    return score
+
+def search_clients_from_firebase(query, limit=20):
+    """Search clients by prefix of name, email, company or phone, best matches first"""
+    try:
+        if not db:
+            return []
+
+        terms = search_terms(query)
+        if not terms:
+            return []
+
+        # The longest term is the most selective one to query on
+        lookup = max(terms, key=len)[:MAX_SEARCH_TOKEN_LENGTH]
+        docs = db.collection('clients') \
+            .where('searchTokens', 'array_contains', lookup) \
+            .order_by('name') \
+            .limit(CLIENT_SEARCH_CANDIDATES) \
+            .stream()
+
+        matches = []
+        for doc in docs:
+            client = client_from_doc(doc)
+            score = score_client_match(client, terms)
+            if score:
+                matches.append((score, client))
+
+        matches.sort(key=lambda match: (-match[0], str(match[1].get('name', '')).lower()))
+        return [client for score, client in matches[:limit]]
+    except Exception as e:
+        logger.error("Error searching clients: %s", e)
+        return []
+
+def invoice_search_query(token, status=None, min_total=None, max_total=None):
+    """Search entries containing a token, with the status and amount filters applied"""
+    query = db.collection(INVOICE_SEARCH_COLLECTION).where('searchTokens', 'array_contains', token)
+    if status:
+        query = query.where('status', '==', status)
+    if min_total is not None:
+        query = query.where('total', '>=', min_total)
+    if max_total is not None:
+        query = query.where('total', '<=', max_total)
+    return query
+
+def select_invoice_search_token(tokens, status=None, min_total=None, max_total=None):
+    """Pick the token matching the fewest entries, and whether its matches exceed the candidates.
+
+    Tokens are counted longest first, stopping at the first whose matches
+    all fit in INVOICE_SEARCH_CANDIDATES. A single token is not counted;
+    the candidates query tells whether it was capped.
+    """
+    if len(tokens) == 1:
+        return tokens[0], None
+    best, best_count = None, None
+    for token in sorted(tokens, key=len, reverse=True):
+        count = invoice_search_query(token, status, min_total, max_total).count().get()[0][0].value
+        if count <= INVOICE_SEARCH_CANDIDATES:
+            return token, False
+        if best_count is None or count < best_count:
+            best, best_count = token, count
+    return best, True
+
+def search_invoices_from_firebase(query, status=None, min_total=None, max_total=None,
+                                  offset=0, limit=INVOICE_SEARCH_PAGE_SIZE):
+    """Search invoices by number, client name or email and line items, best matches first.
+
+    One array_contains query on the search entries fetches up to
+    INVOICE_SEARCH_CANDIDATES candidates for the most selective term, with
+    the status and amount filters applied by the query, newest first; the
+    candidates are ranked here. Returns (page of entries, number of
+    matches, whether the candidates were capped). When capped, the number
+    of matches only counts the candidates, so it is a lower bound.
+    """
+    terms = search_terms(query)
+    # Shorter terms are not indexed, so only the others can be looked up
+    tokens = list(dict.fromkeys(term[:MAX_SEARCH_TOKEN_LENGTH] for term in terms
+                                if len(term) >= MIN_INVOICE_TOKEN_LENGTH))
+    if not tokens:
+        return [], 0, False
+
+    lookup, capped = select_invoice_search_token(tokens, status, min_total, max_total)
+    candidates = invoice_search_query(lookup, status, min_total, max_total)
+    if min_total is not None or max_total is not None:
+        # A range filter must be the first sort order
+        candidates = candidates.order_by('total')
+    else:
+        candidates = candidates.order_by('createdAt', direction='DESCENDING')
+    # One more than kept, to tell whether there were more
+    docs = list(candidates.limit(INVOICE_SEARCH_CANDIDATES + 1).stream())
+    if capped is None:
+        capped = len(docs) > INVOICE_SEARCH_CANDIDATES
+    docs = docs[:INVOICE_SEARCH_CANDIDATES]
+
+    matches = []
+    for doc in docs:
+        entry = doc.to_dict()
+        score = score_invoice_match(entry, terms)
+        if score:
+            entry.pop('searchTokens', None)
+            entry['id'] = doc.id
+            entry['score'] = score
+            matches.append(entry)
+    # Stable, so equal scores keep the query's order
+    matches.sort(key=lambda entry: -entry['score'])
+    return matches[offset:offset + limit], len(matches), capped
+
+def reindex_clients():
+    """Write searchTokens on every client, for clients saved before search existed"""
+    if not db:
+        return 0
+
+    batch = db.batch()
+    pending = 0
+    updated = 0
+    for doc in db.collection('clients').select(list(CLIENT_SEARCH_FIELDS)).stream():
+        batch.update(doc.reference, {'searchTokens': build_search_tokens(doc.to_dict())})
+        pending += 1
+        updated += 1
+        if pending == 500:
+            batch.commit()
+            batch = db.batch()
+            pending = 0
+    if pending:
+        batch.commit()
+    if updated:
+        commit_collection_versions('clients')
+    return updated
+
+def rebuild_invoice_search():
+    """Rewrite the search entry of every invoice, archived ones included, and drop entries of deleted invoices.
+
+    For invoices written before search existed, or after changing how
+    entries are built; safe to run while the app is serving.
+    """
+    if not db:
+        return 0, 0
+
+    fields = list(dict.fromkeys(('items',) + INVOICE_SEARCH_FIELDS))
+    batch = db.batch()
+    pending = 0
+    indexed = 0
+    invoice_ids = set()
+    live = ({**doc.to_dict(), 'id': doc.id} for doc in db.collection('invoices').select(fields).stream())
+    invoices = itertools.chain(live, iter_archived_invoices())
+    for invoice in invoices:
+        batch.set(invoice_search_ref(invoice['id']), build_invoice_search_entry(invoice))
+        invoice_ids.add(invoice['id'])
+        pending += 1
+        indexed += 1
+        if pending == BATCH_WRITE_LIMIT:
+            batch.commit()
+            batch = db.batch()
+            pending = 0
+
+    removed = 0
+    for doc in db.collection(INVOICE_SEARCH_COLLECTION).select([]).stream():
+        if doc.id in invoice_ids:
+            continue
+        batch.delete(doc.reference)
+        pending += 1
+        removed += 1
+        if pending == BATCH_WRITE_LIMIT:
+            batch.commit()
+            batch = db.batch()
+            pending = 0
+    if pending:
+        batch.commit()
+    # Search listings are versioned with the invoices they index
+    commit_collection_versions('invoices')
+    return indexed, removed
+
+def client_from_doc(doc):
+    """Client dict for the API and templates, with its invoice stats"""
+    client = doc.to_dict()
+    client.pop('searchTokens', None)
+    client['id'] = doc.id
+    client['stats'] = client_stats_view(client.get('stats'))
+    return client
 
 def save_client_to_firebase(client_data):
     """Save client to Firestore"""
     try:
-        if db is None:
+        if not db:
             return None
-            
+
+        # Stats are maintained from invoice writes
+        client_data.pop('stats', None)
+        # Lowercased like imported clients, so invoices find their client by email
+        if client_data.get('email'):
+            client_data['email'] = client_data['email'].strip().lower()
         client_ref = db.collection('clients').document()
-        client_data['createdAt'] = datetime.now()
-        client_ref.set(client_data)
+        client_data['createdAt'] = client_data['updatedAt'] = datetime.now()
+        batch = db.batch()
+        batch.set(client_ref, {**client_data, 'searchTokens': build_search_tokens(client_data)})
+        bump_collection_version(batch, 'clients')
+        batch.commit()
         return client_ref.id
     except Exception as e:
-        print(f"Error saving client: {e}")
+        logger.error("Error saving client: %s", e)
         return None
 
 def get_clients_from_firebase():
     """Get all clients from Firestore"""
     try:
-        if db is None:
+        if not db:
             return []
         
         clients_ref = db.collection('clients').order_by('createdAt', direction='DESCENDING')
         docs = clients_ref.stream()
-        clients = []
-        for doc in docs:
-            client = doc.to_dict()
-            client['id'] = doc.id
-            clients.append(client)
-        return clients
+        return [client_from_doc(doc) for doc in docs]
     except Exception as e:
-        print(f"Error getting clients: {e}")
+        logger.error("Error getting clients: %s", e)
         return []
 
+@cached(cache, 'client')
 def get_client_from_firebase(client_id):
     """Get single client from Firestore"""
     try:
-        if db is None:
+        if not db:
             return None
             
         doc = db.collection('clients').document(client_id).get()
         if doc.exists:
-            client = doc.to_dict()
-            client['id'] = doc.id
-            return client
+            return client_from_doc(doc)
         return None
     except Exception as e:
-        print(f"Error getting client: {e}")
+        logger.error("Error getting client: %s", e)
         return None
 
 def update_client_in_firebase(client_id, client_data):
     """Update client in Firestore"""
     try:
-        if db is None:
+        if not db:
             return False
             
-        # Remove createdAt if present to avoid overwriting
-        if 'createdAt' in client_data:
-            del client_data['createdAt']
+        # Remove createdAt and maintained stats if present to avoid overwriting
+        client_data.pop('createdAt', None)
+        client_data.pop('stats', None)
+        if client_data.get('email'):
+            client_data['email'] = client_data['email'].strip().lower()
             
         client_data['updatedAt'] = datetime.now()
-        db.collection('clients').document(client_id).update(client_data)
+        update = dict(client_data)
+        if any(field in client_data for field in CLIENT_SEARCH_FIELDS):
+            current = get_client_from_firebase(client_id) or {}
+            update['searchTokens'] = build_search_tokens({**current, **client_data})
+
+        batch = db.batch()
+        batch.update(db.collection('clients').document(client_id), update)
+        bump_collection_version(batch, 'clients')
+        batch.commit()
+        cache.delete(cache_key('client', client_id))
         return True
     except Exception as e:
-        print(f"Error updating client: {e}")
+        logger.error("Error updating client: %s", e)
         return False
 
 def delete_client_from_firebase(client_id):
-    """Delete client from Firestore"""
+    """Delete client from Firestore, unlinking its invoices"""
     try:
-        if db is None:
+        if not db:
             return False
-            
-        db.collection('clients').document(client_id).delete()
+
+        # Unlink first, so later invoice writes don't recreate the client's stats
+        invoices = itertools.chain.from_iterable(
+            db.collection(collection).where('clientId', '==', client_id).select([]).stream()
+            for collection in ('invoices', ARCHIVE_INDEX_COLLECTION))
+        for chunk in chunked([doc.reference for doc in invoices], BATCH_WRITE_LIMIT - 1):
+            batch = db.batch()
+            for invoice_ref in chunk:
+                batch.update(invoice_ref, {'clientId': firestore.DELETE_FIELD, 'updatedAt': datetime.now()})
+            bump_collection_version(batch, 'invoices')
+            batch.commit()
+            cache.delete(*[cache_key('invoice', invoice_ref.id) for invoice_ref in chunk])
+
+        batch = db.batch()
+        batch.delete(db.collection('clients').document(client_id))
+        bump_collection_version(batch, 'clients')
+        batch.commit()
+        cache.delete(cache_key('client', client_id))
         return True
     except Exception as e:
-        print(f"Error deleting client: {e}")
+        logger.error("Error deleting client: %s", e)
+        return False
+
+def get_client_ids_by_email():
+    """Map lowercased client emails to client ids, reading only the email field"""
+    client_ids = {}
+    for doc in db.collection('clients').select(['email']).stream():
+        email = (doc.to_dict().get('email') or '').strip().lower()
+        if email:
+            client_ids.setdefault(email, doc.id)
+    return client_ids
+
+def import_records_to_firebase(stream, kind, fmt='csv', user_id=None):
+    """Import clients or invoices from a CSV/JSON Lines stream, one row at a time.
+
+    Clients are deduplicated by email against existing clients and earlier
+    rows; invoice rows create a client for unseen emails and link it by
+    clientId. Writes go out in batched commits along with the owner's stats
+    deltas; invoices without a number are numbered as their batch is
+    flushed, reserving exactly as many as it writes. Returns an
+    ImportReport with per-line errors.
+    """
+    report = ImportReport()
+    client_ids = get_client_ids_by_email()
+    committer = BatchCommitter(report)
+    clients = db.collection('clients')
+    invoices = db.collection('invoices')
+
+    batch = db.batch()
+    writes = 0
+    lines = []
+    imported = 0
+    clients_created = 0
+    stats_changes = []
+    # Stats, client and rollup documents the pending batch will update
+    aggregate_ids = set()
+    # Invoices of the pending batch without a number, written once numbered
+    unnumbered = []
+    # Clients the pending batch creates and links invoices to, and the
+    # batch each earlier created client was committed in
+    new_clients, linked_clients = set(), set()
+    created_in = {}
+
+    def flush():
+        nonlocal batch, writes, lines, imported, clients_created, stats_changes, aggregate_ids, unnumbered
+        nonlocal new_clients, linked_clients
+        if unnumbered:
+            # One block per sequence, sized to this batch's invoices, so numbers run on across batches
+            number_allocator.reserve([(invoice_data, user_id) for _, invoice_data in unnumbered])
+            for invoice_ref, invoice_data in unnumbered:
+                batch.set(invoice_ref, invoice_data)
+                write_invoice_search_entry(batch, invoice_ref.id, invoice_data)
+        changed_clients = write_invoice_changes(batch, user_id, stats_changes) if stats_changes else set()
+        if imported and kind == 'invoices':
+            bump_invoice_versions(batch, changed_clients)
+        if clients_created:
+            bump_collection_version(batch, 'clients')
+        # Batches commit in parallel, so one that updates the stats of a client
+        # created in an earlier batch waits for it, rather than have that
+        # batch's create overwrite the stats
+        handle = committer.submit(batch, lines, imported, clients_created,
+                                  on_commit=lambda: invalidate_clients(changed_clients),
+                                  after={created_in[client_id] for client_id in linked_clients
+                                         if client_id in created_in})
+        created_in.update(dict.fromkeys(new_clients, handle))
+        batch = db.batch()
+        writes, lines, imported, clients_created, stats_changes, aggregate_ids = 0, [], 0, 0, [], set()
+        unnumbered = []
+        new_clients, linked_clients = set(), set()
+
+    def create_client(client_data):
+        nonlocal writes, clients_created
+        client_ref = clients.document()
+        client_data['createdAt'] = client_data['updatedAt'] = datetime.now()
+        batch.set(client_ref, {**client_data, 'searchTokens': build_search_tokens(client_data)})
+        writes += 1
+        clients_created += 1
+        new_clients.add(client_ref.id)
+        if client_data.get('email'):
+            client_ids[client_data['email']] = client_ref.id
+        return client_ref.id
+
+    try:
+        for line, row in iter_rows(stream, fmt):
+            report.rows += 1
+            try:
+                if isinstance(row, ImportRowError):
+                    raise row
+                if kind == 'clients':
+                    client_data = parse_client_row(row)
+                    if client_data['email'] in client_ids:
+                        report.skipped += 1
+                        continue
+                    create_client(client_data)
+                else:
+                    invoice_data = parse_invoice_row(row, INVOICE_STATUSES)
+            except ImportRowError as e:
+                report.add_error(line, e)
+                continue
+
+            if kind == 'invoices':
+                email = invoice_data.get('clientEmail')
+                if email:
+                    invoice_data['clientId'] = client_ids.get(email) or create_client({
+                        'name': invoice_data['clientName'],
+                        'email': email,
+                        'phone': invoice_data.get('clientPhone', ''),
+                        'address': invoice_data.get('clientAddress', ''),
+                        'company': ''
+                    })
+                # Historical invoices keep their own date for ordering
+                invoice_data['createdAt'] = parse_due_date(invoice_data.get('invoiceDate')) or datetime.now()
+                invoice_data['updatedAt'] = datetime.now()
+                due_at = parse_due_date(invoice_data.get('dueDate'))
+                if due_at:
+                    invoice_data['dueAt'] = due_at
+                if user_id:
+                    invoice_data['userId'] = user_id
+                invoice_ref = invoices.document()
+                if invoice_data.get('invoiceNumber'):
+                    batch.set(invoice_ref, invoice_data)
+                    write_invoice_search_entry(batch, invoice_ref.id, invoice_data)
+                else:
+                    unnumbered.append((invoice_ref, invoice_data))
+                writes += 2
+                imported += 1
+                stats_changes.append((None, invoice_data))
+                if invoice_data.get('clientId'):
+                    aggregate_ids.add(invoice_data['clientId'])
+                    linked_clients.add(invoice_data['clientId'])
+                if user_id:
+                    aggregate_ids.update(accumulate_rollups(user_id, [(None, invoice_data)]))
+            else:
+                imported += 1
+
+            lines.append(line)
+            # Leave room for a new client, its invoice and search entry, the stats document and its
+            # aggregates, and the version counters
+            if writes + len(aggregate_ids) >= BATCH_WRITE_LIMIT - 7 - ROLLUP_WRITES_PER_INVOICE:
+                flush()
+
+        if lines:
+            flush()
+    finally:
+        committer.close()
+    return report
+
+
+def serialize_recurring_template(template, template_id):
+    """JSON serializable copy of a recurring invoice template"""
+    serialized = {**template, 'id': template_id}
+    for key in ('createdAt', 'updatedAt'):
+        if isinstance(serialized.get(key), datetime):
+            serialized[key] = serialized[key].isoformat()
+    return serialized
+
+def load_recurring_template(template_id, user_id):
+    """Stored fields of a user's recurring invoice template, or None"""
+    doc = db.collection(RECURRING_COLLECTION).document(template_id).get()
+    template = doc.to_dict() if doc.exists else None
+    if not template or template.get('userId') != user_id:
+        return None
+    return template
+
+def get_recurring_template(template_id, user_id):
+    template = load_recurring_template(template_id, user_id)
+    return serialize_recurring_template(template, template_id) if template else None
+
+def get_recurring_templates(user_id):
+    """A user's recurring invoice templates, newest first"""
+    docs = db.collection(RECURRING_COLLECTION).where('userId', '==', user_id).stream()
+    templates = sorted(((doc.to_dict(), doc.id) for doc in docs),
+                       key=lambda pair: pair[0].get('createdAt') or datetime.min, reverse=True)
+    return [serialize_recurring_template(template, template_id) for template, template_id in templates]
+
+def schedule_next_run(template, after=None):
+    """Set a template's nextRunDate and status for runs after `after`"""
+    end = parse_run_date(template['endDate']) if template.get('endDate') else None
+    next_run = next_run_date(template['frequency'], parse_run_date(template['startDate']), after, end)
+    template['nextRunDate'] = next_run.isoformat() if next_run else None
+    template['status'] = 'active' if next_run else 'ended'
+
+def save_recurring_template(user_id, data):
+    """Create a recurring invoice template; raises ValueError for invalid input.
+
+    With skipStart the first run is the one after startDate, for when the
+    invoice for startDate was created by hand.
+    """
+    template = parse_template(data)
+    compute_totals(template['items'], template.get('taxRate'), template.get('tax'))
+    schedule_next_run(template, parse_run_date(template['startDate']) if data.get('skipStart') else None)
+    template['userId'] = user_id
+    template['createdAt'] = template['updatedAt'] = datetime.now()
+    template_ref = db.collection(RECURRING_COLLECTION).document()
+    template_ref.set(template)
+    return template_ref.id
+
+def update_recurring_template(template_id, user_id, data):
+    """Update a template, or pause or resume it with status; returns False when not found.
+
+    A resumed template, or one whose schedule changed, continues from its
+    next run date from today on, so periods it missed are not generated.
+    """
+    existing = load_recurring_template(template_id, user_id)
+    if not existing:
         return False
+    template = parse_template(data, existing)
+    compute_totals(template['items'], template.get('taxRate'), template.get('tax'))
+    status = data.get('status', existing.get('status', 'active'))
+    if status not in ('active', 'paused'):
+        raise ValueError("status must be active or paused")
+    if status == 'paused':
+        template['status'] = 'paused'
+        template['nextRunDate'] = None
+    elif existing.get('status') != 'active' or schedule_changed(template, existing):
+        after = date.today() - timedelta(days=1)
+        if template.get('lastRunDate'):
+            after = max(after, parse_run_date(template['lastRunDate']))
+        schedule_next_run(template, after)
+    template['updatedAt'] = datetime.now()
+    db.collection(RECURRING_COLLECTION).document(template_id).set(template)
+    return True
+
+def delete_recurring_template(template_id, user_id):
+    """Delete a template; invoices it already generated are kept"""
+    if not load_recurring_template(template_id, user_id):
+        return False
+    db.collection(RECURRING_COLLECTION).document(template_id).delete()
+    return True
+
+def generate_recurring_invoices(run_date=None, dry_run=False, send=True):
+    """Create the invoices of every recurring template due on or before run_date, a chunk per transaction.
+
+    Each period's invoice has a fixed id, and a template's nextRunDate moves
+    on in the same commit as its invoices, so running again the same day,
+    or after a failed commit, never creates a period twice. Invoices of
+    templates with autoSend are queued for email in that commit as well
+    when sending is configured. Each transaction re-reads its templates, so
+    one paused or rescheduled during the run is left as it was changed,
+    and reserves exactly the invoice numbers it writes. Returns a
+    RecurringReport.
+    """
+    run_date = run_date or date.today()
+    report = RecurringReport(run_date, dry_run)
+    templates = db.collection(RECURRING_COLLECTION)
+    invoices = db.collection('invoices')
+    clients = db.collection('clients')
+    queue_emails = send and bool(os.getenv('SENDER_EMAIL'))
+    tax_rates = {}
+
+    due = []
+    for doc in templates.where('nextRunDate', '<=', run_date.isoformat()).stream():
+        template = {**doc.to_dict(), 'id': doc.id}
+        try:
+            run_dates = due_run_dates(template, run_date)
+        except (KeyError, ValueError) as e:
+            report.add_error(doc.id, f"Invalid schedule: {e}")
+            continue
+        if run_dates:
+            due.append((template, run_dates))
+    report.templates = len(due)
+
+    def default_tax_rate(user_id):
+        if user_id not in tax_rates:
+            tax_rates[user_id] = (get_user_profile(user_id) or {}).get('defaultTaxRate') if user_id else None
+        return tax_rates[user_id]
+
+    def plan(chunk, existing, current_clients, now):
+        """Invoices to create and the next run of each template in a chunk.
+
+        Returns ([(template, last run date, invoices)], errors, periods
+        already generated), with invoices as [(invoice_id, invoice, send_email)].
+        """
+        plans, errors, skipped = [], [], 0
+        for template, run_dates in chunk:
+            user_id = template.get('userId')
+            tax_rate, tax = template.get('taxRate'), template.get('tax')
+            if tax_rate in (None, '') and tax in (None, ''):
+                tax_rate = default_tax_rate(user_id)
+            try:
+                totals = compute_totals(template.get('items') or [], tax_rate, tax)
+            except ValueError as e:
+                errors.append((template['id'], e))
+                continue
+
+            new_invoices = []
+            for day in run_dates:
+                invoice_id = recurring_invoice_id(template['id'], day)
+                if invoice_id in existing:
+                    skipped += 1
+                    continue
+                invoice = build_recurring_invoice(template, day, totals, current_clients.get(template.get('clientId')))
+                invoice['createdAt'] = invoice['updatedAt'] = now
+                invoice['dueAt'] = parse_due_date(invoice['dueDate'])
+                if user_id:
+                    invoice['userId'] = user_id
+                send_email = bool(template.get('autoSend') and queue_emails and invoice.get('clientEmail'))
+                new_invoices.append((invoice_id, invoice, send_email))
+            plans.append((template, run_dates[-1], new_invoices))
+        return plans, errors, skipped
+
+    @transactional
+    def generate_in_transaction(transaction, chunk, current_clients):
+        # Reads first: the templates as they are now, and the periods already generated
+        fresh = []
+        for snapshot in db.get_all([templates.document(template['id']) for template, _ in chunk],
+                                   transaction=transaction):
+            template = {**snapshot.to_dict(), 'id': snapshot.id} if snapshot.exists else {}
+            try:
+                run_dates = due_run_dates(template, run_date) if template else []
+            except (KeyError, ValueError):
+                run_dates = []
+            if run_dates:
+                fresh.append((template, run_dates))
+        invoice_refs = [invoices.document(recurring_invoice_id(template['id'], day))
+                        for template, run_dates in fresh for day in run_dates]
+        existing = {snapshot.id for snapshot in (db.get_all(invoice_refs, transaction=transaction)
+                                                 if invoice_refs else []) if snapshot.exists}
+        plans, errors, skipped = plan(fresh, existing, current_clients, datetime.now())
+        created = [(invoice, template.get('userId')) for template, _, new_invoices in plans
+                   for _, invoice, _ in new_invoices]
+        if created:
+            number_allocator.number_in_transaction(transaction, created)
+
+        changes = {}
+        generated = queued = 0
+        for template, last_run, new_invoices in plans:
+            user_id = template.get('userId')
+            for invoice_id, invoice, send_email in new_invoices:
+                transaction.create(invoices.document(invoice_id), invoice)
+                write_invoice_search_entry(transaction, invoice_id, invoice)
+                if send_email:
+                    outbox.enqueue_in(transaction, invoice_id, user_id, invoice['clientEmail'])
+                changes.setdefault(user_id, []).append((None, invoice))
+                generated += 1
+                queued += send_email
+            schedule = {key: template.get(key) for key in ('frequency', 'startDate', 'endDate')}
+            schedule_next_run(schedule, last_run)
+            transaction.update(templates.document(template['id']), {
+                'nextRunDate': schedule['nextRunDate'],
+                'status': schedule['status'],
+                'lastRunDate': last_run.isoformat(),
+                'updatedAt': datetime.now()
+            })
+        changed_clients = set()
+        for user_id, user_changes in changes.items():
+            changed_clients |= write_invoice_changes(transaction, user_id, user_changes)
+        if generated:
+            bump_invoice_versions(transaction, changed_clients)
+        return generated, queued, skipped, errors, changed_clients
+
+    def generate(chunk):
+        # The clients' current details, read once outside the transaction
+        client_refs = [clients.document(template['clientId']) for template, _ in chunk if template.get('clientId')]
+        current_clients = {snapshot.id: {**snapshot.to_dict(), 'id': snapshot.id}
+                           for snapshot in (db.get_all(client_refs) if client_refs else []) if snapshot.exists}
+        if dry_run:
+            invoice_refs = [invoices.document(recurring_invoice_id(template['id'], day))
+                            for template, run_dates in chunk for day in run_dates]
+            existing = {snapshot.id for snapshot in db.get_all(invoice_refs) if snapshot.exists}
+            plans, errors, skipped = plan(chunk, existing, current_clients, datetime.now())
+            generated = sum(len(new_invoices) for _, _, new_invoices in plans)
+            queued = sum(send_email for _, _, new_invoices in plans for _, _, send_email in new_invoices)
+        else:
+            try:
+                generated, queued, skipped, errors, changed_clients = generate_in_transaction(
+                    db.transaction(), chunk, current_clients)
+            except Exception as e:
+                for template, _ in chunk:
+                    report.add_error(template['id'], f"Write failed: {e}")
+                return
+            invalidate_clients(changed_clients)
+        for template_id, error in errors:
+            report.add_error(template_id, error)
+        report.skipped += skipped
+        report.add_committed(generated, queued)
+
+    chunk, writes = [], 0
+    for template, run_dates in due:
+        # Plus a number counter per fiscal year the periods fall in
+        template_writes = (2 + len(run_dates) * RECURRING_WRITES_PER_INVOICE
+                           + len({fiscal_year(day) for day in run_dates}))
+        # Leaving two writes for the version counters
+        if chunk and writes + template_writes > BATCH_WRITE_LIMIT - 2:
+            generate(chunk)
+            chunk, writes = [], 0
+        chunk.append((template, run_dates))
+        writes += template_writes
+    if chunk:
+        generate(chunk)
+    if report.queued and not dry_run:
+        outbox.wake()
+    return report
 
 
 def save_user_profile(user_id, profile_data):
     """Save user profile to Firestore"""
     try:
-        if db is None:
+        if not db:
             return False
             
         profile_data['updatedAt'] = datetime.now()
-        db.collection('user_profiles').document(user_id).set(profile_data)
+        batch = db.batch()
+        batch.set(db.collection('user_profiles').document(user_id), profile_data)
+        bump_collection_version(batch, 'user_profiles')
+        batch.commit()
+        cache.delete(cache_key('profile', user_id))
         return True
     except Exception as e:
-        print(f"Error saving user profile: {e}")
+        logger.error("Error saving user profile: %s", e)
         return False
 
+@cached(cache, 'profile')
 def get_user_profile(user_id):
     """Get user profile from Firestore"""
     try:
-        if db is None:
+        if not db:
             return None
             
         doc = db.collection('user_profiles').document(user_id).get()
@@ -277,8 +2097,8 @@ def get_user_profile(user_id):
             return doc.to_dict()
         return {}
     except Exception as e:
-        print(f"Error getting user profile: {e}")
-        return {}
+        logger.error("Error getting user profile: %s", e)
+        return None
 
 def get_current_user_id():
     """Get current user ID from session"""
@@ -287,6 +2107,48 @@ def get_current_user_id():
     return session.get('user', 'default_user')
 
 
+@app.before_request
+def start_background_workers():
+    """Start the email outbox workers with the first request"""
+    # Probes must answer without waiting on the datastore
+    if request.endpoint in HEALTH_ENDPOINTS:
+        return
+    if db:
+        outbox.start()
+
+# Count Firestore reads and writes per route; the local stores count their own
+metrics.instrument_firestore()
+
+@app.before_request
+def start_request_metrics():
+    route = request.url_rule.rule if request.url_rule else 'unmatched'
+    g.request_metrics = metrics.start_request(request.method, route)
+
+@app.after_request
+def finish_request_metrics(response):
+    """Record the request once the response is closed, so streamed bodies are timed too"""
+    request_metrics = g.pop('request_metrics', None)
+    if request_metrics is not None:
+        response.call_on_close(lambda: metrics.finish_request(request_metrics, response.status_code))
+    return response
+
+@app.after_request
+def compress(response):
+    return compress_response(response)
+
+@app.teardown_request
+def end_request_metrics(exc):
+    metrics.end_request_context()
+
+@before_render_template.connect_via(app)
+def start_template_timer(sender, template, context, **extra):
+    metrics.start_template(template.name)
+
+@template_rendered.connect_via(app)
+def finish_template_timer(sender, template, context, **extra):
+    metrics.finish_template(template.name)
+
+
 # Routes
 @app.route('/login', methods=['GET', 'POST'])
 def login():
@@ -310,22 +2172,37 @@ def logout():
 @app.route('/')
 @login_required
 def index():
+    page_args = get_invoice_page_args()
+    user_id = get_current_user_id()
+    search = request.args.get('search', '').strip()
+
+    def search_page():
+        offset = parse_search_cursor(request.args.get('cursor'))
+        results, total, capped = search_invoices_from_firebase(search, page_args['status'], offset=offset,
+                                                               limit=page_args['limit'])
+        return results, str(offset + page_args['limit']) if offset + page_args['limit'] < total else None, capped
+
+    def invoices_page():
+        return (*get_invoices_page_from_firebase(**page_args), False)
+
     try:
-        invoices = get_invoices_from_firebase()
-        stats = get_dashboard_stats(invoices)
+        # Stats gather their own reads, so they run on this thread
+        stats, (invoices, next_cursor, search_capped) = gather(
+            lambda: get_dashboard_stats(user_id),
+            search_page if search else invoices_page)
+        # The next page keeps every filter of this one and only moves the cursor
+        next_args = {key: request.args[key] for key in INVOICE_LIST_ARGS if request.args.get(key)}
+        next_url = url_for('index', **next_args, cursor=next_cursor) if next_cursor else None
         # Pass the is_overdue function to template context
-        return render_template('index.html', invoices=invoices, stats=stats, is_overdue=is_overdue)
+        return render_template('index.html', invoices=invoices, stats=stats, is_overdue=is_overdue,
+                               next_cursor=next_cursor, next_url=next_url, status_filter=page_args['status'],
+                               search=search, search_capped=search_capped,
+                               search_candidates=INVOICE_SEARCH_CANDIDATES)
     except Exception as e:
-        print(f"Error in index route: {e}")
+        logger.error("Error in index route: %s", e)
         # Fallback to prevent crashes
-        return render_template('index.html', invoices=[], stats={
-            'total_invoices': 0,
-            'total_amount': 0,
-            'draft_count': 0,
-            'sent_count': 0,
-            'paid_count': 0,
-            'overdue_count': 0
-        }, is_overdue=is_overdue)
+        return render_template('index.html', invoices=[], stats=empty_dashboard_stats(), is_overdue=is_overdue,
+                               next_cursor=None, status_filter=page_args['status'], search=search)
 
 @app.route('/create-invoice')
 @login_required
@@ -336,73 +2213,301 @@ def create_invoice():
 def create_invoice_api():
     try:
         data = request.get_json()
-        print("Received invoice data:", data)  # Debug print
-        
+        logger.debug("Received invoice data: %s", data)
+        user_id = get_current_user_id()
+
+        # Totals are computed here rather than trusted from the form
+        tax_rate = data.get('taxRate')
+        if tax_rate in (None, '') and data.get('tax') in (None, ''):
+            tax_rate = (get_user_profile(user_id) or {}).get('defaultTaxRate')
+        try:
+            totals = compute_totals(data.get('items') or [], tax_rate, data.get('tax'))
+        except ValueError as e:
+            return jsonify({'success': False, 'error': str(e)}), 400
+
         # Add metadata
         invoice_data = {
-            'invoiceNumber': f"INV-{int(datetime.now().timestamp()) % 10000:04d}",
             'status': 'draft',
-            **data
+            **data,
+            **totals
         }
         
-        print("Saving invoice data:", invoice_data)  # Debug print
-        
         # Save to Firebase
-        invoice_id = save_invoice_to_firebase(invoice_data)
-        print("Invoice saved with ID:", invoice_id)  # Debug print
+        invoice_id = save_invoice_to_firebase(invoice_data, user_id)
+        logger.debug("Invoice saved with ID: %s", invoice_id)
         
         if invoice_id:
             invoice_data['id'] = invoice_id
-            # Make it JSON serializable for the response
-            serialized_invoice = invoice_data.copy()
-            if isinstance(serialized_invoice.get('createdAt'), datetime):
-                serialized_invoice['createdAt'] = serialized_invoice['createdAt'].isoformat()
-            return jsonify({'success': True, 'invoice': serialized_invoice}), 201
+            return jsonify({'success': True, 'invoice': serialize_invoice(invoice_data)}), 201
         else:
             return jsonify({'success': False, 'error': 'Failed to save invoice'}), 500
     except Exception as e:
-        print(f"Error creating invoice: {e}")
+        logger.error("Error creating invoice: %s", e)
         return jsonify({'success': False, 'error': str(e)}), 500
 
 @app.route('/api/invoices')
 @login_required
 def get_invoices_api():
-    invoices = get_invoices_from_firebase()
-    # Make invoices JSON serializable
-    serialized_invoices = []
-    for invoice in invoices:
-        serialized = invoice.copy()
-        if isinstance(serialized.get('createdAt'), datetime):
-            serialized['createdAt'] = serialized['createdAt'].isoformat()
-        serialized_invoices.append(serialized)
-    return jsonify({'invoices': serialized_invoices})
+    page_args = get_invoice_page_args()
+
+    def build():
+        invoices, next_cursor = get_invoices_page_from_firebase(**page_args)
+        return {
+            'invoices': [serialize_invoice(invoice) for invoice in invoices],
+            'next_cursor': next_cursor
+        }
+    return conditional_json(list_etag('invoices', sorted(page_args.items())), build)
+
+def parse_search_cursor(cursor):
+    """Offset into ranked search results from a next_cursor"""
+    try:
+        return max(0, int(cursor or 0))
+    except ValueError:
+        return 0
+
+@app.route('/api/invoices/search')
+@login_required
+def search_invoices_api():
+    """Ranked invoice search over number, client and line items.
+
+    ?q= with optional status, min_total and max_total filters; pages with
+    limit and the returned next_cursor. When the candidates were capped,
+    total is null and only the newest candidates were ranked.
+    """
+    query = request.args.get('q', '').strip()
+    status = request.args.get('status') or None
+    if status and status not in INVOICE_STATUSES:
+        return jsonify({'error': f"status must be one of {', '.join(INVOICE_STATUSES)}"}), 400
+    try:
+        min_total = float(request.args['min_total']) if request.args.get('min_total') else None
+        max_total = float(request.args['max_total']) if request.args.get('max_total') else None
+    except ValueError:
+        return jsonify({'error': 'min_total and max_total must be numbers'}), 400
+    try:
+        limit = max(1, min(int(request.args.get('limit', INVOICE_SEARCH_PAGE_SIZE)), MAX_INVOICE_PAGE_SIZE))
+    except ValueError:
+        limit = INVOICE_SEARCH_PAGE_SIZE
+    offset = parse_search_cursor(request.args.get('cursor'))
+    if not query:
+        return jsonify({'invoices': [], 'total': 0, 'next_cursor': None})
+    if not db:
+        return jsonify({'error': 'Database unavailable'}), 503
+
+    def build():
+        results, total, capped = search_invoices_from_firebase(query, status, min_total, max_total, offset, limit)
+        return {
+            'invoices': [serialize_invoice(entry) for entry in results],
+            'total': None if capped else total,
+            'capped': capped,
+            'candidates': INVOICE_SEARCH_CANDIDATES,
+            'next_cursor': str(offset + limit) if offset + limit < total else None
+        }
+    try:
+        return conditional_json(list_etag('invoices', 'search', query, status, min_total, max_total, offset, limit),
+                                build)
+    except Exception as e:
+        logger.error("Error searching invoices: %s", e)
+        return jsonify({'error': 'Search failed'}), 500
+
+@app.route('/api/invoices/batch', methods=['POST'])
+@login_required
+def batch_invoices_api():
+    """Set status on, send or delete many invoices in one request"""
+    data = request.get_json() or {}
+    # Drop duplicate ids while keeping their order
+    invoice_ids = list(dict.fromkeys(str(invoice_id) for invoice_id in data.get('ids') or []))
+    action = data.get('action')
+    status = data.get('status')
+
+    if not invoice_ids:
+        return jsonify({'success': False, 'error': 'No invoice ids given'}), 400
+    if len(invoice_ids) > MAX_BATCH_INVOICE_IDS:
+        return jsonify({'success': False, 'error': f'At most {MAX_BATCH_INVOICE_IDS} invoices per batch'}), 400
+    if action not in ('set_status', 'send', 'delete'):
+        return jsonify({'success': False, 'error': 'Unknown action'}), 400
+    if action == 'set_status' and status not in INVOICE_STATUSES:
+        return jsonify({'success': False, 'error': 'Invalid status'}), 400
+    if action == 'send' and (not db or not os.getenv('SENDER_EMAIL')):
+        return jsonify({'success': False, 'error': 'Email is not configured'}), 500
+
+    results = batch_update_invoices_firebase(invoice_ids, action, status, get_current_user_id())
+    failed = sum(1 for result in results.values() if not result['success'])
+    return jsonify({'success': failed == 0, 'failed': failed, 'results': results})
 
 @app.route('/api/invoices/<invoice_id>')
 @login_required
 def get_invoice_api(invoice_id):
     invoice = get_invoice_from_firebase(invoice_id)
     if invoice:
-        # Make it JSON serializable
-        serialized_invoice = invoice.copy()
-        if isinstance(serialized_invoice.get('createdAt'), datetime):
-            serialized_invoice['createdAt'] = serialized_invoice['createdAt'].isoformat()
-        return jsonify(serialized_invoice)
+        return jsonify(serialize_invoice(invoice))
     return jsonify({'error': 'Invoice not found'}), 404
 
+@app.route('/api/invoices/overdue')
+@login_required
+def get_overdue_invoices_api():
+    """Get invoices past their due date"""
+    try:
+        limit = int(request.args.get('limit', INVOICE_PAGE_SIZE))
+    except ValueError:
+        limit = INVOICE_PAGE_SIZE
+    limit = max(1, min(limit, MAX_INVOICE_PAGE_SIZE))
+    cursor = request.args.get('cursor')
+
+    invoices, next_cursor = get_overdue_invoices_from_firebase(
+        limit, decode_invoice_cursor(cursor, field='dueAt') if cursor else None)
+    return jsonify({
+        'invoices': [serialize_invoice(invoice) for invoice in invoices],
+        'next_cursor': next_cursor
+    })
+
+@app.route('/api/analytics')
+@login_required
+def get_analytics_api():
+    """Revenue by month, status and client for ?from=..&to=.., plus ageing buckets"""
+    today = datetime.now().date()
+    date_to = parse_due_date(request.args.get('to'))
+    date_to = date_to.date() if date_to else today
+    date_from = parse_due_date(request.args.get('from'))
+    # Default to the last twelve months, starting on the first of the month
+    date_from = date_from.date() if date_from else (date_to.replace(day=1) - timedelta(days=334)).replace(day=1)
+    if date_from > date_to or (date_to - date_from).days > MAX_ANALYTICS_DAYS:
+        return jsonify({'error': f'from must be before to and at most {MAX_ANALYTICS_DAYS} days earlier'}), 400
+    try:
+        client_limit = max(1, min(int(request.args.get('clients', ANALYTICS_CLIENT_LIMIT)), 1000))
+    except ValueError:
+        client_limit = ANALYTICS_CLIENT_LIMIT
+
+    report = get_analytics_from_firebase(get_current_user_id(), date_from, date_to, client_limit)
+    if report is None:
+        return jsonify({'error': 'Analytics unavailable'}), 503
+    return jsonify(report)
+
 @app.route('/invoice/<invoice_id>')
 @login_required
 def view_invoice(invoice_id):
-    invoice = get_invoice_from_firebase(invoice_id)
+    user_id = get_current_user_id()
+    invoice, profile = gather(lambda: get_invoice_from_firebase(invoice_id), lambda: get_user_profile(user_id))
     if invoice:
-        # Rename 'items' to 'invoice_items' to avoid conflict with dict.items() method
-        template_data = invoice.copy()
-        if 'items' in template_data:
-            template_data['invoice_items'] = template_data.pop('items')
-        
-        return render_template('view_invoice.html', invoice=template_data, is_overdue=is_overdue)
+        return render_template('view_invoice.html', invoice=invoice_template_data(invoice), profile=profile,
+                               is_overdue=is_overdue)
     else:
         return "Invoice not found", 404
 
+@app.route('/api/invoices/<invoice_id>/pdf')
+@login_required
+def invoice_pdf(invoice_id):
+    """Download an invoice as PDF, rendered off the request thread and cached on disk"""
+    user_id = get_current_user_id()
+    invoice, profile = gather(lambda: get_invoice_from_firebase(invoice_id), lambda: get_user_profile(user_id))
+    if not invoice:
+        return jsonify({'success': False, 'error': 'Invoice not found'}), 404
+
+    profile = profile or {}
+    html = render_template('invoice_pdf.html', invoice=invoice_template_data(invoice), profile=profile)
+
+    try:
+        pdf_path = render_invoice_pdf(invoice_id, html)
+    except PdfRendererBusy:
+        return jsonify({'success': False, 'error': 'PDF renderer is busy, please retry'}), 503, {'Retry-After': '5'}
+    except Exception as e:
+        logger.error("Error rendering invoice PDF: %s", e)
+        return jsonify({'success': False, 'error': 'Failed to render PDF'}), 500
+
+    return send_file(pdf_path, mimetype='application/pdf',
+                     download_name=f"{invoice.get('invoiceNumber') or invoice_id}.pdf")
+
+@app.route('/api/exports/pdf')
+@login_required
+def export_invoice_pdfs():
+    """Download the PDFs of all invoices matching the filters as a streamed ZIP.
+
+    PDFs are rendered in parallel and added to the archive as each one
+    finishes. The X-Export-Id header identifies the export for progress
+    polling at /api/exports/<export_id>.
+    """
+    filters = get_invoice_filter_args()
+    export_id = export_progress.start(count_invoices_in_firebase(include_archived=True, **filters))
+    profile = get_user_profile(get_current_user_id()) or {}
+
+    def render_jobs():
+        for invoice in iter_invoices_from_firebase(include_archived=True, **filters):
+            html = render_template('invoice_pdf.html', invoice=invoice_template_data(invoice), profile=profile)
+            yield invoice['id'], html, f"{invoice.get('invoiceNumber') or 'invoice'}-{invoice['id']}.pdf"
+
+    def archive_files():
+        errors = []
+        failure = None
+        completed = False
+        try:
+            for name, pdf_path, error in render_invoice_pdfs(render_jobs()):
+                export_progress.advance(export_id, failed=error is not None)
+                if error:
+                    errors.append(f"{name}: {error}")
+                else:
+                    yield name, pdf_path
+            if errors:
+                yield 'errors.txt', '\n'.join(errors).encode()
+            completed = True
+        except Exception as e:
+            failure = e
+            raise
+        finally:
+            # A client that disconnects closes this generator mid-archive
+            export_progress.finish(export_id, error=failure, cancelled=not completed)
+
+    filename = f"invoices-{datetime.now().strftime('%Y%m%d-%H%M%S')}.zip"
+    response = Response(stream_with_context(stream_zip(archive_files())), mimetype='application/zip', headers={
+        'Content-Disposition': f'attachment; filename={filename}',
+        'X-Export-Id': export_id
+    })
+    # Covers a client that goes away before the archive starts; finish() is a no-op after the first call
+    response.call_on_close(lambda: export_progress.finish(export_id, cancelled=True))
+    return response
+
+@app.route('/api/exports/invoices')
+@login_required
+def export_invoices():
+    """Stream invoices matching the filters as CSV or JSON Lines.
+
+    ?format=csv|jsonl, ?columns=a,b,c picks fields, ?items=flatten writes
+    one row per line item. Invoices are read page by page, so memory use
+    does not grow with the number of invoices.
+    """
+    fmt = request.args.get('format', 'csv')
+    if fmt not in ('csv', 'jsonl'):
+        return jsonify({'success': False, 'error': 'format must be csv or jsonl'}), 400
+
+    columns = [column.strip() for column in request.args.get('columns', '').split(',') if column.strip()]
+    columns = columns or list(INVOICE_EXPORT_COLUMNS)
+    invalid = [column for column in columns if not EXPORT_COLUMN_PATTERN.match(column)]
+    if invalid:
+        return jsonify({'success': False, 'error': f"Invalid columns: {', '.join(invalid)}"}), 400
+
+    flatten_items = request.args.get('items') == 'flatten'
+    fields = [column for column in columns if column != 'id'] + (['items'] if flatten_items else [])
+    invoices = iter_invoices_from_firebase(fields=fields, include_archived=True, **get_invoice_filter_args())
+    rows = invoice_export_rows(invoices, columns, flatten_items)
+
+    filename = f"invoices-{datetime.now().strftime('%Y%m%d-%H%M%S')}.{fmt}"
+    if fmt == 'csv':
+        body, mimetype = stream_csv(rows, export_columns(columns, flatten_items)), 'text/csv'
+    else:
+        body, mimetype = stream_jsonl(rows), 'application/x-ndjson'
+    return Response(stream_with_context(body), mimetype=mimetype, headers={
+        'Content-Disposition': f'attachment; filename={filename}'
+    })
+
+@app.route('/api/exports/<export_id>')
+@login_required
+def get_export_progress(export_id):
+    """Progress of a running or recently finished export"""
+    if not db:
+        return jsonify({'success': False, 'error': 'Database unavailable'}), 503
+    progress = export_progress.get(export_id)
+    if progress is None:
+        return jsonify({'success': False, 'error': 'Export not found'}), 404
+    return jsonify({'success': True, 'progress': progress})
+
 @app.route('/debug/invoice-full/<invoice_id>')
 @login_required
 def debug_invoice_full(invoice_id):
@@ -438,38 +2543,121 @@ def debug_invoice_full(invoice_id):
 def update_invoice_status(invoice_id):
     data = request.get_json()
     new_status = data.get('status')
-    
-    if update_invoice_status_firebase(invoice_id, new_status):
-        invoice = get_invoice_from_firebase(invoice_id)
-        if invoice:
-            # Make it JSON serializable
-            serialized_invoice = invoice.copy()
-            if isinstance(serialized_invoice.get('createdAt'), datetime):
-                serialized_invoice['createdAt'] = serialized_invoice['createdAt'].isoformat()
-            if isinstance(serialized_invoice.get('updatedAt'), datetime):
-                serialized_invoice['updatedAt'] = serialized_invoice['updatedAt'].isoformat()
-        return jsonify({'success': True, 'invoice': serialized_invoice})
+
+    invoice = update_invoice_status_firebase(invoice_id, new_status)
+    if invoice:
+        return jsonify({'success': True, 'invoice': serialize_invoice(invoice)})
+    elif db and get_archived_invoice(invoice_id):
+        return jsonify({'success': False, 'error': 'Archived invoices cannot be changed'}), 409
     else:
         return jsonify({'success': False, 'error': 'Failed to update invoice'}), 500
 
 @app.route('/api/invoices/<invoice_id>/send-email', methods=['POST'])
 @login_required
 def send_invoice_email_route(invoice_id):
-    """Send invoice via email"""
+    """Queue an invoice email; the status flips to sent once it is delivered"""
     invoice = get_invoice_from_firebase(invoice_id)
-    if invoice:
-        # Send email
-        if send_invoice_email(invoice):
-            # Update status to sent
-            if update_invoice_status_firebase(invoice_id, 'sent'):
-                return jsonify({'success': True, 'message': 'Invoice sent successfully!'})
-            else:
-                return jsonify({'success': True, 'message': 'Email sent but status update failed'})
-        else:
-            return jsonify({'success': False, 'error': 'Failed to send email'}), 500
-    else:
+    if not invoice:
         return jsonify({'success': False, 'error': 'Invoice not found'}), 404
-    
+    if not invoice.get('clientEmail'):
+        return jsonify({'success': False, 'error': 'Invoice has no client email'}), 400
+    if not db or not os.getenv('SENDER_EMAIL'):
+        return jsonify({'success': False, 'error': 'Email is not configured'}), 500
+
+    entry_id = outbox.enqueue(invoice_id, get_current_user_id(), invoice['clientEmail'])
+    return jsonify({'success': True, 'message': 'Invoice queued for sending', 'outboxId': entry_id}), 202
+
+@app.route('/api/outbox/<entry_id>')
+@login_required
+def get_outbox_entry_api(entry_id):
+    """Delivery status of a queued email"""
+    entry = outbox.get(entry_id) if db else None
+    if not entry:
+        return jsonify({'success': False, 'error': 'Email not found'}), 404
+    return jsonify({'success': True, 'email': entry})
+
+@app.route('/api/events')
+@login_required
+def invoice_events():
+    """Server-Sent Events stream of invoice, client and dashboard stats changes"""
+    if not db:
+        return jsonify({'error': 'Database unavailable'}), 503
+    change_feed.start()
+    try:
+        subscription = event_hub.subscribe(get_current_user_id(), request.headers.get('Last-Event-ID'))
+    except TooManyStreams as e:
+        logger.warning("Refusing event stream: %s", e)
+        return jsonify({'error': 'Too many open event streams'}), 503
+    # X-Accel-Buffering stops nginx from holding events back
+    return Response(event_hub.stream(subscription), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+def prime_caches(invoice_limit=WARM_UP_INVOICES):
+    """Load the most recently updated invoices and the users' profiles into the cache"""
+    docs = db.collection('invoices').order_by('updatedAt', direction='DESCENDING').limit(invoice_limit).stream()
+    for doc in docs:
+        invoice = doc.to_dict()
+        invoice['id'] = doc.id
+        cache.set(cache_key('invoice', doc.id), invoice)
+    for user_id in users:
+        get_user_profile(user_id)
+
+def warm_up():
+    """Get this process ready to serve before it takes traffic.
+
+    Creates the datastore client and reads the cache versions, which opens
+    the gRPC channel and fetches credentials, then compiles the templates and
+    fills the cache, so the first requests pay none of that.
+    """
+    with startup.phase('datastore'):
+        if not db:
+            raise DatastoreUnavailable(db.error or 'Datastore is not initialized')
+        # Recording the cache versions first keeps the first check from dropping what prime_caches() loads
+        cache.sync(cache_versions())
+    with startup.phase('templates'):
+        for name in app.jinja_env.list_templates():
+            app.jinja_env.get_template(name)
+    with startup.phase('caches'):
+        prime_caches()
+
+@app.route('/healthz')
+def healthz():
+    """Liveness: the process is up and answering requests"""
+    return jsonify({'status': 'ok'})
+
+@app.route('/readyz')
+def readyz():
+    """Readiness: 200 once the datastore is connected and this process has warmed up.
+
+    Warms up on the first call when no server hook already did; after that
+    the answer costs no reads.
+    """
+    try:
+        startup.run_once(warm_up)
+    except Exception as e:
+        logger.warning("Not ready: %s", e)
+    stats = startup.stats()
+    body = {
+        'ready': stats['ready'],
+        'datastore': {'backend': STORAGE_BACKEND, 'connected': db.initialized, 'error': db.error},
+        'startup': stats
+    }
+    return jsonify(body), 200 if stats['ready'] else 503
+
+@app.route('/metrics')
+def metrics_endpoint():
+    """Prometheus metrics; set METRICS_TOKEN to require it as a bearer token"""
+    token = os.getenv('METRICS_TOKEN')
+    if token and request.headers.get('Authorization') != f"Bearer {token}":
+        return Response('Unauthorized\n', status=401, mimetype='text/plain')
+    return Response(metrics.render_metrics(cache.stats(), event_hub.stats(), startup.stats()), mimetype='text/plain; version=0.0.4')
+
+@app.route('/debug/cache')
+@login_required
+def debug_cache():
+    """Cache hit/miss counters"""
+    return jsonify(cache.stats())
+
 @app.route('/register', methods=['GET', 'POST'])
 def register():
     if request.method == 'POST':
@@ -511,8 +2699,7 @@ def clients():
 @login_required
 def get_clients_api():
     """Get all clients as JSON"""
-    clients = get_clients_from_firebase()
-    return jsonify({'clients': clients})
+    return conditional_json(list_etag('clients'), lambda: {'clients': get_clients_from_firebase()})
 
 @app.route('/api/clients', methods=['POST'])
 @login_required
@@ -547,6 +2734,28 @@ def get_client_api(client_id):
     else:
         return jsonify({'success': False, 'error': 'Client not found'}), 404
 
+@app.route('/api/clients/<client_id>/invoices')
+@login_required
+def get_client_invoices_api(client_id):
+    """A client with its stats and one page of its invoices, newest first"""
+    if not db:
+        return jsonify({'success': False, 'error': 'Database unavailable'}), 503
+    page_args = get_invoice_page_args()
+    page_args.pop('client')
+    # Read the client fresh, since its stats change with every invoice write
+    doc, (invoices, next_cursor) = gather(
+        lambda: db.collection('clients').document(client_id).get(),
+        lambda: get_invoices_page_from_firebase(**page_args, client_id=client_id))
+    if not doc.exists:
+        return jsonify({'success': False, 'error': 'Client not found'}), 404
+
+    return jsonify({
+        'success': True,
+        'client': client_from_doc(doc),
+        'invoices': [serialize_invoice(invoice) for invoice in invoices],
+        'next_cursor': next_cursor
+    })
+
 @app.route('/api/clients/<client_id>', methods=['PUT'])
 @login_required
 def update_client_api(client_id):
@@ -571,22 +2780,123 @@ def delete_client_api(client_id):
 @app.route('/api/clients/search')
 @login_required
 def search_clients_api():
-    """Search clients by name or email"""
-    query = request.args.get('q', '').lower()
-    
+    """Search clients by name, email, company or phone.
+
+    mode=typeahead returns only the fields needed for suggestions.
+    """
+    query = request.args.get('q', '')
+    typeahead = request.args.get('mode') == 'typeahead'
+    try:
+        limit = int(request.args.get('limit', 8 if typeahead else 20))
+    except ValueError:
+        limit = 20
+    limit = max(1, min(limit, 50))
+
     if not query:
         return jsonify({'clients': []})
-    
-    all_clients = get_clients_from_firebase()
-    filtered_clients = [
-        client for client in all_clients
-        if query in client.get('name', '').lower() or 
-           query in client.get('email', '').lower()
-    ]
-    
-    return jsonify({'clients': filtered_clients})
 
+    clients = search_clients_from_firebase(query, limit)
+    if typeahead:
+        clients = [
+            {key: client.get(key, '') for key in ('id', 'name', 'email', 'company')}
+            for client in clients
+        ]
+
+    return jsonify({'clients': clients})
+
+@app.route('/api/import/<kind>', methods=['POST'])
+@login_required
+def import_records_api(kind):
+    """Import clients or invoices from an uploaded CSV or JSON Lines file.
+
+    Send the file as multipart field `file`, or as the raw request body.
+    ?format=csv|jsonl overrides detection from the filename.
+    """
+    if kind not in ('clients', 'invoices'):
+        return jsonify({'success': False, 'error': 'Can only import clients or invoices'}), 404
+    if not db:
+        return jsonify({'success': False, 'error': 'Firebase is not initialized'}), 500
+
+    upload = request.files.get('file')
+    stream = upload.stream if upload else request.stream
+    fmt = request.args.get('format') or detect_format(upload.filename if upload else None, request.content_type)
+    if fmt not in IMPORT_FORMATS:
+        return jsonify({'success': False, 'error': f"Unsupported format: {fmt}"}), 400
+
+    try:
+        report = import_records_to_firebase(stream, kind, fmt, get_current_user_id())
+    except Exception as e:
+        logger.error("Error importing %s: %s", kind, e)
+        return jsonify({'success': False, 'error': str(e)}), 500
+
+    result = report.to_dict()
+    return jsonify({'success': result['failed'] == 0, **result})
+
+@app.route('/api/recurring-invoices', methods=['GET'])
+@login_required
+def get_recurring_invoices_api():
+    """Recurring invoice templates of the current user"""
+    if not db:
+        return jsonify({'success': False, 'error': 'Database unavailable'}), 503
+    return jsonify({'success': True, 'templates': get_recurring_templates(get_current_user_id())})
+
+@app.route('/api/recurring-invoices', methods=['POST'])
+@login_required
+def create_recurring_invoice_api():
+    """Create a recurring invoice template; the scheduler generates its invoices"""
+    if not db:
+        return jsonify({'success': False, 'error': 'Database unavailable'}), 503
+    user_id = get_current_user_id()
+    try:
+        template_id = save_recurring_template(user_id, request.get_json(silent=True))
+    except ValueError as e:
+        return jsonify({'success': False, 'error': str(e)}), 400
+    except Exception as e:
+        logger.error("Error saving recurring invoice: %s", e)
+        return jsonify({'success': False, 'error': 'Failed to save recurring invoice'}), 500
+    return jsonify({'success': True, 'template': get_recurring_template(template_id, user_id)}), 201
+
+@app.route('/api/recurring-invoices/<template_id>', methods=['GET'])
+@login_required
+def get_recurring_invoice_api(template_id):
+    if not db:
+        return jsonify({'success': False, 'error': 'Database unavailable'}), 503
+    template = get_recurring_template(template_id, get_current_user_id())
+    if not template:
+        return jsonify({'success': False, 'error': 'Recurring invoice not found'}), 404
+    return jsonify({'success': True, 'template': template})
+
+@app.route('/api/recurring-invoices/<template_id>', methods=['PUT'])
+@login_required
+def update_recurring_invoice_api(template_id):
+    """Update a template, or pause and resume it with {"status": "paused" | "active"}"""
+    if not db:
+        return jsonify({'success': False, 'error': 'Database unavailable'}), 503
+    user_id = get_current_user_id()
+    try:
+        found = update_recurring_template(template_id, user_id, request.get_json(silent=True) or {})
+    except ValueError as e:
+        return jsonify({'success': False, 'error': str(e)}), 400
+    except Exception as e:
+        logger.error("Error updating recurring invoice: %s", e)
+        return jsonify({'success': False, 'error': 'Failed to update recurring invoice'}), 500
+    if not found:
+        return jsonify({'success': False, 'error': 'Recurring invoice not found'}), 404
+    return jsonify({'success': True, 'template': get_recurring_template(template_id, user_id)})
 
+@app.route('/api/recurring-invoices/<template_id>', methods=['DELETE'])
+@login_required
+def delete_recurring_invoice_api(template_id):
+    if not db:
+        return jsonify({'success': False, 'error': 'Database unavailable'}), 503
+    try:
+        found = delete_recurring_template(template_id, get_current_user_id())
+    except Exception as e:
+        logger.error("Error deleting recurring invoice: %s", e)
+        return jsonify({'success': False, 'error': 'Failed to delete recurring invoice'}), 500
+    if not found:
+        return jsonify({'success': False, 'error': 'Recurring invoice not found'}), 404
+    return jsonify({'success': True, 'message': 'Recurring invoice deleted'})
 
 @app.route('/settings')
 @login_required
@@ -601,8 +2911,12 @@ def settings():
 def get_profile_api():
     """Get user profile"""
     user_id = get_current_user_id()
+    # Read before the profile, which may come from this worker's cache
+    etag = cached_etag('profile', user_id)
     profile = get_user_profile(user_id)
-    return jsonify({'success': True, 'profile': profile})
+    if profile is None:
+        return jsonify({'success': True, 'profile': profile})
+    return conditional_json(etag, lambda: {'success': True, 'profile': profile})
 
 @app.route('/api/settings/profile', methods=['POST'])
 @login_required
@@ -617,5 +2931,170 @@ def save_profile_api():
         return jsonify({'success': False, 'error': 'Failed to save profile'}), 500
     
     
+@app.cli.command('rebuild-stats')
+@click.option('--user', 'user_id', default=None, help='Only rebuild stats for this user')
+@click.option('--assign-to', default=None, help='Claim invoices without a userId for this user')
+def rebuild_stats_command(user_id, assign_to):
+    """Recompute dashboard stats documents from all invoices"""
+    if not db:
+        click.echo("Firebase is not initialized")
+        return
+    rebuilt = rebuild_dashboard_stats(user_id, assign_to)
+    for owner, stats in rebuilt.items():
+        click.echo(f"{owner}: {stats['total_invoices']} invoices, total {stats['total_amount']:.2f}")
+
+
+@app.cli.command('recompute-totals')
+@click.option('--user', 'user_id', default=None, help='Only check this user\'s invoices')
+@click.option('--fix', is_flag=True, help='Correct wrong draft invoices')
+@click.option('--apply-default-rate', is_flag=True, help='Re-rate drafts with their owner\'s default tax rate')
+@click.option('--include-issued', is_flag=True, help='With --fix, also correct sent, paid and overdue invoices')
+def recompute_totals_command(user_id, fix, apply_default_rate, include_issued):
+    """Recompute invoice totals in paise and report any that are wrong"""
+    if not db:
+        click.echo("Firebase is not initialized")
+        return
+    report = recompute_invoice_totals(user_id, fix, apply_default_rate, include_issued)
+    for wrong in report['discrepancies']:
+        if wrong['expected'] is None:
+            click.echo(f"{wrong['invoiceNumber'] or wrong['id']}: invalid ({wrong['error']})", err=True)
+            continue
+        click.echo(f"{wrong['invoiceNumber'] or wrong['id']}: {', '.join(wrong['fields'])} "
+                   f"(stored {wrong['stored']['total']}, expected {wrong['expected']['total']})", err=True)
+    click.echo(f"Checked {report['checked']} invoices: {report['wrong']} wrong, {report['invalid']} invalid, "
+               f"{report['rerated']} re-rated, {report['fixed']} updated")
+
+
+@app.cli.command('rebuild-analytics')
+@click.option('--user', 'user_id', default=None, help='Only rebuild this user\'s rollups')
+def rebuild_analytics_command(user_id):
+    """Recompute analytics rollups from all invoices"""
+    if not db:
+        click.echo("Firebase is not initialized")
+        return
+    click.echo(f"Wrote {rebuild_analytics_rollups(user_id)} rollup documents")
+
+
+@app.cli.command('rebuild-client-stats')
+def rebuild_client_stats_command():
+    """Link invoices to clients by email and recompute client stats"""
+    if not db:
+        click.echo("Firebase is not initialized")
+        return
+    linked, updated = rebuild_client_stats()
+    click.echo(f"Linked {linked} invoices, updated {updated} clients")
+
+
+@app.cli.command('mark-overdue')
+def mark_overdue_command():
+    """Flip sent invoices past their due date to overdue (run daily)"""
+    if not db:
+        click.echo("Firebase is not initialized")
+        return
+    click.echo(f"Marked {mark_overdue_invoices()} invoices overdue")
+
+@app.cli.command('backfill-due-dates')
+def backfill_due_dates_command():
+    """Add the indexed dueAt field to existing invoices"""
+    if not db:
+        click.echo("Firebase is not initialized")
+        return
+    click.echo(f"Updated {backfill_due_dates()} invoices")
+
+@app.cli.command('reindex-clients')
+def reindex_clients_command():
+    """Rebuild client search tokens"""
+    if not db:
+        click.echo("Firebase is not initialized")
+        return
+    click.echo(f"Reindexed {reindex_clients()} clients")
+
+@app.cli.command('reindex-invoices')
+def reindex_invoices_command():
+    """Rebuild the invoice search index"""
+    if not db:
+        click.echo("Firebase is not initialized")
+        return
+    indexed, removed = rebuild_invoice_search()
+    click.echo(f"Indexed {indexed} invoices, removed {removed} stale entries")
+
+@app.cli.command('archive-invoices')
+@click.option('--older-than', 'older_than_days', type=click.IntRange(min=0), default=ARCHIVE_AFTER_DAYS,
+              show_default=True, help='Archive paid invoices created more than this many days ago')
+@click.option('--dry-run', is_flag=True, help='Count archivable invoices without moving them')
+def archive_invoices_command(older_than_days, dry_run):
+    """Move old paid invoices into the compressed archive (run daily or monthly)"""
+    if not db:
+        click.echo("Firebase is not initialized")
+        return
+    archived, segments = archive_invoices(older_than_days, dry_run)
+    if dry_run:
+        click.echo(f"{archived} invoices would be archived")
+    else:
+        click.echo(f"Archived {archived} invoices into {segments} segments")
+
+@app.cli.command('import-data')
+@click.argument('path', type=click.File('rb'))
+@click.option('--kind', type=click.Choice(['clients', 'invoices']), default='invoices', show_default=True)
+@click.option('--format', 'fmt', type=click.Choice(IMPORT_FORMATS), default=None, help='Defaults to the file extension')
+@click.option('--user', 'user_id', default=None, help='Owner of imported invoices')
+def import_data_command(path, kind, fmt, user_id):
+    """Import clients or invoices from a CSV or JSON Lines file"""
+    if not db:
+        click.echo("Firebase is not initialized")
+        return
+    report = import_records_to_firebase(path, kind, fmt or detect_format(path.name), user_id).to_dict()
+    for error in report['errors']:
+        click.echo(f"Line {error['line']}: {error['error']}", err=True)
+    click.echo(f"{report['rows']} rows: {report['imported']} imported, {report['clientsCreated']} clients created, "
+               f"{report['skipped']} skipped, {report['failed']} failed")
+
+@app.cli.command('generate-recurring')
+@click.option('--date', 'run_date', default=None, help='Generate as of this YYYY-MM-DD instead of today')
+@click.option('--dry-run', is_flag=True, help='Count what would be generated without writing')
+@click.option('--no-send', is_flag=True, help='Do not queue emails for templates with autoSend')
+def generate_recurring_command(run_date, dry_run, no_send):
+    """Create the invoices of recurring templates that are due (run daily)"""
+    if not db:
+        click.echo("Firebase is not initialized")
+        return
+    started = time.perf_counter()
+    report = generate_recurring_invoices(parse_run_date(run_date) if run_date else None, dry_run,
+                                         send=not no_send).to_dict()
+    for error in report['errors']:
+        click.echo(f"Template {error['templateId']}: {error['error']}", err=True)
+    click.echo(f"{report['templates']} templates due: {report['generated']} invoices "
+               f"{'to generate' if dry_run else 'generated'}, {report['queued']} queued for sending, "
+               f"{report['skipped']} already generated, {report['failed']} failed "
+               f"in {time.perf_counter() - started:.1f}s")
+
+@app.cli.command('warm-up')
+def warm_up_command():
+    """Connect to the datastore, warm up and print how long each startup phase took"""
+    try:
+        startup.run_once(warm_up)
+    except Exception as e:
+        click.echo(f"Warm-up failed: {e}", err=True)
+        raise SystemExit(1)
+    for phase, seconds in startup.phases.items():
+        click.echo(f"{phase:<10} {seconds * 1000:>8.1f} ms")
+
+@app.cli.command('outbox-worker')
+@click.option('--once', is_flag=True, help='Deliver one batch and exit')
+def outbox_worker_command(once):
+    """Deliver queued invoice emails in the foreground"""
+    if not db:
+        click.echo("Firebase is not initialized")
+        return
+    if once:
+        click.echo(f"Processed {outbox.process_once()} emails")
+        return
+    outbox.run_worker()
+
+
+startup.record('import', time.perf_counter() - startup.started)
+
 if __name__ == '__main__':
+    if os.getenv('WARM_UP') == '1':
+        startup.run_once(warm_up)
     app.run(debug=True, port=5000)
\ No newline at end of file
@@ -0,0 +1,98 @@
+# archive.py
+import gzip
+import json
+import os
+import uuid
+from datetime import datetime
+
+from analytics import ROLLUP_FIELDS
+
+# Archived invoices live in compressed segments, one or more per owner and
+# month, and each has an uncompressed index entry naming its segment
+ARCHIVE_SEGMENTS_COLLECTION = 'invoice_archive'
+ARCHIVE_INDEX_COLLECTION = 'archived_invoices'
+# Paid invoices created longer ago than this are moved out of the invoices collection
+ARCHIVE_AFTER_DAYS = int(os.getenv('ARCHIVE_AFTER_DAYS', '365'))
+ARCHIVE_STATUSES = ('paid',)
+# Fields kept on index entries: enough to filter exports and rebuild stats
+# and rollups without opening segments
+ARCHIVE_SUMMARY_FIELDS = ('userId', 'invoiceNumber') + ROLLUP_FIELDS
+ARCHIVE_COMPRESS_LEVEL = 9
+
+
+def aware(value):
+    """A datetime with a timezone, taking naive ones as local time"""
+    return value if value.tzinfo else value.astimezone()
+
+
+def is_archivable(invoice, cutoff):
+    """Whether an invoice is settled and was created before `cutoff`"""
+    created_at = invoice.get('createdAt')
+    return (invoice.get('status') in ARCHIVE_STATUSES and isinstance(created_at, datetime)
+            and aware(created_at) < aware(cutoff))
+
+
+def archive_month(invoice):
+    return invoice['createdAt'].strftime('%Y-%m')
+
+
+def group_by_segment(invoices):
+    """Invoices grouped by (owner, month of creation), the unit a segment holds"""
+    groups = {}
+    for invoice in invoices:
+        groups.setdefault((invoice.get('userId'), archive_month(invoice)), []).append(invoice)
+    return groups
+
+
+def new_segment_id(month):
+    return f"{month}-{uuid.uuid4().hex[:12]}"
+
+
+def encode_value(value):
+    if isinstance(value, datetime):
+        return {'$date': value.isoformat()}
+    return str(value)
+
+
+def decode_value(value):
+    if len(value) == 1 and '$date' in value:
+        return datetime.fromisoformat(value['$date'])
+    return value
+
+
+def encode_segment(invoices):
+    """Invoices as gzipped JSON Lines; datetimes keep their timezone, or lack of one"""
+    lines = (json.dumps(invoice, default=encode_value, separators=(',', ':'), ensure_ascii=False)
+             for invoice in invoices)
+    return gzip.compress('\n'.join(lines).encode(), compresslevel=ARCHIVE_COMPRESS_LEVEL, mtime=0)
+
+
+def decode_segment(data):
+    """{invoice_id: invoice} from an encoded segment"""
+    invoices = {}
+    for line in gzip.decompress(data).decode().splitlines():
+        invoice = json.loads(line, object_hook=decode_value)
+        invoices[invoice.pop('id')] = invoice
+    return invoices
+
+
+def build_archive_segment(invoices, user_id, month, archived_at):
+    """Segment document for invoices of one owner and month, with its count and total"""
+    segment = {
+        'month': month,
+        'count': len(invoices),
+        'total': round(sum(float(invoice.get('total') or 0) for invoice in invoices), 2),
+        'data': encode_segment(invoices),
+        'archivedAt': archived_at
+    }
+    if user_id:
+        segment['userId'] = user_id
+    return segment
+
+
+def build_archive_entry(invoice, segment_id, archived_at):
+    """Index entry for an archived invoice"""
+    entry = {field: invoice[field] for field in ARCHIVE_SUMMARY_FIELDS if invoice.get(field) is not None}
+    entry['segmentId'] = segment_id
+    entry['archivedAt'] = archived_at
+    return entry
@@ -0,0 +1,380 @@
+# benchmark.py
+"""Benchmark the main routes against a local store as the data set grows.
+
+    python benchmark.py --backend sqlite --sizes 1000,10000,100000
+    python benchmark.py --compare benchmark-abc123.json benchmark-def456.json
+
+Each size runs in a fresh process: it seeds N invoices (with clients and
+realistic line items) from a fixed random seed, then drives every route
+through the Flask test client from several threads. Results are written
+as JSON so runs can be compared between commits.
+"""
+import argparse
+import contextlib
+import json
+import multiprocessing
+import os
+import platform
+import random
+import resource
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+
+DEFAULT_SIZES = (1000, 10000, 100000)
+INVOICES_PER_CLIENT = 20
+BENCHMARK_USER = 'admin'
+# p95 slowdown treated as a regression by --compare
+REGRESSION_THRESHOLD = 0.10
+
+FIRST_NAMES = ('Aarav', 'Diya', 'Ishaan', 'Kavya', 'Rohan', 'Meera', 'Arjun', 'Ananya', 'Vikram', 'Priya',
+               'Rahul', 'Sneha', 'Karan', 'Pooja', 'Aditya', 'Neha')
+LAST_NAMES = ('Sharma', 'Patel', 'Iyer', 'Reddy', 'Gupta', 'Nair', 'Mehta', 'Singh', 'Das', 'Kulkarni',
+              'Joshi', 'Bose')
+COMPANY_WORDS = ('Tech', 'Traders', 'Solutions', 'Exports', 'Textiles', 'Foods', 'Logistics', 'Studio',
+                 'Consulting', 'Pharma', 'Motors', 'Labs')
+CITIES = ('Mumbai', 'Pune', 'Bengaluru', 'Chennai', 'Hyderabad', 'Delhi', 'Kolkata', 'Ahmedabad', 'Jaipur')
+LINE_ITEMS = (
+    ('Website design', 15000, 60000),
+    ('Monthly retainer', 20000, 80000),
+    ('Logo and branding', 5000, 25000),
+    ('Consulting (per hour)', 1500, 5000),
+    ('Mobile app development', 50000, 300000),
+    ('SEO audit', 8000, 20000),
+    ('Hosting (annual)', 3000, 12000),
+    ('Content writing (per article)', 800, 3000),
+    ('Photography session', 5000, 20000),
+    ('Maintenance support', 2000, 10000),
+)
+STATUS_WEIGHTS = (('paid', 60), ('sent', 25), ('draft', 10), ('overdue', 5))
+
+
+def generate_client(rng, index):
+    first, last = rng.choice(FIRST_NAMES), rng.choice(LAST_NAMES)
+    company = f"{last} {rng.choice(COMPANY_WORDS)}"
+    return {
+        'name': f"{first} {last}",
+        'email': f"{first}.{last}.{index}@example.com".lower(),
+        'phone': f"+91 9{rng.randrange(10 ** 8, 10 ** 9)}",
+        'address': f"{rng.randrange(1, 400)}, MG Road, {rng.choice(CITIES)}",
+        'company': company
+    }
+
+
+def generate_invoice(rng, index, client, client_id, now):
+    """An invoice shaped like one saved from the create invoice form"""
+    items = []
+    for _ in range(rng.choice((1, 1, 2, 2, 3, 4, 6, 8))):
+        description, low, high = rng.choice(LINE_ITEMS)
+        quantity = rng.choice((1, 1, 1, 2, 3, 5, 10))
+        rate = round(rng.uniform(low, high), -2)
+        items.append({'description': description, 'quantity': quantity, 'rate': rate, 'amount': quantity * rate})
+
+    subtotal = sum(item['amount'] for item in items)
+    tax = round(subtotal * 0.18, 2)
+    created = now - timedelta(days=rng.uniform(0, 730))
+    due = created + timedelta(days=rng.choice((7, 15, 30, 45)))
+    status = rng.choices([status for status, _ in STATUS_WEIGHTS], [weight for _, weight in STATUS_WEIGHTS])[0]
+    return {
+        'invoiceNumber': f"INV-{index + 1:06d}",
+        'clientName': client['name'],
+        'clientEmail': client['email'],
+        'clientPhone': client['phone'],
+        'clientAddress': client['address'],
+        'clientId': client_id,
+        'invoiceDate': created.strftime('%Y-%m-%d'),
+        'dueDate': due.strftime('%Y-%m-%d'),
+        'dueAt': due.replace(hour=0, minute=0, second=0, microsecond=0),
+        'status': status,
+        'items': items,
+        'subtotal': subtotal,
+        'tax': tax,
+        'total': round(subtotal + tax, 2),
+        'createdAt': created,
+        'userId': BENCHMARK_USER
+    }
+
+
+def seed(app_module, invoice_count, seed_value):
+    """Write clients and invoices in batched commits, then rebuild stats.
+
+    Returns (invoice_ids, clients) for building requests.
+    """
+    db = app_module.db
+    rng = random.Random(seed_value)
+    now = datetime(2026, 1, 1)
+    clients = [generate_client(rng, index) for index in range(max(1, invoice_count // INVOICES_PER_CLIENT))]
+
+    batch, pending = db.batch(), 0
+    client_ids = []
+    for client in clients:
+        client_ref = db.collection('clients').document()
+        batch.set(client_ref, {**client, 'createdAt': now, 'searchTokens': app_module.build_search_tokens(client)})
+        client_ids.append(client_ref.id)
+        pending += 1
+        if pending >= app_module.BATCH_WRITE_LIMIT:
+            batch.commit()
+            batch, pending = db.batch(), 0
+
+    invoice_ids = []
+    for index in range(invoice_count):
+        client_index = rng.randrange(len(clients))
+        invoice_ref = db.collection('invoices').document()
+        batch.set(invoice_ref, generate_invoice(rng, index, clients[client_index], client_ids[client_index], now))
+        invoice_ids.append(invoice_ref.id)
+        pending += 1
+        if pending >= app_module.BATCH_WRITE_LIMIT:
+            batch.commit()
+            batch, pending = db.batch(), 0
+    if pending:
+        batch.commit()
+
+    app_module.rebuild_dashboard_stats(BENCHMARK_USER)
+    app_module.rebuild_analytics_rollups(BENCHMARK_USER)
+    return invoice_ids, clients
+
+
+def build_routes(invoice_ids, clients, rng):
+    """(name, request factory) pairs; each factory returns (method, url, json_body)"""
+    def search_query():
+        client = rng.choice(clients)
+        field = rng.choice((client['name'], client['company'], client['email']))
+        return field[:rng.randrange(2, 6)]
+
+    def new_invoice():
+        client = rng.choice(clients)
+        invoice = generate_invoice(rng, rng.randrange(10 ** 6), client, None, datetime.now())
+        for key in ('createdAt', 'dueAt', 'userId', 'clientId'):
+            invoice.pop(key)
+        return invoice
+
+    return [
+        ('GET /', lambda: ('GET', '/', None)),
+        ('GET /api/invoices', lambda: ('GET', '/api/invoices', None)),
+        ('GET /api/invoices?status=paid', lambda: ('GET', '/api/invoices?status=paid', None)),
+        ('GET /api/clients/search', lambda: ('GET', f"/api/clients/search?q={search_query()}", None)),
+        ('GET /invoice/<id>', lambda: ('GET', f"/invoice/{rng.choice(invoice_ids)}", None)),
+        ('GET /api/analytics', lambda: ('GET', '/api/analytics', None)),
+        ('POST /api/invoices', lambda: ('POST', '/api/invoices', new_invoice())),
+    ]
+
+
+class RssSampler:
+    """Samples resident memory in the background to find the peak during a run"""
+
+    def __init__(self, interval=0.01):
+        self.interval = interval
+        self.peak = 0
+        self._stop = threading.Event()
+        self._thread = None
+
+    @staticmethod
+    def current():
+        try:
+            with open('/proc/self/statm') as f:
+                return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+        except (OSError, ValueError):
+            # No /proc (e.g. macOS): fall back to the process high-water mark
+            maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+            return maxrss if sys.platform == 'darwin' else maxrss * 1024
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            self.peak = max(self.peak, self.current())
+
+    def __enter__(self):
+        self.peak = self.current()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self._stop.set()
+        self._thread.join()
+        self.peak = max(self.peak, self.current())
+
+
+def percentile(sorted_values, fraction):
+    if not sorted_values:
+        return None
+    index = min(len(sorted_values) - 1, max(0, round(fraction * len(sorted_values)) - 1))
+    return sorted_values[index]
+
+
+def run_route(app, make_request, requests, concurrency, warmup):
+    """Drive one route, returning latency percentiles, throughput and peak RSS"""
+    local = threading.local()
+
+    def call(_):
+        client = getattr(local, 'client', None)
+        if client is None:
+            client = local.client = app.test_client()
+            with client.session_transaction() as session:
+                session['user'] = BENCHMARK_USER
+        method, url, body = make_request()
+        started = time.perf_counter()
+        response = client.open(url, method=method, json=body)
+        elapsed = time.perf_counter() - started
+        response.close()
+        return elapsed, response.status_code < 400
+
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        list(executor.map(call, range(warmup)))
+        with RssSampler() as sampler:
+            started = time.perf_counter()
+            results = list(executor.map(call, range(requests)))
+            wall = time.perf_counter() - started
+
+    latencies = sorted(elapsed * 1000 for elapsed, _ in results)
+    return {
+        'requests': requests,
+        'errors': sum(1 for _, ok in results if not ok),
+        'p50_ms': round(percentile(latencies, 0.50), 3),
+        'p95_ms': round(percentile(latencies, 0.95), 3),
+        'p99_ms': round(percentile(latencies, 0.99), 3),
+        'mean_ms': round(statistics.fmean(latencies), 3),
+        'throughput_rps': round(requests / wall, 1),
+        'peak_rss_mb': round(sampler.peak / 2 ** 20, 1)
+    }
+
+
+def run_size(options, invoice_count, results):
+    """Seed one data set and benchmark every route (runs in a child process)"""
+    os.environ['STORAGE_BACKEND'] = options['backend']
+    data_dir = tempfile.mkdtemp(prefix='nayapaisa-bench-')
+    os.environ['SQLITE_PATH'] = os.path.join(data_dir, 'bench.db')
+    os.environ['PDF_CACHE_DIR'] = os.path.join(data_dir, 'pdf_cache')
+    os.environ.setdefault('EMAIL_OUTBOX_WORKERS', '0')
+    os.environ.setdefault('LOG_LEVEL', 'WARNING')
+
+    # The app prints while handling requests; keep that out of the report
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+        import app as app_module
+
+        started = time.perf_counter()
+        invoice_ids, clients = seed(app_module, invoice_count, options['seed'])
+        seed_seconds = time.perf_counter() - started
+
+        rng = random.Random(options['seed'] + 1)
+        routes = build_routes(invoice_ids, clients, rng)
+        for name, make_request in routes:
+            if options['routes'] and name not in options['routes']:
+                continue
+            app_module.cache.clear()
+            stats = run_route(app_module.app, make_request, options['requests'], options['concurrency'],
+                              options['warmup'])
+            results.put({'invoices': invoice_count, 'clients': len(clients), 'route': name,
+                         'seed_seconds': round(seed_seconds, 2), **stats})
+    results.put(None)
+    shutil.rmtree(data_dir, ignore_errors=True)
+
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__)), check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return 'unknown'
+
+
+def run(options):
+    context = multiprocessing.get_context('spawn')
+    report = {
+        'commit': git_commit(),
+        'timestamp': datetime.now().isoformat(timespec='seconds'),
+        'backend': options['backend'],
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'options': {key: options[key] for key in ('requests', 'concurrency', 'warmup', 'seed')},
+        'results': []
+    }
+
+    print(f"{'invoices':>9} {'route':<32} {'p50':>8} {'p95':>8} {'p99':>8} {'req/s':>8} {'rss MB':>8} {'err':>4}")
+    for size in options['sizes']:
+        results = context.Queue()
+        process = context.Process(target=run_size, args=(options, size, results))
+        process.start()
+        while True:
+            result = results.get()
+            if result is None:
+                break
+            report['results'].append(result)
+            print(f"{result['invoices']:>9} {result['route']:<32} {result['p50_ms']:>8.2f} {result['p95_ms']:>8.2f} "
+                  f"{result['p99_ms']:>8.2f} {result['throughput_rps']:>8.1f} {result['peak_rss_mb']:>8.1f} "
+                  f"{result['errors']:>4}")
+        process.join()
+        if process.exitcode:
+            raise SystemExit(f"Benchmark for {size} invoices failed (exit code {process.exitcode})")
+
+    output = options['output'] or f"benchmark-{report['commit']}.json"
+    with open(output, 'w') as f:
+        json.dump(report, f, indent=2)
+    print(f"Results written to {output}")
+
+
+def compare(baseline_path, current_path, threshold=REGRESSION_THRESHOLD):
+    """Print p95 changes between two result files, returning the number of regressions"""
+    with open(baseline_path) as f:
+        baseline = json.load(f)
+    with open(current_path) as f:
+        current = json.load(f)
+
+    before = {(result['invoices'], result['route']): result for result in baseline['results']}
+    regressions = 0
+    print(f"{baseline['commit']} -> {current['commit']}")
+    for result in current['results']:
+        previous = before.get((result['invoices'], result['route']))
+        if not previous:
+            continue
+        change = (result['p95_ms'] - previous['p95_ms']) / previous['p95_ms'] if previous['p95_ms'] else 0
+        flag = ''
+        if change > threshold:
+            flag = '  REGRESSION'
+            regressions += 1
+        print(f"{result['invoices']:>9} {result['route']:<32} p95 {previous['p95_ms']:>8.2f} -> "
+              f"{result['p95_ms']:>8.2f} ms ({change:+.0%}){flag}")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark Nayapaisa routes against a local store')
+    parser.add_argument('--backend', choices=('memory', 'sqlite', 'firestore'), default='sqlite',
+                        help='firestore uses firebase_config, e.g. with FIRESTORE_EMULATOR_HOST set')
+    parser.add_argument('--sizes', default=','.join(str(size) for size in DEFAULT_SIZES),
+                        help='Comma separated invoice counts')
+    parser.add_argument('--requests', type=int, default=200, help='Measured requests per route')
+    parser.add_argument('--concurrency', type=int, default=4)
+    parser.add_argument('--warmup', type=int, default=10)
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--route', action='append', dest='routes', help='Only run this route (repeatable)')
+    parser.add_argument('--output', help='Defaults to benchmark-<commit>.json')
+    parser.add_argument('--compare', nargs=2, metavar=('BASELINE', 'CURRENT'),
+                        help='Compare two result files instead of running')
+    parser.add_argument('--fail-on-regression', action='store_true',
+                        help='With --compare, exit non-zero if any p95 regressed')
+    args = parser.parse_args()
+
+    if args.compare:
+        regressions = compare(*args.compare)
+        sys.exit(1 if regressions and args.fail_on_regression else 0)
+
+    run({
+        'backend': args.backend,
+        'sizes': [int(size) for size in args.sizes.split(',') if size],
+        'requests': args.requests,
+        'concurrency': args.concurrency,
+        'warmup': args.warmup,
+        'seed': args.seed,
+        'routes': args.routes or [],
+        'output': args.output
+    })
+
+
+if __name__ == '__main__':
+    main()
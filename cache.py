@@ -0,0 +1,225 @@
+# cache.py
+import copy
+import logging
+import os
+import pickle
+import threading
+import time
+from collections import OrderedDict
+from functools import wraps
+
+logger = logging.getLogger(__name__)
+
+# Returned by get() on a miss, so falsy values like {} can still be cached
+MISSING = object()
+
+
+class LRUCache:
+    """In-process LRU cache with a per-entry TTL.
+
+    delete() only reaches this process. With `versions`, a callable
+    returning the datastore's write counter per key prefix, the counters
+    are read at most every `check_seconds` and the entries of any prefix
+    whose counter moved are dropped, so writes made by other workers show
+    up within that time rather than the TTL.
+    """
+
+    def __init__(self, max_entries=1024, ttl=300, versions=None, check_seconds=1.0):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._read_versions = versions
+        self._versions = {}
+        self.check_seconds = check_seconds
+        self._checked_at = None
+        self._checking = False
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+
+    def _check_versions(self):
+        now = time.monotonic()
+        with self._lock:
+            if self._checking or (self._checked_at is not None and now - self._checked_at < self.check_seconds):
+                return
+            self._checking = True
+        try:
+            self.sync(self._read_versions())
+        except Exception as e:
+            logger.error("Error reading cache versions: %s", e)
+        finally:
+            with self._lock:
+                self._checking = False
+                self._checked_at = time.monotonic()
+
+    def sync(self, versions):
+        """Drop the entries of every key prefix whose write counter has moved on"""
+        with self._lock:
+            changed = {prefix for prefix, version in versions.items() if version > self._versions.get(prefix, -1)}
+            if not changed:
+                return
+            for prefix in changed:
+                self._versions[prefix] = versions[prefix]
+            stale = [key for key in self._entries if key.split(':', 1)[0] in changed]
+            for key in stale:
+                del self._entries[key]
+            self.invalidations += len(stale)
+
+    def get(self, key):
+        if self._read_versions is not None:
+            self._check_versions()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry[1] < time.monotonic():
+                if entry is not None:
+                    del self._entries[key]
+                self.misses += 1
+                return MISSING
+            self._entries.move_to_end(key)
+            self.hits += 1
+            value = entry[0]
+        # Hand out copies so callers can't mutate the cached document
+        return copy.deepcopy(value)
+
+    def set(self, key, value, ttl=None):
+        expires_at = time.monotonic() + (ttl or self.ttl)
+        value = copy.deepcopy(value)
+        with self._lock:
+            self._entries[key] = (value, expires_at)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def delete(self, *keys):
+        with self._lock:
+            for key in keys:
+                if self._entries.pop(key, None) is not None:
+                    self.invalidations += 1
+
+    def clear(self):
+        with self._lock:
+            self.invalidations += len(self._entries)
+            self._entries.clear()
+
+    def stats(self):
+        with self._lock:
+            size = len(self._entries)
+        return {
+            'backend': 'memory',
+            'hits': self.hits,
+            'misses': self.misses,
+            'invalidations': self.invalidations,
+            'size': size,
+            'max_entries': self.max_entries
+        }
+
+
+class RedisCache:
+    """Cache shared between workers, backed by Redis.
+
+    Use this when running several worker processes, so a write in one
+    worker invalidates the entry for all of them.
+    """
+
+    def __init__(self, url, ttl=300, prefix='nayapaisa:'):
+        import redis
+        self.client = redis.Redis.from_url(url)
+        self.ttl = ttl
+        self.prefix = prefix
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+
+    def _count(self, counter, amount=1):
+        with self._lock:
+            setattr(self, counter, getattr(self, counter) + amount)
+
+    def get(self, key):
+        try:
+            data = self.client.get(self.prefix + key)
+        except Exception as e:
+            logger.error("Error reading cache: %s", e)
+            data = None
+        if data is None:
+            self._count('misses')
+            return MISSING
+        self._count('hits')
+        return pickle.loads(data)
+
+    def set(self, key, value, ttl=None):
+        try:
+            self.client.set(self.prefix + key, pickle.dumps(value), ex=ttl or self.ttl)
+        except Exception as e:
+            logger.error("Error writing cache: %s", e)
+
+    def delete(self, *keys):
+        if not keys:
+            return
+        try:
+            deleted = self.client.delete(*[self.prefix + key for key in keys])
+            self._count('invalidations', deleted)
+        except Exception as e:
+            logger.error("Error invalidating cache: %s", e)
+
+    def sync(self, versions):
+        """Nothing to do: deletes already reach every worker"""
+
+    def clear(self):
+        try:
+            keys = list(self.client.scan_iter(match=self.prefix + '*'))
+            if keys:
+                self._count('invalidations', self.client.delete(*keys))
+        except Exception as e:
+            logger.error("Error clearing cache: %s", e)
+
+    def stats(self):
+        return {
+            'backend': 'redis',
+            'hits': self.hits,
+            'misses': self.misses,
+            'invalidations': self.invalidations
+        }
+
+
+def create_cache(versions=None):
+    """Build the cache configured by CACHE_URL, CACHE_TTL, CACHE_MAX_ENTRIES and CACHE_VERSION_CHECK_SECONDS
+
+    `versions` is only used by the in-process cache, see LRUCache.
+    """
+    ttl = int(os.getenv('CACHE_TTL', '300'))
+    url = os.getenv('CACHE_URL')
+    if url:
+        try:
+            return RedisCache(url, ttl=ttl)
+        except ImportError:
+            logger.warning("CACHE_URL is set but the redis package is not installed, using in-process cache")
+    return LRUCache(max_entries=int(os.getenv('CACHE_MAX_ENTRIES', '1024')), ttl=ttl, versions=versions,
+                    check_seconds=float(os.getenv('CACHE_VERSION_CHECK_SECONDS', '1')))
+
+
+def cache_key(prefix, *args):
+    """Build a cache key such as 'invoice:<id>'"""
+    return ':'.join([prefix, *map(str, args)])
+
+
+def cached(cache, prefix):
+    """Read-through caching for a lookup helper.
+
+    Results of None (not found or a read error) are not cached, so failures
+    are retried on the next call.
+    """
+    def decorator(f):
+        @wraps(f)
+        def wrapper(*args):
+            key = cache_key(prefix, *args)
+            value = cache.get(key)
+            if value is not MISSING:
+                return value
+            value = f(*args)
+            if value is not None:
+                cache.set(key, value)
+            return value
+        return wrapper
+    return decorator
@@ -0,0 +1,38 @@
+# concurrency.py
+import atexit
+import contextvars
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+# Blocking datastore reads in flight at once per process, across all requests
+READ_CONCURRENCY = int(os.getenv('FIRESTORE_READ_CONCURRENCY', '32'))
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def read_pool():
+    """Shared pool for independent reads, created on first use so it starts after a fork"""
+    global _pool
+    if _pool is None:
+        with _pool_lock:
+            if _pool is None:
+                _pool = ThreadPoolExecutor(max_workers=READ_CONCURRENCY, thread_name_prefix='datastore-read')
+                atexit.register(_pool.shutdown, wait=False)
+    return _pool
+
+
+def gather(*calls):
+    """Run independent blocking reads at once and return their results in order.
+
+    Each call is a function taking no arguments. The first runs on the
+    calling thread while the rest run on the shared pool, in copies of the
+    caller's context so per-request metrics still see their reads.
+    Exceptions are re-raised in the caller.
+    """
+    if len(calls) < 2:
+        return [call() for call in calls]
+    futures = [read_pool().submit(contextvars.copy_context().run, call) for call in calls[1:]]
+    first = calls[0]()
+    return [first] + [future.result() for future in futures]
@@ -0,0 +1,305 @@
+# email_outbox.py
+import logging
+import os
+import smtplib
+import threading
+import time
+from datetime import datetime, timedelta
+from email.message import EmailMessage
+
+from storage import transactional
+
+logger = logging.getLogger(__name__)
+
+OUTBOX_COLLECTION = 'email_outbox'
+OUTBOX_WORKERS = int(os.getenv('EMAIL_OUTBOX_WORKERS', '2'))
+OUTBOX_BATCH_SIZE = int(os.getenv('EMAIL_OUTBOX_BATCH_SIZE', '20'))
+OUTBOX_POLL_INTERVAL = int(os.getenv('EMAIL_OUTBOX_POLL_INTERVAL', '5'))
+OUTBOX_MAX_ATTEMPTS = int(os.getenv('EMAIL_OUTBOX_MAX_ATTEMPTS', '5'))
+# Base delay for exponential backoff between attempts, in seconds
+OUTBOX_RETRY_DELAY = int(os.getenv('EMAIL_OUTBOX_RETRY_DELAY', '30'))
+# How long a claimed message is reserved for one worker
+OUTBOX_LEASE = 120
+
+
+class SmtpPool:
+    """Reuses logged-in SMTP connections instead of reconnecting per email"""
+
+    def __init__(self, host, port, username=None, password=None, use_tls=True, size=2, max_idle=60):
+        self.host = host
+        self.port = port
+        self.username = username
+        self.password = password
+        self.use_tls = use_tls
+        self.size = size
+        self.max_idle = max_idle
+        self._idle = []
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_env(cls):
+        return cls(
+            host=os.getenv('SMTP_HOST', 'smtp.gmail.com'),
+            port=int(os.getenv('SMTP_PORT', '587')),
+            username=os.getenv('SENDER_EMAIL'),
+            password=os.getenv('SENDER_PASSWORD'),
+            use_tls=os.getenv('SMTP_USE_TLS', '1') not in ('0', 'false', 'False'),
+            size=OUTBOX_WORKERS
+        )
+
+    def connect(self):
+        connection = smtplib.SMTP(self.host, self.port, timeout=30)
+        if self.use_tls:
+            connection.starttls()
+        if self.username and self.password:
+            connection.login(self.username, self.password)
+        return connection
+
+    def acquire(self):
+        while True:
+            with self._lock:
+                if not self._idle:
+                    break
+                connection, idle_since = self._idle.pop()
+            # Connections idle for a while may have been dropped by the server
+            if time.monotonic() - idle_since < self.max_idle:
+                return connection
+            try:
+                if connection.noop()[0] == 250:
+                    return connection
+            except smtplib.SMTPException:
+                pass
+            self.discard(connection)
+        return self.connect()
+
+    def release(self, connection):
+        with self._lock:
+            if len(self._idle) < self.size:
+                self._idle.append((connection, time.monotonic()))
+                return
+        self.discard(connection)
+
+    def discard(self, connection):
+        try:
+            connection.quit()
+        except Exception:
+            pass
+
+    def close(self):
+        with self._lock:
+            idle, self._idle = self._idle, []
+        for connection, _ in idle:
+            self.discard(connection)
+
+
+def build_invoice_email(sender, invoice, profile, attachment=None):
+    """Build the email for an invoice, attaching (filename, pdf_bytes) if given"""
+    business = (profile or {}).get('businessName') or 'Nayapaisa'
+    number = invoice.get('invoiceNumber', '')
+
+    message = EmailMessage()
+    message['From'] = sender
+    message['To'] = invoice.get('clientEmail')
+    message['Subject'] = f"Invoice {number} from {business}"
+    message.set_content(
+        f"Hello {invoice.get('clientName') or ''},\n\n"
+        f"Please find attached invoice {number} for "
+        f"₹{float(invoice.get('total') or 0):,.2f}, due {invoice.get('dueDate') or 'on receipt'}.\n\n"
+        f"Thank you for your business.\n{business}\n"
+    )
+    if attachment:
+        filename, pdf_bytes = attachment
+        message.add_attachment(pdf_bytes, maintype='application', subtype='pdf', filename=filename)
+    return message
+
+
+def retry_delay(attempts):
+    """Exponential backoff before the next attempt"""
+    return timedelta(seconds=OUTBOX_RETRY_DELAY * 2 ** max(attempts - 1, 0))
+
+
+@transactional
+def claim_in_transaction(transaction, entry_ref, now):
+    """Reserve a due outbox entry for this worker, returning it or None"""
+    snapshot = entry_ref.get(transaction=transaction)
+    if not snapshot.exists:
+        return None
+    entry = snapshot.to_dict()
+    if entry.get('status') not in ('queued', 'sending'):
+        return None
+    next_attempt = entry.get('nextAttemptAt')
+    if next_attempt and next_attempt.replace(tzinfo=None) > now:
+        return None
+
+    entry['attempts'] = entry.get('attempts', 0) + 1
+    transaction.update(entry_ref, {
+        'status': 'sending',
+        'attempts': entry['attempts'],
+        'nextAttemptAt': now + timedelta(seconds=OUTBOX_LEASE)
+    })
+    entry['id'] = snapshot.id
+    return entry
+
+
+class EmailOutbox:
+    """Persistent queue of invoice emails, delivered by background workers.
+
+    Entries live in the email_outbox collection, so queued mail survives
+    restarts and several processes can run workers; each entry is claimed
+    in a transaction before it is sent.
+
+    `load_message(entry)` builds the EmailMessage for an entry and
+    `on_delivered(entry)` runs after a successful send.
+    """
+
+    def __init__(self, db, load_message, on_delivered, smtp_pool=None):
+        self.db = db
+        self.load_message = load_message
+        self.on_delivered = on_delivered
+        self.smtp_pool = smtp_pool or SmtpPool.from_env()
+        self._wakeup = threading.Event()
+        self._stop = threading.Event()
+        self._threads = []
+        self._start_lock = threading.Lock()
+
+    def enqueue(self, invoice_id, user_id, to):
+        """Queue an invoice email, returning the outbox entry id"""
+        return self.enqueue_many([(invoice_id, user_id, to)])[0]
+
+    def enqueue_many(self, emails, batch_size=500):
+        """Queue (invoice_id, user_id, to) emails with batched writes, returning entry ids"""
+        entry_ids = []
+        for start in range(0, len(emails), batch_size):
+            batch = self.db.batch()
+            for invoice_id, user_id, to in emails[start:start + batch_size]:
+                entry_ids.append(self.enqueue_in(batch, invoice_id, user_id, to))
+            batch.commit()
+        self.wake()
+        return entry_ids
+
+    def enqueue_in(self, writer, invoice_id, user_id, to):
+        """Queue an email as part of the caller's batch or transaction, returning the entry id.
+
+        The email is sent only if that write commits; call wake() after it
+        does to start delivery without waiting for the next poll.
+        """
+        now = datetime.now()
+        entry_ref = self.db.collection(OUTBOX_COLLECTION).document()
+        writer.set(entry_ref, {
+            'invoiceId': invoice_id,
+            'userId': user_id,
+            'to': to,
+            'status': 'queued',
+            'attempts': 0,
+            'createdAt': now,
+            'nextAttemptAt': now
+        })
+        return entry_ref.id
+
+    def wake(self):
+        self._wakeup.set()
+
+    def get(self, entry_id):
+        doc = self.db.collection(OUTBOX_COLLECTION).document(entry_id).get()
+        if not doc.exists:
+            return None
+        entry = doc.to_dict()
+        entry['id'] = doc.id
+        return entry
+
+    def claim_batch(self):
+        """Claim up to OUTBOX_BATCH_SIZE entries that are due for sending"""
+        now = datetime.now()
+        docs = self.db.collection(OUTBOX_COLLECTION) \
+            .where('status', 'in', ['queued', 'sending']) \
+            .where('nextAttemptAt', '<=', now) \
+            .order_by('nextAttemptAt') \
+            .limit(OUTBOX_BATCH_SIZE) \
+            .stream()
+
+        claimed = []
+        for doc in docs:
+            entry = claim_in_transaction(self.db.transaction(), doc.reference, now)
+            if entry:
+                claimed.append(entry)
+        return claimed
+
+    def deliver(self, entries):
+        """Send claimed entries over one pooled SMTP connection"""
+        connection = None
+        try:
+            for entry in entries:
+                try:
+                    message = self.load_message(entry)
+                    if connection is None:
+                        connection = self.smtp_pool.acquire()
+                    connection.send_message(message)
+                except (smtplib.SMTPServerDisconnected, OSError) as e:
+                    # The connection is unusable; reconnect for the next entry
+                    if connection is not None:
+                        self.smtp_pool.discard(connection)
+                        connection = None
+                    self.mark_failed(entry, e)
+                    continue
+                except Exception as e:
+                    self.mark_failed(entry, e)
+                    continue
+                self.mark_sent(entry)
+        finally:
+            if connection is not None:
+                self.smtp_pool.release(connection)
+
+    def mark_sent(self, entry):
+        self.db.collection(OUTBOX_COLLECTION).document(entry['id']).update({
+            'status': 'sent',
+            'sentAt': datetime.now(),
+            'lastError': None
+        })
+        try:
+            self.on_delivered(entry)
+        except Exception as e:
+            logger.error("Error after delivering email %s: %s", entry['id'], e)
+
+    def mark_failed(self, entry, error):
+        logger.warning("Error sending email %s (attempt %s): %s", entry['id'], entry['attempts'], error)
+        if entry['attempts'] >= OUTBOX_MAX_ATTEMPTS:
+            update = {'status': 'failed'}
+        else:
+            update = {'status': 'queued', 'nextAttemptAt': datetime.now() + retry_delay(entry['attempts'])}
+        update['lastError'] = str(error)
+        self.db.collection(OUTBOX_COLLECTION).document(entry['id']).update(update)
+
+    def process_once(self):
+        """Claim and deliver one batch, returning how many entries were claimed"""
+        entries = self.claim_batch()
+        if entries:
+            self.deliver(entries)
+        return len(entries)
+
+    def run_worker(self):
+        while not self._stop.is_set():
+            try:
+                if self.process_once():
+                    continue
+            except Exception as e:
+                logger.error("Error in email outbox worker: %s", e)
+            self._wakeup.wait(OUTBOX_POLL_INTERVAL)
+            self._wakeup.clear()
+
+    def start(self, workers=OUTBOX_WORKERS):
+        """Start background worker threads once per process"""
+        with self._start_lock:
+            if self._threads or workers <= 0:
+                return
+            for index in range(workers):
+                thread = threading.Thread(target=self.run_worker, name=f"email-outbox-{index}", daemon=True)
+                thread.start()
+                self._threads.append(thread)
+
+    def stop(self):
+        self._stop.set()
+        self._wakeup.set()
+        for thread in self._threads:
+            thread.join(timeout=5)
+        self._threads = []
+        self.smtp_pool.close()
@@ -0,0 +1,255 @@
+# events.py
+import itertools
+import json
+import logging
+import os
+import threading
+import uuid
+from collections import deque
+from datetime import datetime, timedelta
+
+logger = logging.getLogger(__name__)
+
+# Open streams allowed per process, and events buffered per stream before a
+# slow client is told to reload instead
+MAX_EVENT_STREAMS = int(os.getenv('MAX_EVENT_STREAMS', '500'))
+EVENT_BUFFER_SIZE = int(os.getenv('EVENT_BUFFER_SIZE', '100'))
+# Seconds between keep-alive comments on an idle stream, which is also how
+# quickly a closed connection is noticed
+EVENT_HEARTBEAT_SECONDS = float(os.getenv('EVENT_HEARTBEAT_SECONDS', '15'))
+# Recent events kept for clients that reconnect with Last-Event-ID
+EVENT_REPLAY_SIZE = 256
+# Seconds between moving the change listeners' start forward, and how far
+# before now a new listener starts, to allow for writers' clock skew
+CHANGE_FEED_REFRESH_SECONDS = float(os.getenv('CHANGE_FEED_REFRESH_SECONDS', '300'))
+CHANGE_FEED_OVERLAP_SECONDS = float(os.getenv('CHANGE_FEED_OVERLAP_SECONDS', '30'))
+
+
+class TooManyStreams(Exception):
+    pass
+
+
+class Subscription:
+    """One open event stream: a bounded queue of events for one user"""
+
+    def __init__(self, user_id, buffer_size=EVENT_BUFFER_SIZE):
+        self.user_id = user_id
+        self.buffer_size = buffer_size
+        self._events = deque()
+        self._ready = threading.Event()
+        self._lock = threading.Lock()
+
+    def push(self, event):
+        """Queue an event, returning False when the queue overflowed into a reset"""
+        with self._lock:
+            overflowed = len(self._events) >= self.buffer_size
+            if overflowed:
+                # The client is not keeping up; drop what it missed and have it reload
+                self._events.clear()
+                event = (event[0], 'reset', {})
+            self._events.append(event)
+        self._ready.set()
+        return not overflowed
+
+    def wait(self, timeout):
+        """Events pushed since the last call, waiting up to `timeout` seconds for one"""
+        self._ready.wait(timeout)
+        with self._lock:
+            events = list(self._events)
+            self._events.clear()
+            self._ready.clear()
+        return events
+
+
+class EventHub:
+    """Fans change events out to every open event stream in this process.
+
+    Publishing is a non-blocking append to each matching subscriber's
+    queue, so one shared listener can feed any number of streams. Streams
+    wait on an Event rather than polling: under gevent workers (gunicorn
+    -k gevent) an idle stream is a parked greenlet, not a thread, and
+    MAX_EVENT_STREAMS bounds how many a threaded server holds open.
+    """
+
+    def __init__(self, max_streams=MAX_EVENT_STREAMS, replay_size=EVENT_REPLAY_SIZE):
+        self.max_streams = max_streams
+        self._subscribers = set()
+        self._recent = deque(maxlen=replay_size)
+        self._ids = itertools.count(1)
+        # Event ids carry the process they came from, since a reconnecting
+        # client may land on another worker
+        self.instance = uuid.uuid4().hex[:8]
+        self._lock = threading.Lock()
+        self.published = 0
+        self.resets = 0
+
+    def subscribe(self, user_id, last_event_id=None):
+        """Open a stream for a user, replaying events after `last_event_id` when still buffered"""
+        subscription = Subscription(user_id)
+        with self._lock:
+            if len(self._subscribers) >= self.max_streams:
+                raise TooManyStreams(f"{len(self._subscribers)} event streams already open")
+            self._subscribers.add(subscription)
+            missed = self.missed_since(last_event_id, user_id)
+        for event in missed:
+            subscription.push(event)
+        return subscription
+
+    def missed_since(self, last_event_id, user_id):
+        """Buffered events after `last_event_id`, or a reset when some may have been missed"""
+        if not last_event_id:
+            return []
+        instance, _, number = str(last_event_id).partition(':')
+        try:
+            last = int(number)
+        except ValueError:
+            last = None
+        if instance != self.instance or last is None:
+            return [(next(self._ids), 'reset', {})]
+        if self._recent and self._recent[0][0] > last + 1:
+            return [(self._recent[-1][0], 'reset', {})]
+        return [(event_id, kind, data) for event_id, kind, data, owner in self._recent
+                if event_id > last and owner in (None, user_id)]
+
+    def unsubscribe(self, subscription):
+        with self._lock:
+            self._subscribers.discard(subscription)
+
+    def has_subscribers(self, user_id=None):
+        with self._lock:
+            return any(user_id is None or subscription.user_id == user_id for subscription in self._subscribers)
+
+    def publish(self, kind, data, user_id=None):
+        """Send an event to every stream, or only to `user_id`'s streams"""
+        with self._lock:
+            event_id = next(self._ids)
+            self._recent.append((event_id, kind, data, user_id))
+            subscribers = [subscription for subscription in self._subscribers
+                           if user_id is None or subscription.user_id == user_id]
+            self.published += 1
+        resets = sum(not subscription.push((event_id, kind, data)) for subscription in subscribers)
+        if resets:
+            with self._lock:
+                self.resets += resets
+
+    def stream(self, subscription, heartbeat=EVENT_HEARTBEAT_SECONDS):
+        """Server-Sent Events body for a subscription; unsubscribes when the client goes away"""
+        try:
+            yield 'retry: 5000\n\n'
+            while True:
+                events = subscription.wait(heartbeat)
+                if not events:
+                    yield ': keep-alive\n\n'
+                for event_id, kind, data in events:
+                    yield format_event(f"{self.instance}:{event_id}", kind, data)
+        finally:
+            self.unsubscribe(subscription)
+
+    def stats(self):
+        with self._lock:
+            streams = len(self._subscribers)
+        return {'streams': streams, 'published': self.published, 'resets': self.resets}
+
+
+def format_event(event_id, kind, data):
+    return f"id: {event_id}\nevent: {kind}\ndata: {json.dumps(data, default=str)}\n\n"
+
+
+class ChangeFeed:
+    """One set of snapshot listeners per process, shared by all event streams.
+
+    Each watch is (name, query_for(since), handler): the query is built for
+    documents updated since shortly before the listener started, and
+    handler(change) turns each later document change into events. A
+    listener keeps every document its query matches, so every
+    CHANGE_FEED_REFRESH_SECONDS each one is replaced by a listener with a
+    later `since`, bounding its memory and what a resumed stream re-sends.
+    Firestore runs the handlers on its listener threads.
+    """
+
+    def __init__(self, watches, refresh_seconds=CHANGE_FEED_REFRESH_SECONDS,
+                 overlap_seconds=CHANGE_FEED_OVERLAP_SECONDS):
+        self.watches = watches
+        self.refresh_seconds = refresh_seconds
+        self.overlap = timedelta(seconds=overlap_seconds)
+        self._listeners = {}
+        # Replaced listeners still running until their replacement has caught up
+        self._retiring = set()
+        self._lock = threading.Lock()
+        self._stopped = threading.Event()
+        self.refreshes = 0
+
+    @property
+    def started(self):
+        return bool(self._listeners)
+
+    def start(self):
+        with self._lock:
+            if self._listeners:
+                return
+            self._stopped.clear()
+            for watch in self.watches:
+                self._listeners[watch[0]] = self._listen(watch)
+            threading.Thread(target=self._refresh_loop, name='change-feed-refresh', daemon=True).start()
+            logger.info("Listening for changes to %s", ', '.join(name for name, _, _ in self.watches))
+
+    def refresh(self):
+        """Replace every listener with one whose query starts from now"""
+        with self._lock:
+            if not self._listeners:
+                return
+            for watch in self.watches:
+                replaced = self._listeners[watch[0]]
+                self._retiring.add(replaced)
+                self._listeners[watch[0]] = self._listen(watch, replaced)
+            self.refreshes += 1
+
+    def stop(self):
+        with self._lock:
+            self._stopped.set()
+            for listener in [*self._listeners.values(), *self._retiring]:
+                listener.unsubscribe()
+            self._listeners = {}
+            self._retiring = set()
+
+    def _listen(self, watch, replaced=None):
+        name, query_for, handler = watch
+        # Writers stamp updatedAt with their own clocks, so start a little early
+        since = datetime.now() - self.overlap
+        return query_for(since).on_snapshot(self.callback(name, handler, replaced))
+
+    def _refresh_loop(self):
+        while not self._stopped.wait(self.refresh_seconds):
+            try:
+                self.refresh()
+            except Exception as e:
+                logger.error("Error refreshing change listeners: %s", e)
+
+    def _retire(self, listener):
+        with self._lock:
+            if listener not in self._retiring:
+                return
+            self._retiring.discard(listener)
+        listener.unsubscribe()
+
+    def callback(self, name, handler, replaced=None):
+        initial = True
+
+        def on_snapshot(documents, changes, read_time):
+            nonlocal initial
+            if initial:
+                # The first snapshot lists documents updated before the
+                # listener started; the listener it replaces has sent them, and
+                # keeps running a little longer to deliver any still in flight
+                initial = False
+                if replaced is not None:
+                    timer = threading.Timer(self.overlap.total_seconds(), self._retire, [replaced])
+                    timer.daemon = True
+                    timer.start()
+                return
+            for change in changes:
+                try:
+                    handler(change)
+                except Exception as e:
+                    logger.error("Error handling %s change %s: %s", name, change.document.id, e)
+        return on_snapshot
@@ -0,0 +1,224 @@
+# exports.py
+import csv
+import io
+import json
+import logging
+import threading
+import time
+import uuid
+import zipfile
+from datetime import datetime, timedelta, timezone
+
+from firebase_admin import firestore
+
+logger = logging.getLogger(__name__)
+
+# Export progress documents, how long they are kept for polling, and how
+# often a running export writes its counts
+EXPORT_PROGRESS_COLLECTION = 'export_progress'
+EXPORT_PROGRESS_TTL = 3600
+EXPORT_PROGRESS_FLUSH_SECONDS = 1.0
+
+INVOICE_EXPORT_COLUMNS = ('id', 'invoiceNumber', 'status', 'clientName', 'clientEmail', 'invoiceDate',
+                          'dueDate', 'subtotal', 'tax', 'total', 'createdAt')
+ITEM_EXPORT_COLUMNS = ('description', 'quantity', 'rate', 'amount')
+# Rows encoded per chunk of a streamed CSV/JSON Lines response
+EXPORT_ROWS_PER_CHUNK = 200
+
+
+class StreamBuffer:
+    """Write-only file object whose contents are drained after each write.
+
+    zipfile writes to it as if it were a file. It is not seekable, so
+    zipfile uses data descriptors and never needs the whole archive in
+    memory.
+    """
+
+    def __init__(self):
+        self._chunks = []
+
+    def write(self, data):
+        self._chunks.append(bytes(data))
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def drain(self):
+        data = b''.join(self._chunks)
+        self._chunks = []
+        return data
+
+
+def stream_zip(files):
+    """Yield a ZIP archive chunk by chunk from (name, path_or_bytes) pairs"""
+    buffer = StreamBuffer()
+    files = iter(files)
+    try:
+        # PDFs are already compressed, so store them as-is
+        with zipfile.ZipFile(buffer, 'w', compression=zipfile.ZIP_STORED) as archive:
+            for name, content in files:
+                if isinstance(content, bytes):
+                    archive.writestr(name, content)
+                else:
+                    archive.write(content, arcname=name)
+                data = buffer.drain()
+                if data:
+                    yield data
+        yield buffer.drain()
+    finally:
+        # Closed early when the client disconnects; let `files` clean up too
+        if hasattr(files, 'close'):
+            files.close()
+
+
+def export_value(value):
+    """Convert a Firestore value to something CSV/JSON can hold"""
+    if isinstance(value, datetime):
+        return value.isoformat()
+    if isinstance(value, (list, dict)):
+        return json.dumps(value, default=str)
+    return value
+
+
+def invoice_export_rows(invoices, columns, flatten_items=False):
+    """Yield one flat dict per invoice, or per line item when flattening.
+
+    Flattened rows repeat the invoice columns and add item.* columns; an
+    invoice without items still gets a single row.
+    """
+    for invoice in invoices:
+        row = {column: export_value(invoice.get(column)) for column in columns}
+        if not flatten_items:
+            yield row
+            continue
+        items = invoice.get('items') or [{}]
+        for item in items if isinstance(items, list) else [{}]:
+            item = item if isinstance(item, dict) else {}
+            yield {**row, **{f"item.{column}": export_value(item.get(column)) for column in ITEM_EXPORT_COLUMNS}}
+
+
+def export_columns(columns, flatten_items=False):
+    """Header for an export, including item columns when flattening"""
+    return list(columns) + ([f"item.{column}" for column in ITEM_EXPORT_COLUMNS] if flatten_items else [])
+
+
+def csv_safe(value):
+    """Stop spreadsheet apps from treating text cells as formulas"""
+    if isinstance(value, str) and value[:1] in ('=', '+', '-', '@'):
+        return "'" + value
+    return value
+
+
+def stream_csv(rows, header):
+    """Yield CSV text in chunks of EXPORT_ROWS_PER_CHUNK rows"""
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(header)
+    pending = 0
+    for row in rows:
+        writer.writerow([csv_safe(row.get(column)) for column in header])
+        pending += 1
+        if pending >= EXPORT_ROWS_PER_CHUNK:
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+            pending = 0
+    yield buffer.getvalue()
+
+
+def stream_jsonl(rows):
+    """Yield newline-delimited JSON in chunks of EXPORT_ROWS_PER_CHUNK rows"""
+    lines = []
+    for row in rows:
+        lines.append(json.dumps(row, ensure_ascii=False, default=str))
+        if len(lines) >= EXPORT_ROWS_PER_CHUNK:
+            yield '\n'.join(lines) + '\n'
+            lines = []
+    if lines:
+        yield '\n'.join(lines) + '\n'
+
+
+class ExportProgress:
+    """Progress of long running exports, kept in the datastore so any worker can answer a poll.
+
+    Counts are buffered in the exporting process and written at most every
+    EXPORT_PROGRESS_FLUSH_SECONDS, and when the export finishes. status is
+    running until then, and completed, failed or cancelled after. Progress
+    write failures are logged and never fail the export.
+    """
+
+    def __init__(self, db, flush_seconds=EXPORT_PROGRESS_FLUSH_SECONDS):
+        self._db = db
+        self._flush_seconds = flush_seconds
+        self._pending = {}
+        self._lock = threading.Lock()
+
+    def _ref(self, export_id):
+        return self._db.collection(EXPORT_PROGRESS_COLLECTION).document(export_id)
+
+    def _write(self, export_id, update, merge=True):
+        update['updatedAt'] = time.time()
+        try:
+            self._ref(export_id).set(update, merge=merge)
+        except Exception as e:
+            logger.error("Error saving progress of export %s: %s", export_id, e)
+
+    def _take(self, export_id):
+        """Counts buffered since the last write, as increments"""
+        pending = self._pending.get(export_id)
+        if not pending:
+            return {}
+        counts = {key: firestore.Increment(pending[key]) for key in ('done', 'failed') if pending[key]}
+        self._pending[export_id] = {'done': 0, 'failed': 0, 'flushedAt': time.time()}
+        return counts
+
+    def start(self, total):
+        export_id = uuid.uuid4().hex
+        with self._lock:
+            self._pending[export_id] = {'done': 0, 'failed': 0, 'flushedAt': time.time()}
+        self._write(export_id, {
+            'total': total,
+            'done': 0,
+            'failed': 0,
+            'finished': False,
+            'status': 'running',
+            'startedAt': time.time(),
+            # Firestore deletes the document after this, via a TTL policy
+            'expiresAt': datetime.now(timezone.utc) + timedelta(seconds=EXPORT_PROGRESS_TTL)
+        }, merge=False)
+        return export_id
+
+    def advance(self, export_id, failed=False):
+        with self._lock:
+            pending = self._pending.get(export_id)
+            if pending is None:
+                return
+            pending['failed' if failed else 'done'] += 1
+            if time.time() - pending['flushedAt'] < self._flush_seconds:
+                return
+            counts = self._take(export_id)
+        self._write(export_id, counts)
+
+    def finish(self, export_id, error=None, cancelled=False):
+        """Write the remaining counts and mark the export finished, with the error that stopped it if any"""
+        with self._lock:
+            if export_id not in self._pending:
+                return
+            counts = self._take(export_id)
+            self._pending.pop(export_id, None)
+        update = {**counts, 'finished': True,
+                  'status': 'failed' if error else 'cancelled' if cancelled else 'completed'}
+        if error:
+            update['error'] = str(error)
+        self._write(export_id, update)
+
+    def get(self, export_id):
+        snapshot = self._ref(export_id).get()
+        if not snapshot.exists:
+            return None
+        progress = snapshot.to_dict()
+        expires_at = progress.pop('expiresAt', None)
+        if expires_at is not None and expires_at < datetime.now(timezone.utc):
+            return None
+        return progress
@@ -1,19 +1,102 @@
 # firebase_config.py
 import firebase_admin
 from firebase_admin import credentials, firestore
+import logging
 import os
+import threading
+import time
+from storage import STORAGE_BACKEND, create_store
+
+logger = logging.getLogger(__name__)
+
+# Path to your service account key
+SERVICE_ACCOUNT_KEY = os.getenv('FIREBASE_SERVICE_ACCOUNT', 'serviceAccountKey.json')
+# After a failed connection, requests fail fast for this long before the
+# datastore is tried again
+DATASTORE_RETRY_SECONDS = float(os.getenv('DATASTORE_RETRY_SECONDS', '30'))
+
+
+class DatastoreUnavailable(Exception):
+    """Raised when the datastore is used but could not be initialized"""
+
 
 def initialize_firebase():
-    """Initialize Firebase with service account"""
+    """Firestore client for the service account; raises when it cannot be created"""
     try:
-        # Path to your service account key
-        cred = credentials.Certificate("serviceAccountKey.json")
-        firebase_admin.initialize_app(cred)
-        print("Firebase initialized successfully!")
-        return firestore.client()
-    except Exception as e:
-        print(f"Error initializing Firebase: {e}")
-        return None
-
-# Initialize Firebase when module is imported
-db = initialize_firebase()
\ No newline at end of file
+        app = firebase_admin.get_app()
+    except ValueError:
+        app = firebase_admin.initialize_app(credentials.Certificate(SERVICE_ACCOUNT_KEY))
+        logger.info("Firebase initialized successfully!")
+    return firestore.client(app)
+
+def initialize_db():
+    """Firestore client, or a local store when STORAGE_BACKEND is sqlite or memory"""
+    store = create_store(STORAGE_BACKEND)
+    if store is not None:
+        logger.info("Using %s storage backend", STORAGE_BACKEND)
+        return store
+    return initialize_firebase()
+
+
+class LazyDatastore:
+    """The datastore client, created on first use rather than at import.
+
+    Creation runs once per process under a lock, so a prefork server's
+    workers each build their client after forking and concurrent first
+    requests share it. bool(db) is False while the datastore is
+    unavailable, and any other use then raises DatastoreUnavailable.
+    """
+
+    def __init__(self, factory, retry_seconds=DATASTORE_RETRY_SECONDS):
+        self._factory = factory
+        self._retry_seconds = retry_seconds
+        self._client = None
+        self._lock = threading.Lock()
+        self._failed_at = None
+        self.error = None
+        self.init_seconds = None
+
+    @property
+    def initialized(self):
+        return self._client is not None
+
+    def get(self):
+        """The client, or None when it cannot be created"""
+        client = self._client
+        if client is not None:
+            return client
+        with self._lock:
+            if self._client is None and not self._backing_off():
+                self._connect()
+            return self._client
+
+    def _backing_off(self):
+        return self._failed_at is not None and time.monotonic() - self._failed_at < self._retry_seconds
+
+    def _connect(self):
+        started = time.perf_counter()
+        try:
+            self._client = self._factory()
+        except Exception as e:
+            self.error = str(e)
+            self._failed_at = time.monotonic()
+            logger.error("Error initializing the datastore: %s", e)
+            logger.error("Set STORAGE_BACKEND=sqlite or STORAGE_BACKEND=memory to run without Firebase")
+            return
+        self.init_seconds = time.perf_counter() - started
+        self.error = None
+        self._failed_at = None
+        logger.info("Datastore client created in %.1f ms", self.init_seconds * 1000)
+
+    def __bool__(self):
+        return self.get() is not None
+
+    def __getattr__(self, name):
+        client = self.get()
+        if client is None:
+            raise DatastoreUnavailable(self.error or 'Datastore is not initialized')
+        return getattr(client, name)
+
+
+# Nothing connects at import; the client is created by the first request or by warm-up
+db = LazyDatastore(initialize_db)
@@ -0,0 +1,68 @@
+# gunicorn.conf.py
+# Production serving: gunicorn -c gunicorn.conf.py app:app
+import multiprocessing
+import os
+import time
+
+bind = os.getenv('BIND', '0.0.0.0:8000')
+
+# gevent workers handle many I/O-bound requests and idle event streams per
+# process, so one worker per core is enough; WORKER_CLASS=gthread uses
+# plain threads instead
+worker_class = os.getenv('WORKER_CLASS', 'gevent')
+workers = int(os.getenv('WEB_CONCURRENCY', multiprocessing.cpu_count()))
+worker_connections = int(os.getenv('WORKER_CONNECTIONS', '1000'))
+threads = int(os.getenv('WORKER_THREADS', '8'))
+
+# The app is imported once in the master and forked into workers, so a new
+# or recycled worker starts without re-importing it. Importing creates no
+# Firestore client; each worker builds its own after forking, since gRPC
+# channels do not survive a fork. PRELOAD_APP=0 imports in every worker.
+preload_app = os.getenv('PRELOAD_APP', '1') == '1'
+if preload_app and worker_class == 'gevent':
+    # Patch before the app is imported, so the locks it creates at import
+    # are greenlet-aware in the workers
+    from gevent import monkey
+    monkey.patch_all()
+
+# Workers connect to the datastore, compile templates and fill the cache
+# before accepting connections. One that cannot reach the datastore still
+# boots, with /readyz answering 503 and retrying warm-up once the datastore
+# backoff has passed; a worker that exits during boot would make gunicorn
+# halt the whole server. WARM_UP=0 leaves all of that to the first requests.
+warm_up = os.getenv('WARM_UP', '1') == '1'
+
+timeout = int(os.getenv('WORKER_TIMEOUT', '60'))
+# In-flight requests get this long to finish on reload or shutdown
+graceful_timeout = int(os.getenv('GRACEFUL_TIMEOUT', '30'))
+keepalive = int(os.getenv('KEEPALIVE', '5'))
+# Recycle workers now and then to bound memory growth; jitter keeps them
+# from restarting together. Open event streams reconnect to another worker.
+max_requests = int(os.getenv('MAX_REQUESTS', '5000'))
+max_requests_jitter = int(os.getenv('MAX_REQUESTS_JITTER', '500'))
+
+accesslog = os.getenv('ACCESS_LOG')
+errorlog = '-'
+
+
+def post_fork(server, worker):
+    if worker_class == 'gevent':
+        # Let gRPC calls to Firestore yield to other greenlets instead of blocking the worker
+        from grpc.experimental import gevent as grpc_gevent
+        grpc_gevent.init_gevent()
+    if preload_app:
+        # Time this worker's startup from the fork; the import was paid once by the master
+        import app
+        app.startup.started = time.perf_counter()
+
+
+def post_worker_init(worker):
+    """Runs after the app is loaded and before the worker accepts connections"""
+    if warm_up:
+        import app
+        try:
+            app.startup.run_once(app.warm_up)
+        except Exception as e:
+            worker.log.error("Worker not ready, /readyz will retry warm-up: %s", e)
+            return
+        worker.log.info("Worker ready in %.0f ms", app.startup.phases['total'] * 1000)
@@ -0,0 +1,82 @@
+# http_cache.py
+import gzip
+import hashlib
+import os
+
+from flask import jsonify, request, Response
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+# Bodies smaller than this gain little from compression
+COMPRESS_MIN_SIZE = int(os.getenv('COMPRESS_MIN_SIZE', '1024'))
+GZIP_LEVEL = int(os.getenv('GZIP_LEVEL', '6'))
+BROTLI_QUALITY = int(os.getenv('BROTLI_QUALITY', '5'))
+COMPRESSIBLE_MIMETYPES = ('application/json', 'text/html', 'text/plain')
+# Private to the user, and always revalidated with the ETag before reuse
+API_CACHE_CONTROL = 'private, no-cache'
+
+
+def make_etag(*parts):
+    """Strong ETag for a representation identified by its version parts"""
+    return hashlib.sha1(repr(parts).encode()).hexdigest()
+
+
+def etag_matches(etag):
+    """Whether If-None-Match names this ETag, in any content encoding"""
+    # Compressed responses carry the ETag with an encoding suffix
+    return any(tag.split('-', 1)[0] == etag for tag in request.if_none_match.as_set())
+
+
+def conditional_json(etag, build, cache_control=API_CACHE_CONTROL):
+    """JSON from build() tagged with `etag`, or 304 when the client already has it.
+
+    build is only called when the client's copy is stale, so a revalidation
+    costs the version reads and nothing else. Without an etag the response
+    is built as usual.
+    """
+    if etag is None:
+        return jsonify(build())
+    if etag_matches(etag):
+        response = Response(status=304)
+    else:
+        response = jsonify(build())
+    response.set_etag(etag)
+    response.headers['Cache-Control'] = cache_control
+    response.vary.add('Accept-Encoding')
+    return response
+
+
+def accepted_encoding():
+    accepted = request.accept_encodings
+    if brotli is not None and accepted['br']:
+        return 'br'
+    if accepted['gzip']:
+        return 'gzip'
+    return None
+
+
+def compress_response(response):
+    """Compress a large text response with brotli or gzip when the client accepts it"""
+    if (response.status_code < 200 or response.status_code >= 300 or response.status_code == 204
+            or response.direct_passthrough or response.is_streamed
+            or response.mimetype not in COMPRESSIBLE_MIMETYPES or 'Content-Encoding' in response.headers):
+        return response
+    response.vary.add('Accept-Encoding')
+    encoding = accepted_encoding()
+    data = response.get_data()
+    if encoding is None or len(data) < COMPRESS_MIN_SIZE:
+        return response
+
+    if encoding == 'br':
+        response.set_data(brotli.compress(data, quality=BROTLI_QUALITY))
+    else:
+        response.set_data(gzip.compress(data, compresslevel=GZIP_LEVEL, mtime=0))
+    response.headers['Content-Encoding'] = encoding
+    # A strong ETag must differ between encodings of the same version
+    etag, weak = response.get_etag()
+    if etag:
+        response.set_etag(f"{etag}-{encoding}", weak)
+    return response
@@ -0,0 +1,283 @@
+# importer.py
+import csv
+import io
+import json
+import math
+import os
+import re
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+from totals import from_paise, from_rate_units, line_amount, tax_amount, to_milli, to_paise, to_rate_units
+
+IMPORT_FORMATS = ('csv', 'jsonl')
+IMPORT_COMMIT_WORKERS = int(os.getenv('IMPORT_COMMIT_WORKERS', '4'))
+# Errors listed in an import report; rows past this are only counted
+MAX_REPORTED_ERRORS = 1000
+
+EMAIL_PATTERN = re.compile(r'^[^@\s]+@[^@\s]+\.[^@\s]+$')
+CLIENT_FIELDS = ('name', 'email', 'phone', 'address', 'company')
+INVOICE_TEXT_FIELDS = ('invoiceNumber', 'clientName', 'clientEmail', 'clientPhone', 'clientAddress', 'notes')
+
+
+class ImportRowError(ValueError):
+    """Raised when a row cannot be imported"""
+
+
+def detect_format(filename=None, content_type=None):
+    """Guess the import format from a filename or content type"""
+    name = (filename or '').lower()
+    if name.endswith(('.jsonl', '.ndjson')) or 'ndjson' in (content_type or '') or 'jsonl' in (content_type or ''):
+        return 'jsonl'
+    return 'csv'
+
+
+def iter_rows(stream, fmt='csv'):
+    """Yield (line_number, row) from a binary stream without reading it all.
+
+    Rows are dicts; a line that cannot be parsed is yielded as an
+    ImportRowError instead.
+    """
+    text = io.TextIOWrapper(stream, encoding='utf-8-sig', newline='')
+    if fmt == 'jsonl':
+        for line_number, line in enumerate(text, start=1):
+            if not line.strip():
+                continue
+            try:
+                row = json.loads(line)
+            except ValueError as e:
+                yield line_number, ImportRowError(f"Invalid JSON: {e}")
+                continue
+            if not isinstance(row, dict):
+                yield line_number, ImportRowError("Expected a JSON object")
+                continue
+            yield line_number, row
+        return
+
+    reader = csv.DictReader(text)
+    for row in reader:
+        if None in row:
+            yield reader.line_num, ImportRowError("Too many columns")
+            continue
+        if not any(value and value.strip() for value in row.values()):
+            continue
+        yield reader.line_num, row
+
+
+def clean_text(value):
+    if value is None:
+        return ''
+    return str(value).strip()
+
+
+def parse_number(value, field, default=0):
+    """Parse a number from JSON or a CSV cell like '1,250.00' or '₹99'"""
+    if value is None or value == '':
+        return default
+    if isinstance(value, bool):
+        raise ImportRowError(f"Invalid {field}: {value!r}")
+    if isinstance(value, (int, float)):
+        number = value
+    else:
+        try:
+            number = float(str(value).replace(',', '').replace('₹', '').strip())
+        except ValueError:
+            raise ImportRowError(f"Invalid {field}: {value!r}")
+    if not math.isfinite(number) or number < 0:
+        raise ImportRowError(f"Invalid {field}: {value!r}")
+    return number
+
+
+def parse_email(value):
+    email = clean_text(value).lower()
+    if email and not EMAIL_PATTERN.match(email):
+        raise ImportRowError(f"Invalid email: {value!r}")
+    return email
+
+
+def parse_date(value, field):
+    """Validate a YYYY-MM-DD date, returning it as a string"""
+    date = clean_text(value)
+    if not date:
+        return ''
+    try:
+        datetime.strptime(date, '%Y-%m-%d')
+    except ValueError:
+        raise ImportRowError(f"Invalid {field} (expected YYYY-MM-DD): {value!r}")
+    return date
+
+
+def parse_client_row(row):
+    """Validate a client row, returning the client fields"""
+    client = {field: clean_text(row.get(field)) for field in CLIENT_FIELDS}
+    client['email'] = parse_email(row.get('email'))
+    if not client['name'] and not client['email']:
+        raise ImportRowError("A client needs a name or email")
+    if not client['name']:
+        client['name'] = client['email']
+    return client
+
+
+def parse_items(row):
+    """Line items from an `items` list (or JSON string), or from single item columns"""
+    items = row.get('items')
+    if isinstance(items, str) and items.strip():
+        try:
+            items = json.loads(items)
+        except ValueError:
+            raise ImportRowError("Invalid items JSON")
+    if not items:
+        items = [{
+            'description': row.get('description'),
+            'quantity': row.get('quantity'),
+            'rate': row.get('rate'),
+            'amount': row.get('amount')
+        }]
+    if not isinstance(items, list):
+        raise ImportRowError("items must be a list")
+
+    parsed = []
+    for item in items:
+        if not isinstance(item, dict):
+            raise ImportRowError("Each item must be an object")
+        description = clean_text(item.get('description'))
+        if not description:
+            raise ImportRowError("Item description is required")
+        quantity = parse_number(item.get('quantity'), 'quantity', default=1)
+        if isinstance(quantity, float) and quantity.is_integer():
+            quantity = int(quantity)
+        rate = parse_number(item.get('rate'), 'rate')
+        amount = parse_number(item.get('amount'), 'amount', default=None)
+        parsed.append({
+            'description': description,
+            'quantity': quantity,
+            'rate': rate,
+            # Historical amounts are kept as given, to the paisa
+            'amount': from_paise(line_amount(to_milli(quantity), to_paise(rate)) if amount is None
+                                 else to_paise(amount))
+        })
+    return parsed
+
+
+def parse_invoice_row(row, statuses):
+    """Validate an invoice row, returning invoice fields in the shape the app saves"""
+    invoice = {field: clean_text(row.get(field)) for field in INVOICE_TEXT_FIELDS}
+    invoice['clientEmail'] = parse_email(row.get('clientEmail'))
+    if not invoice['clientName']:
+        raise ImportRowError("clientName is required")
+
+    invoice['invoiceDate'] = parse_date(row.get('invoiceDate'), 'invoiceDate')
+    invoice['dueDate'] = parse_date(row.get('dueDate'), 'dueDate')
+
+    status = clean_text(row.get('status')).lower() or 'draft'
+    if status not in statuses:
+        raise ImportRowError(f"Invalid status: {row.get('status')!r}")
+    invoice['status'] = status
+
+    invoice['items'] = parse_items(row)
+    subtotal = parse_number(row.get('subtotal'), 'subtotal', default=None)
+    subtotal = sum(to_paise(item['amount']) for item in invoice['items']) if subtotal is None else to_paise(subtotal)
+    tax_rate = parse_number(row.get('taxRate'), 'taxRate', default=None)
+    if tax_rate is not None and row.get('tax') in (None, ''):
+        rate_units = to_rate_units(tax_rate)
+        tax = tax_amount(subtotal, rate_units)
+        invoice['taxRate'] = from_rate_units(rate_units)
+    else:
+        tax = to_paise(parse_number(row.get('tax'), 'tax'))
+    total = parse_number(row.get('total'), 'total', default=None)
+    invoice['subtotal'] = from_paise(subtotal)
+    invoice['tax'] = from_paise(tax)
+    invoice['total'] = from_paise(subtotal + tax if total is None else to_paise(total))
+
+    # Drop empty optional fields like the invoice form does
+    return {key: value for key, value in invoice.items() if value != ''}
+
+
+class ImportReport:
+    """Counts and per-line errors for one import"""
+
+    def __init__(self):
+        self.rows = 0
+        self.imported = 0
+        self.clients_created = 0
+        self.skipped = 0
+        self.failed = 0
+        self.errors = []
+        self._lock = threading.Lock()
+
+    def add_error(self, line, error):
+        with self._lock:
+            self.failed += 1
+            if len(self.errors) < MAX_REPORTED_ERRORS:
+                self.errors.append({'line': line, 'error': str(error)})
+
+    def add_committed(self, imported, clients_created):
+        with self._lock:
+            self.imported += imported
+            self.clients_created += clients_created
+
+    def to_dict(self):
+        return {
+            'rows': self.rows,
+            'imported': self.imported,
+            'clientsCreated': self.clients_created,
+            'skipped': self.skipped,
+            'failed': self.failed,
+            'errors': sorted(self.errors, key=lambda error: error['line']),
+            'errorsTruncated': self.failed > len(self.errors)
+        }
+
+
+class BatchCommitter:
+    """Commits write batches on a few threads while the next batch is built.
+
+    At most `workers * 2` batches are pending, so memory stays bounded on
+    large files. A failed commit marks every line in that batch as failed;
+    a successful one passes the batch's counts to report.add_committed()
+    and then calls its on_commit callback. A batch that writes to documents
+    an earlier batch creates is submitted `after` it, and only commits once
+    that batch has, failing if it failed.
+    """
+
+    def __init__(self, report, workers=IMPORT_COMMIT_WORKERS):
+        self.report = report
+        self.max_pending = max(workers, 1) * 2
+        self._executor = ThreadPoolExecutor(max_workers=max(workers, 1), thread_name_prefix='import-commit')
+        self._pending = []
+
+    def submit(self, batch, lines, *counts, on_commit=None, after=()):
+        """Queue a batch for commit, returning a handle for later batches' `after`"""
+        if len(self._pending) >= self.max_pending:
+            self._finish(self._pending.pop(0))
+        future = self._executor.submit(self._commit, batch, list(after))
+        self._pending.append((future, lines, counts, on_commit))
+        return future
+
+    @staticmethod
+    def _commit(batch, after):
+        # Earlier batches were queued first, so they are running or done
+        for earlier in after:
+            if earlier.exception() is not None:
+                raise RuntimeError("an earlier batch it depends on failed")
+        return batch.commit()
+
+    def _finish(self, pending):
+        future, lines, counts, on_commit = pending
+        try:
+            future.result()
+        except Exception as e:
+            for line in lines:
+                self.report.add_error(line, f"Write failed: {e}")
+            return
+        self.report.add_committed(*counts)
+        if on_commit:
+            on_commit()
+
+    def close(self):
+        """Wait for all pending commits"""
+        try:
+            while self._pending:
+                self._finish(self._pending.pop(0))
+        finally:
+            self._executor.shutdown()
@@ -0,0 +1,276 @@
+# metrics.py
+import contextvars
+import logging
+import threading
+import time
+from bisect import bisect_left
+from functools import wraps
+
+logger = logging.getLogger('nayapaisa.requests')
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+# Document reads per request; a route in the high buckets is probably reading N+1
+READ_BUCKETS = (0, 1, 2, 5, 10, 25, 50, 100, 250, 500, 1000)
+
+
+def format_labels(labelnames, values, extra=None):
+    pairs = list(zip(labelnames, values)) + ([extra] if extra else [])
+    if not pairs:
+        return ''
+    escaped = (str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for _, value in pairs)
+    return '{' + ','.join(f'{name}="{value}"' for (name, _), value in zip(pairs, escaped)) + '}'
+
+
+def format_number(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) and not value.is_integer() else str(int(value))
+
+
+class Counter:
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = labelnames
+        self.values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1, **labels):
+        key = tuple(labels[name] for name in self.labelnames)
+        with self._lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} counter"]
+        with self._lock:
+            for key, value in sorted(self.values.items()):
+                lines.append(f"{self.name}{format_labels(self.labelnames, key)} {format_number(value)}")
+        return lines
+
+
+class Histogram:
+    def __init__(self, name, documentation, labelnames=(), buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = labelnames
+        self.buckets = tuple(buckets)
+        self.values = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value, **labels):
+        key = tuple(labels[name] for name in self.labelnames)
+        with self._lock:
+            counts, total = self.values.get(key, ([0] * (len(self.buckets) + 1), 0))
+            counts[bisect_left(self.buckets, value)] += 1
+            self.values[key] = (counts, total + value)
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            for key, (counts, total) in sorted(self.values.items()):
+                cumulative = 0
+                for bound, count in zip(self.buckets + (float('inf'),), counts):
+                    cumulative += count
+                    labels = format_labels(self.labelnames, key, ('le', format_number(bound)))
+                    lines.append(f"{self.name}_bucket{labels} {cumulative}")
+                labels = format_labels(self.labelnames, key)
+                lines.append(f"{self.name}_sum{labels} {format_number(total)}")
+                lines.append(f"{self.name}_count{labels} {cumulative}")
+        return lines
+
+
+http_requests = Counter('nayapaisa_http_requests_total', 'HTTP requests handled',
+                        ('method', 'route', 'status'))
+http_duration = Histogram('nayapaisa_http_request_duration_seconds', 'Time to handle a request, including streaming',
+                          ('method', 'route'))
+datastore_reads = Counter('nayapaisa_datastore_reads_total', 'Documents read from the datastore', ('route',))
+datastore_writes = Counter('nayapaisa_datastore_writes_total', 'Documents written to the datastore', ('route',))
+reads_per_request = Histogram('nayapaisa_datastore_reads_per_request', 'Documents read while handling one request',
+                              ('route',), READ_BUCKETS)
+template_render = Histogram('nayapaisa_template_render_seconds', 'Time to render a template', ('template',))
+
+METRICS = [http_requests, http_duration, datastore_reads, datastore_writes, reads_per_request, template_render]
+
+
+class RequestMetrics:
+    """Counters for the request being handled"""
+
+    def __init__(self, method, route):
+        self.method = method
+        self.route = route
+        self.started = time.perf_counter()
+        self.reads = 0
+        self.writes = 0
+        self.render_seconds = 0.0
+        # Reads for one request can run on several threads at once
+        self._lock = threading.Lock()
+
+    def add(self, reads=0, writes=0):
+        with self._lock:
+            self.reads += reads
+            self.writes += writes
+
+
+_current = contextvars.ContextVar('request_metrics', default=None)
+_templates = threading.local()
+
+
+def start_request(method, route):
+    request_metrics = RequestMetrics(method, route)
+    _current.set(request_metrics)
+    return request_metrics
+
+
+def end_request_context():
+    _current.set(None)
+
+
+def finish_request(request_metrics, status):
+    """Record a finished request and log one line describing it"""
+    duration = time.perf_counter() - request_metrics.started
+    http_requests.inc(method=request_metrics.method, route=request_metrics.route, status=str(status))
+    http_duration.observe(duration, method=request_metrics.method, route=request_metrics.route)
+    reads_per_request.observe(request_metrics.reads, route=request_metrics.route)
+    logger.info("method=%s route=%s status=%s duration_ms=%.1f reads=%d writes=%d render_ms=%.1f",
+                request_metrics.method, request_metrics.route, status, duration * 1000,
+                request_metrics.reads, request_metrics.writes, request_metrics.render_seconds * 1000)
+
+
+def record_reads(count=1):
+    """Count documents read, against the current request's route"""
+    request_metrics = _current.get()
+    if request_metrics:
+        request_metrics.add(reads=count)
+    datastore_reads.inc(count, route=request_metrics.route if request_metrics else 'background')
+
+
+def record_writes(count=1):
+    request_metrics = _current.get()
+    if request_metrics:
+        request_metrics.add(writes=count)
+    datastore_writes.inc(count, route=request_metrics.route if request_metrics else 'background')
+
+
+def start_template(name):
+    if not hasattr(_templates, 'started'):
+        _templates.started = []
+    _templates.started.append((name, time.perf_counter()))
+
+
+def finish_template(name):
+    started = getattr(_templates, 'started', None)
+    # Drop timers left behind by templates that raised while rendering
+    while started and started[-1][0] != name:
+        started.pop()
+    if not started:
+        return
+    _, began = started.pop()
+    elapsed = time.perf_counter() - began
+    template_render.observe(elapsed, template=name or 'string')
+    request_metrics = _current.get()
+    if request_metrics:
+        request_metrics.render_seconds += elapsed
+
+
+def render_metrics(cache_stats=None, event_stats=None, startup_stats=None):
+    """All metrics in the Prometheus text exposition format"""
+    lines = []
+    for metric in METRICS:
+        lines.extend(metric.render())
+    if cache_stats:
+        hits, misses = cache_stats.get('hits', 0), cache_stats.get('misses', 0)
+        backend = cache_stats.get('backend', 'memory')
+        for name, kind, value, documentation in (
+            ('nayapaisa_cache_hits_total', 'counter', hits, 'Cache lookups that found an entry'),
+            ('nayapaisa_cache_misses_total', 'counter', misses, 'Cache lookups that missed'),
+            ('nayapaisa_cache_hit_ratio', 'gauge', hits / (hits + misses) if hits + misses else 0,
+             'Share of cache lookups that hit since start'),
+            ('nayapaisa_cache_entries', 'gauge', cache_stats.get('size', 0), 'Entries in the cache'),
+        ):
+            lines.append(f"# HELP {name} {documentation}")
+            lines.append(f"# TYPE {name} {kind}")
+            lines.append(f"{name}{format_labels(('backend',), (backend,))} {format_number(value)}")
+    if event_stats:
+        for name, kind, value, documentation in (
+            ('nayapaisa_event_streams', 'gauge', event_stats.get('streams', 0), 'Open Server-Sent Events streams'),
+            ('nayapaisa_events_published_total', 'counter', event_stats.get('published', 0),
+             'Change events published to streams'),
+            ('nayapaisa_event_stream_resets_total', 'counter', event_stats.get('resets', 0),
+             'Streams told to reload after falling behind'),
+        ):
+            lines.append(f"# HELP {name} {documentation}")
+            lines.append(f"# TYPE {name} {kind}")
+            lines.append(f"{name} {format_number(value)}")
+    if startup_stats:
+        lines.append("# HELP nayapaisa_ready Whether this process has warmed up and takes traffic")
+        lines.append("# TYPE nayapaisa_ready gauge")
+        lines.append(f"nayapaisa_ready {int(startup_stats.get('ready', False))}")
+        lines.append("# HELP nayapaisa_startup_phase_seconds Time spent in each startup phase")
+        lines.append("# TYPE nayapaisa_startup_phase_seconds gauge")
+        for phase, seconds in startup_stats.get('phases', {}).items():
+            lines.append(f"nayapaisa_startup_phase_seconds{format_labels(('phase',), (phase,))} "
+                         f"{format_number(seconds)}")
+    return '\n'.join(lines) + '\n'
+
+
+def counting_generator(iterable):
+    """Yield from `iterable`, counting one read per document (and at least one per query)"""
+    count = 0
+    try:
+        for item in iterable:
+            count += 1
+            yield item
+    finally:
+        record_reads(max(count, 1))
+
+
+_firestore_instrumented = False
+
+
+def instrument_firestore():
+    """Count reads and writes made through the Firestore client library.
+
+    Patches the client classes once per process, since the app's helpers
+    create references and queries all over the place.
+    """
+    global _firestore_instrumented
+    if _firestore_instrumented:
+        return
+    _firestore_instrumented = True
+
+    from google.cloud.firestore_v1 import aggregation, batch, client, document, query, transaction
+
+    def wrap(cls, name, wrapper):
+        original = getattr(cls, name)
+        setattr(cls, name, wraps(original)(wrapper(original)))
+
+    def counted_get(original):
+        def get(self, *args, **kwargs):
+            record_reads(1)
+            return original(self, *args, **kwargs)
+        return get
+
+    def counted_stream(original):
+        def stream(self, *args, **kwargs):
+            return counting_generator(original(self, *args, **kwargs))
+        return stream
+
+    def counted_get_all(original):
+        def get_all(self, references, *args, **kwargs):
+            references = list(references)
+            record_reads(len(references))
+            return original(self, references, *args, **kwargs)
+        return get_all
+
+    def counted_commit(original):
+        def commit(self, *args, **kwargs):
+            record_writes(len(getattr(self, '_write_pbs', None) or []))
+            return original(self, *args, **kwargs)
+        return commit
+
+    wrap(document.DocumentReference, 'get', counted_get)
+    wrap(aggregation.AggregationQuery, 'get', counted_get)
+    wrap(query.Query, 'stream', counted_stream)
+    wrap(client.Client, 'get_all', counted_get_all)
+    wrap(batch.WriteBatch, 'commit', counted_commit)
+    wrap(transaction.Transaction, '_commit', counted_commit)
@@ -0,0 +1,140 @@
+# numbering.py
+import os
+import threading
+from datetime import datetime
+
+from storage import transactional
+
+COUNTER_COLLECTION = 'invoice_counters'
+INVOICE_NUMBER_SERIES = os.getenv('INVOICE_NUMBER_SERIES', 'INV')
+# 1 keeps numbers gap-free; larger blocks trade possible gaps for fewer counter writes
+INVOICE_NUMBER_BLOCK_SIZE = int(os.getenv('INVOICE_NUMBER_BLOCK_SIZE', '1'))
+# Indian fiscal years run April to March
+FISCAL_YEAR_START_MONTH = int(os.getenv('FISCAL_YEAR_START_MONTH', '4'))
+
+
+def fiscal_year(date):
+    """Fiscal year label for a date, e.g. '2526' for April 2025 - March 2026"""
+    start = date.year if date.month >= FISCAL_YEAR_START_MONTH else date.year - 1
+    if FISCAL_YEAR_START_MONTH == 1:
+        return str(start)
+    return f"{start % 100:02d}{(start + 1) % 100:02d}"
+
+
+def invoice_date(invoice_data):
+    """The date an invoice is numbered under: its invoiceDate, else its creation time"""
+    try:
+        return datetime.strptime(invoice_data.get('invoiceDate') or '', '%Y-%m-%d')
+    except ValueError:
+        return invoice_data.get('createdAt') or datetime.now()
+
+
+def format_invoice_number(series, year, number):
+    return f"{series}-{year}-{number:05d}"
+
+
+def advance_counter(transaction, counter_ref, count):
+    """Advance a counter by `count` within a transaction, returning the first number reserved"""
+    snapshot = counter_ref.get(transaction=transaction)
+    next_number = snapshot.to_dict().get('next', 1) if snapshot.exists else 1
+    transaction.set(counter_ref, {'next': next_number + count, 'updatedAt': datetime.now()}, merge=True)
+    return next_number
+
+
+@transactional
+def reserve_numbers_in_transaction(transaction, counter_ref, count):
+    return advance_counter(transaction, counter_ref, count)
+
+
+def assign_numbers(by_sequence, starts):
+    """Number each sequence's invoices in order from its reserved start"""
+    for key, invoices in by_sequence.items():
+        _, series, year = key
+        for offset, invoice_data in enumerate(invoices):
+            invoice_data['invoiceNumber'] = format_invoice_number(series, year, starts[key] + offset)
+
+
+class InvoiceNumberAllocator:
+    """Sequential invoice numbers per user, series and fiscal year.
+
+    Each sequence is one document in invoice_counters. With a block size of
+    1, next_in_transaction() numbers an invoice inside the transaction that
+    writes it, so numbers are unique and gap-free; number_in_transaction()
+    does the same for many invoices. For high write rates, allocate()
+    reserves `block_size` numbers per counter write and hands them out from
+    memory; numbers left in a block when the process exits are skipped. A
+    block is only gap-free when sized to exactly the invoices it numbers,
+    as reserve() does, and their write commits.
+    """
+
+    def __init__(self, db, block_size=INVOICE_NUMBER_BLOCK_SIZE, series=INVOICE_NUMBER_SERIES):
+        self.db = db
+        self.block_size = max(block_size, 1)
+        self.series = series
+        self._blocks = {}
+        self._lock = threading.Lock()
+
+    def counter_ref(self, user_id, series, year):
+        counter_id = f"{user_id or 'default'}:{series}:{year}".replace('/', '_')
+        return self.db.collection(COUNTER_COLLECTION).document(counter_id)
+
+    def sequence(self, invoice_data, user_id):
+        series = invoice_data.get('series') or self.series
+        return user_id, series, fiscal_year(invoice_date(invoice_data))
+
+    def next_in_transaction(self, transaction, invoice_data, user_id=None):
+        """Reserve the next number within the caller's transaction (call before any writes)"""
+        user_id, series, year = self.sequence(invoice_data, user_id)
+        number = advance_counter(transaction, self.counter_ref(user_id, series, year), 1)
+        return format_invoice_number(series, year, number)
+
+    def group_by_sequence(self, invoices):
+        """{sequence: [invoice_data]} for (invoice_data, user_id) pairs, keeping their order"""
+        by_sequence = {}
+        for invoice_data, user_id in invoices:
+            by_sequence.setdefault(self.sequence(invoice_data, user_id), []).append(invoice_data)
+        return by_sequence
+
+    def number_in_transaction(self, transaction, invoices):
+        """Number (invoice_data, user_id) pairs within the caller's transaction.
+
+        Reserves exactly as many numbers as invoices, so a failed commit
+        gives none out. Reads every counter before writing any, so call it
+        after the transaction's other reads and before its writes.
+        """
+        by_sequence = self.group_by_sequence(invoices)
+        refs = {key: self.counter_ref(*key) for key in by_sequence}
+        counters = {snapshot.id: snapshot
+                    for snapshot in self.db.get_all(list(refs.values()), transaction=transaction)}
+        starts = {}
+        for key, ref in refs.items():
+            snapshot = counters.get(ref.id)
+            starts[key] = snapshot.to_dict().get('next', 1) if snapshot and snapshot.exists else 1
+            transaction.set(ref, {'next': starts[key] + len(by_sequence[key]), 'updatedAt': datetime.now()},
+                            merge=True)
+        assign_numbers(by_sequence, starts)
+
+    def reserve(self, invoices):
+        """Number (invoice_data, user_id) pairs with one block per sequence, sized to exactly its invoices.
+
+        The numbers are taken before the invoices are written, so they are
+        skipped if that write fails.
+        """
+        by_sequence = self.group_by_sequence(invoices)
+        starts = {key: reserve_numbers_in_transaction(self.db.transaction(), self.counter_ref(*key), len(numbered))
+                  for key, numbered in by_sequence.items()}
+        assign_numbers(by_sequence, starts)
+
+    def allocate(self, invoice_data, user_id=None):
+        """Take the next number from this process's block, reserving a new block when empty"""
+        user_id, series, year = self.sequence(invoice_data, user_id)
+        key = (user_id, series, year)
+        with self._lock:
+            block = self._blocks.get(key)
+            if not block or block[0] >= block[1]:
+                start = reserve_numbers_in_transaction(self.db.transaction(), self.counter_ref(*key),
+                                                       self.block_size)
+                block = self._blocks[key] = [start, start + self.block_size]
+            number = block[0]
+            block[0] += 1
+        return format_invoice_number(series, year, number)
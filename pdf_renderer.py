@@ -0,0 +1,179 @@
+# pdf_renderer.py
+import glob
+import hashlib
+import multiprocessing
+import os
+import tempfile
+import threading
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+
+PDF_ENGINE = os.getenv('PDF_ENGINE', 'weasyprint')
+PDF_RENDER_WORKERS = int(os.getenv('PDF_RENDER_WORKERS', '2'))
+PDF_RENDER_TIMEOUT = int(os.getenv('PDF_RENDER_TIMEOUT', '30'))
+PDF_CACHE_DIR = os.getenv('PDF_CACHE_DIR', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'pdf_cache'))
+
+# Renders allowed to wait for a worker before new requests are turned away
+MAX_QUEUED_RENDERS = PDF_RENDER_WORKERS * 4
+
+
+class PdfRendererBusy(Exception):
+    """Raised when too many renders are already queued"""
+
+
+_executor = None
+_executor_lock = threading.Lock()
+_queue_slots = threading.BoundedSemaphore(MAX_QUEUED_RENDERS)
+_inflight = {}
+_inflight_lock = threading.Lock()
+
+
+def html_to_pdf(html, engine=PDF_ENGINE):
+    """Convert an HTML document to PDF bytes (runs in a worker process)"""
+    if engine == 'pdfkit':
+        import pdfkit
+        return pdfkit.from_string(html, False)
+
+    from weasyprint import HTML
+    return HTML(string=html).write_pdf()
+
+
+def get_executor():
+    """Process pool for rendering, created on first use.
+
+    Workers are spawned rather than forked, since forking a process that
+    holds an open Firestore gRPC channel is unsafe.
+    """
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = ProcessPoolExecutor(max_workers=PDF_RENDER_WORKERS,
+                                            mp_context=multiprocessing.get_context('spawn'))
+        return _executor
+
+
+def cached_pdf_path(invoice_id, html):
+    """Cache file for an invoice, keyed by a hash of its rendered HTML"""
+    content_hash = hashlib.sha256(html.encode()).hexdigest()[:16]
+    return os.path.join(PDF_CACHE_DIR, f"{invoice_id}-{content_hash}.pdf")
+
+
+def invalidate_invoice_pdf(invoice_id, keep=None):
+    """Delete cached PDFs for an invoice, except the `keep` path"""
+    for path in glob.glob(os.path.join(PDF_CACHE_DIR, f"{glob.escape(invoice_id)}-*.pdf")):
+        if path != keep:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+
+def write_cache_file(path, pdf_bytes):
+    """Write a cache file atomically so readers never see a partial PDF"""
+    os.makedirs(PDF_CACHE_DIR, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=PDF_CACHE_DIR, suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(pdf_bytes)
+        os.replace(tmp_path, path)
+    except Exception:
+        os.remove(tmp_path)
+        raise
+
+
+def render_pdf_in_pool(html):
+    """Render HTML on the process pool, bounded by the render queue"""
+    if not _queue_slots.acquire(timeout=PDF_RENDER_TIMEOUT):
+        raise PdfRendererBusy("PDF renderer is busy")
+    try:
+        future = get_executor().submit(html_to_pdf, html)
+        return future.result(timeout=PDF_RENDER_TIMEOUT)
+    finally:
+        _queue_slots.release()
+
+
+def render_invoice_pdf(invoice_id, html):
+    """Return the path of the PDF for an invoice's rendered HTML.
+
+    An unchanged invoice is served from the disk cache. Any edit changes
+    the HTML and therefore the cache key, and older files for the invoice
+    are removed once the new one is written. Concurrent requests for the
+    same document share a single render.
+    """
+    path = cached_pdf_path(invoice_id, html)
+    if os.path.exists(path):
+        return path
+
+    with _inflight_lock:
+        event = _inflight.get(path)
+        owner = event is None
+        if owner:
+            event = _inflight[path] = threading.Event()
+
+    if not owner:
+        event.wait(PDF_RENDER_TIMEOUT)
+        if os.path.exists(path):
+            return path
+        raise RuntimeError("PDF render failed")
+
+    try:
+        write_cache_file(path, render_pdf_in_pool(html))
+        invalidate_invoice_pdf(invoice_id, keep=path)
+        return path
+    finally:
+        with _inflight_lock:
+            _inflight.pop(path, None)
+        event.set()
+
+
+def render_invoice_pdfs(jobs, window=None):
+    """Render many invoices in parallel, yielding results as they finish.
+
+    `jobs` yields (invoice_id, html, name) and is consumed lazily, so at most
+    `window` renders are in flight at once. Yields (name, path, error) with
+    path None and error set when a render fails. Cached PDFs are yielded
+    without rendering.
+    """
+    window = window or PDF_RENDER_WORKERS * 2
+    executor = get_executor()
+    pending = {}
+    jobs = iter(jobs)
+    exhausted = False
+
+    try:
+        while pending or not exhausted:
+            while not exhausted and len(pending) < window:
+                try:
+                    invoice_id, html, name = next(jobs)
+                except StopIteration:
+                    exhausted = True
+                    break
+                path = cached_pdf_path(invoice_id, html)
+                if os.path.exists(path):
+                    yield name, path, None
+                    continue
+                pending[executor.submit(html_to_pdf, html)] = (invoice_id, path, name)
+
+            if not pending:
+                continue
+
+            done, _ = wait(pending, timeout=PDF_RENDER_TIMEOUT, return_when=FIRST_COMPLETED)
+            if not done:
+                # Nothing finished in time; give up on the whole window
+                for future, (invoice_id, path, name) in pending.items():
+                    future.cancel()
+                    yield name, None, "Timed out rendering PDF"
+                pending = {}
+                continue
+
+            for future in done:
+                invoice_id, path, name = pending.pop(future)
+                try:
+                    write_cache_file(path, future.result())
+                    invalidate_invoice_pdf(invoice_id, keep=path)
+                    yield name, path, None
+                except Exception as e:
+                    yield name, None, str(e)
+    finally:
+        # Stop queued renders if the consumer went away (e.g. client disconnect)
+        for future in pending:
+            future.cancel()
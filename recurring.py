@@ -0,0 +1,186 @@
+# recurring.py
+import threading
+from calendar import monthrange
+from datetime import date, datetime, timedelta
+
+RECURRING_COLLECTION = 'recurring_invoices'
+# Months between runs; weekly templates step by days instead
+FREQUENCY_MONTHS = {'monthly': 1, 'quarterly': 3, 'yearly': 12}
+FREQUENCIES = ('weekly',) + tuple(FREQUENCY_MONTHS)
+RECURRING_STATUSES = ('active', 'paused', 'ended')
+DEFAULT_DUE_DAYS = 15
+MAX_DUE_DAYS = 365
+# Missed periods one run catches up per template, e.g. after the scheduler was down
+MAX_CATCH_UP_PERIODS = 12
+# Errors listed in a run report; the rest are only counted
+MAX_REPORTED_ERRORS = 1000
+CLIENT_FIELDS = ('clientName', 'clientEmail', 'clientPhone', 'clientAddress')
+TEXT_FIELDS = CLIENT_FIELDS + ('clientId', 'notes', 'series')
+
+
+def parse_run_date(value, field='date'):
+    """A date from a YYYY-MM-DD string"""
+    if isinstance(value, date) and not isinstance(value, datetime):
+        return value
+    try:
+        return datetime.strptime(str(value or '').strip(), '%Y-%m-%d').date()
+    except ValueError:
+        raise ValueError(f"Invalid {field}: {value!r}")
+
+
+def nth_run_date(frequency, start, n):
+    """The n-th run after `start` (n=0 is start itself).
+
+    Monthly runs keep the start's day of the month, moved back to the last
+    day in shorter months, so a template started on the 31st runs on
+    Feb 28 and then Mar 31 rather than drifting to the 28th.
+    """
+    if frequency == 'weekly':
+        return start + timedelta(weeks=n)
+    months = start.month - 1 + n * FREQUENCY_MONTHS[frequency]
+    year, month = start.year + months // 12, months % 12 + 1
+    return date(year, month, min(start.day, monthrange(year, month)[1]))
+
+
+def next_run_date(frequency, start, after=None, end=None):
+    """First run on or after `start` and strictly after `after`, or None past `end`"""
+    n = 0
+    if after is not None and after >= start:
+        if frequency == 'weekly':
+            n = (after - start).days // 7
+        else:
+            n = ((after.year - start.year) * 12 + after.month - start.month) // FREQUENCY_MONTHS[frequency]
+        while nth_run_date(frequency, start, n) <= after:
+            n += 1
+    run_date = nth_run_date(frequency, start, n)
+    if end is not None and run_date > end:
+        return None
+    return run_date
+
+
+def due_run_dates(template, until, limit=MAX_CATCH_UP_PERIODS):
+    """Run dates of an active template that are due on or before `until`, oldest first"""
+    if template.get('status', 'active') != 'active' or not template.get('nextRunDate'):
+        return []
+    frequency = template['frequency']
+    start = parse_run_date(template['startDate'])
+    end = parse_run_date(template['endDate']) if template.get('endDate') else None
+    run_dates = []
+    run_date = parse_run_date(template['nextRunDate'])
+    while run_date is not None and run_date <= until and len(run_dates) < limit:
+        run_dates.append(run_date)
+        run_date = next_run_date(frequency, start, run_date, end)
+    return run_dates
+
+
+def parse_template(data, existing=None):
+    """Validate a recurring invoice template from JSON, merged over `existing` on update.
+
+    Returns the fields to store; raises ValueError with a message for the
+    client. Line items and tax are checked separately by compute_totals.
+    """
+    if not isinstance(data, dict):
+        raise ValueError("Expected a JSON object")
+    template = {**(existing or {}), **{key: value for key, value in data.items()
+                                       if key in TEXT_FIELDS + ('frequency', 'startDate', 'endDate', 'dueDays',
+                                                                'autoSend', 'items', 'taxRate', 'tax')}}
+    for field in TEXT_FIELDS:
+        if field in template:
+            template[field] = str(template[field] or '').strip()
+    if not template.get('clientId'):
+        template.pop('clientId', None)
+    if not template.get('clientName') or not template.get('clientEmail'):
+        raise ValueError("clientName and clientEmail are required")
+    if template.get('frequency') not in FREQUENCIES:
+        raise ValueError(f"frequency must be one of {', '.join(FREQUENCIES)}")
+    if not isinstance(template.get('items'), list) or not template['items']:
+        raise ValueError("At least one item is required")
+
+    start = parse_run_date(template.get('startDate') or date.today(), 'startDate')
+    template['startDate'] = start.isoformat()
+    if template.get('endDate'):
+        end = parse_run_date(template['endDate'], 'endDate')
+        if end < start:
+            raise ValueError("endDate is before startDate")
+        template['endDate'] = end.isoformat()
+    else:
+        template.pop('endDate', None)
+
+    due_days = template.get('dueDays')
+    try:
+        due_days = DEFAULT_DUE_DAYS if due_days in (None, '') else int(due_days)
+    except (TypeError, ValueError):
+        raise ValueError(f"Invalid dueDays: {due_days!r}")
+    if not 0 <= due_days <= MAX_DUE_DAYS:
+        raise ValueError(f"dueDays must be between 0 and {MAX_DUE_DAYS}")
+    template['dueDays'] = due_days
+    template['autoSend'] = bool(template.get('autoSend'))
+    return template
+
+
+def schedule_changed(template, existing):
+    return any(template.get(field) != existing.get(field) for field in ('frequency', 'startDate', 'endDate'))
+
+
+def recurring_invoice_id(template_id, run_date):
+    """Invoice id for one period of a template, so a period can only be generated once"""
+    return f"{template_id}-{run_date.isoformat()}"
+
+
+def build_recurring_invoice(template, run_date, totals, client=None):
+    """Invoice data for one run of a template, with the client's current details when it still exists"""
+    invoice = {field: template[field] for field in CLIENT_FIELDS + ('notes', 'series') if template.get(field)}
+    if client:
+        invoice.update({field: client[key] for field, key in (('clientName', 'name'), ('clientEmail', 'email'),
+                                                              ('clientPhone', 'phone'), ('clientAddress', 'address'))
+                        if client.get(key)})
+        invoice['clientId'] = client['id']
+    due_date = run_date + timedelta(days=template.get('dueDays', DEFAULT_DUE_DAYS))
+    return {
+        'status': 'draft',
+        **invoice,
+        **totals,
+        'invoiceDate': run_date.isoformat(),
+        'dueDate': due_date.isoformat(),
+        'recurringId': template['id'],
+        'recurringPeriod': run_date.isoformat()
+    }
+
+
+class RecurringReport:
+    """Counts and per-template errors for one scheduler run"""
+
+    def __init__(self, run_date, dry_run=False):
+        self.run_date = run_date
+        self.dry_run = dry_run
+        self.templates = 0
+        self.generated = 0
+        self.queued = 0
+        self.skipped = 0
+        self.failed = 0
+        self.errors = []
+        self._lock = threading.Lock()
+
+    def add_error(self, template_id, error):
+        with self._lock:
+            self.failed += 1
+            if len(self.errors) < MAX_REPORTED_ERRORS:
+                self.errors.append({'templateId': template_id, 'error': str(error)})
+
+    def add_committed(self, generated, queued):
+        with self._lock:
+            self.generated += generated
+            self.queued += queued
+
+    def to_dict(self):
+        return {
+            'runDate': self.run_date.isoformat(),
+            'dryRun': self.dry_run,
+            'templates': self.templates,
+            'generated': self.generated,
+            'queued': self.queued,
+            'skipped': self.skipped,
+            'failed': self.failed,
+            'errors': self.errors,
+            'errorsTruncated': self.failed > len(self.errors)
+        }
@@ -0,0 +1,91 @@
+# search.py
+import re
+
+# Longest indexed prefix of a word
+MAX_SEARCH_TOKEN_LENGTH = 15
+
+INVOICE_SEARCH_COLLECTION = 'invoice_search'
+# Invoice fields copied to its search entry, which results are filtered,
+# ranked and listed from without reading the invoices
+INVOICE_SEARCH_FIELDS = ('invoiceNumber', 'clientName', 'clientEmail', 'status', 'total',
+                         'invoiceDate', 'dueDate', 'createdAt')
+# Line item text kept on an entry for ranking and result snippets
+MAX_INDEXED_DESCRIPTION_LENGTH = 500
+# Single characters match too much to be worth indexing on invoices
+MIN_INVOICE_TOKEN_LENGTH = 2
+
+
+def search_terms(text):
+    """Split text into lowercase alphanumeric words"""
+    return re.findall(r'[a-z0-9]+', str(text or '').lower())
+
+
+def prefix_tokens(words, min_length=1):
+    """Every prefix of each word, from `min_length` up to MAX_SEARCH_TOKEN_LENGTH characters"""
+    tokens = set()
+    for word in words:
+        for length in range(min_length, min(len(word), MAX_SEARCH_TOKEN_LENGTH) + 1):
+            tokens.add(word[:length])
+    return sorted(tokens)
+
+
+def invoice_number_terms(number):
+    """Words of an invoice number, plus the whole number so 'INV-2526-00042' matches 'inv252600042'"""
+    words = search_terms(number)
+    return words + [''.join(words)] if len(words) > 1 else words
+
+
+def item_descriptions(invoice):
+    items = invoice.get('items') if isinstance(invoice.get('items'), list) else []
+    text = ' '.join(str(item.get('description') or '').strip() for item in items if isinstance(item, dict))
+    return ' '.join(text.split())[:MAX_INDEXED_DESCRIPTION_LENGTH]
+
+
+def build_invoice_search_entry(invoice):
+    """Search entry for an invoice: prefix tokens of its number, client name and
+    email and line item descriptions, with the fields results need.
+
+    Entries live in their own collection, keyed by invoice id, so an
+    array_contains query on searchTokens is an inverted index lookup and
+    invoices themselves carry no tokens.
+    """
+    entry = {field: invoice[field] for field in INVOICE_SEARCH_FIELDS if invoice.get(field) is not None}
+    descriptions = item_descriptions(invoice)
+    if descriptions:
+        entry['descriptions'] = descriptions
+    words = (invoice_number_terms(invoice.get('invoiceNumber')) + search_terms(invoice.get('clientName'))
+             + search_terms(invoice.get('clientEmail')) + search_terms(descriptions))
+    entry['searchTokens'] = prefix_tokens(words, MIN_INVOICE_TOKEN_LENGTH)
+    return entry
+
+
+def score_invoice_match(entry, terms):
+    """Rank a search entry for a query, or return 0 if any term does not match.
+
+    Invoice numbers rank above client names, then emails, then line items;
+    whole-word matches rank above prefixes.
+    """
+    number_words = invoice_number_terms(entry.get('invoiceNumber'))
+    name_words = search_terms(entry.get('clientName'))
+    email_words = search_terms(entry.get('clientEmail'))
+    description_words = search_terms(entry.get('descriptions'))
+
+    score = 0
+    for term in terms:
+        if term in number_words:
+            score += 8
+        elif any(word.startswith(term) for word in number_words):
+            score += 5
+        elif term in name_words:
+            score += 4
+        elif any(word.startswith(term) for word in name_words):
+            score += 3
+        elif any(word.startswith(term) for word in email_words):
+            score += 2
+        elif term in description_words:
+            score += 2
+        elif any(word.startswith(term) for word in description_words):
+            score += 1
+        else:
+            return 0
+    return score
@@ -0,0 +1,53 @@
+# startup.py
+import logging
+import threading
+import time
+from contextlib import contextmanager
+
+logger = logging.getLogger(__name__)
+
+
+class Startup:
+    """How long this process took to start, phase by phase, and whether it is ready for traffic"""
+
+    def __init__(self, started=None):
+        self.started = time.perf_counter() if started is None else started
+        self.phases = {}
+        self.ready = False
+        self.error = None
+        self._lock = threading.Lock()
+
+    def record(self, name, seconds):
+        self.phases[name] = seconds
+        logger.info("Startup phase %s took %.1f ms", name, seconds * 1000)
+
+    @contextmanager
+    def phase(self, name):
+        """Time a block as a startup phase"""
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(name, time.perf_counter() - started)
+
+    def run_once(self, warm_up):
+        """Run warm_up() unless this process is already ready, marking it ready when it succeeds.
+
+        Failures are recorded for the readiness probe and re-raised, so the
+        caller can log them; the next call tries again.
+        """
+        with self._lock:
+            if self.ready:
+                return
+            try:
+                warm_up()
+            except Exception as e:
+                self.error = str(e)
+                raise
+            self.error = None
+            self.ready = True
+            self.record('total', time.perf_counter() - self.started)
+
+    def stats(self):
+        return {'ready': self.ready, 'error': self.error,
+                'phases': {name: round(seconds, 4) for name, seconds in self.phases.items()}}
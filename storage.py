@@ -0,0 +1,886 @@
+# storage.py
+import base64
+import copy
+import json
+import logging
+import os
+import sqlite3
+import threading
+import uuid
+from contextlib import contextmanager
+from datetime import datetime, timezone
+from functools import cmp_to_key, wraps
+
+from firebase_admin import firestore
+from google.api_core.exceptions import AlreadyExists, NotFound
+from google.cloud.firestore_v1.watch import ChangeType, DocumentChange
+
+from metrics import counting_generator, record_reads, record_writes
+
+logger = logging.getLogger(__name__)
+
+STORAGE_BACKEND = os.getenv('STORAGE_BACKEND', 'firestore')
+SQLITE_PATH = os.getenv('SQLITE_PATH', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'nayapaisa.db'))
+
+# Expression indexes created with each SQLite table, matching the queries the app runs
+SQLITE_INDEXES = {
+    'invoices': [
+        ('createdAt',),
+        ('status', 'createdAt'),
+        ('clientEmail', 'createdAt'),
+        ('clientId', 'createdAt'),
+        ('clientId', 'status', 'createdAt'),
+        ('dueAt',),
+        ('status', 'dueAt'),
+        ('userId', 'status', 'dueAt'),
+        ('updatedAt',),
+    ],
+    'clients': [('createdAt',), ('email',), ('name',), ('updatedAt',)],
+    'email_outbox': [('status', 'nextAttemptAt')],
+    'analytics_rollups': [('userId', 'period', 'start')],
+    'invoice_search': [('createdAt',), ('status', 'createdAt'), ('total',), ('status', 'total')],
+}
+# Array fields whose elements get a lookup table of (value, id), so
+# array_contains is an index seek instead of a json_each scan of every row
+SQLITE_ARRAY_INDEXES = {
+    'clients': ('searchTokens',),
+    'invoice_search': ('searchTokens',),
+}
+
+MISSING = object()
+
+
+def utc(value):
+    """Datetimes come back timezone-aware in UTC, as from Firestore"""
+    if value.tzinfo is None:
+        return value.replace(tzinfo=timezone.utc)
+    return value.astimezone(timezone.utc)
+
+
+def transform(value, current=MISSING):
+    """Resolve Firestore sentinels and transforms against the current field value"""
+    if value is firestore.DELETE_FIELD:
+        return MISSING
+    if value is firestore.SERVER_TIMESTAMP:
+        return datetime.now(timezone.utc)
+    if isinstance(value, firestore.Increment):
+        base = current if isinstance(current, (int, float)) and not isinstance(current, bool) else 0
+        return base + value.value
+    if isinstance(value, (firestore.Maximum, firestore.Minimum)):
+        if not isinstance(current, (int, float)) or isinstance(current, bool):
+            return value.value
+        return max(current, value.value) if isinstance(value, firestore.Maximum) else min(current, value.value)
+    if isinstance(value, firestore.ArrayUnion):
+        values = list(current) if isinstance(current, list) else []
+        return values + [item for item in value.values if item not in values]
+    if isinstance(value, firestore.ArrayRemove):
+        return [item for item in (current if isinstance(current, list) else []) if item not in value.values]
+    if isinstance(value, dict):
+        resolved = {key: transform(item) for key, item in value.items()}
+        return {key: item for key, item in resolved.items() if item is not MISSING}
+    if isinstance(value, (list, tuple)):
+        return [transform(item) for item in value]
+    if isinstance(value, datetime):
+        return utc(value)
+    if isinstance(value, DocumentReference):
+        return value.path
+    return value
+
+
+def merge_fields(target, data):
+    """Deep merge like set(..., merge=True)"""
+    for key, value in data.items():
+        current = target.get(key, MISSING)
+        if isinstance(value, dict) and isinstance(current, dict):
+            merge_fields(current, value)
+            continue
+        resolved = transform(value, current)
+        if resolved is MISSING:
+            target.pop(key, None)
+        else:
+            target[key] = resolved
+
+
+def update_fields(target, data):
+    """Apply dotted field paths like update()"""
+    for path, value in data.items():
+        parent = target
+        parts = path.split('.')
+        for part in parts[:-1]:
+            if not isinstance(parent.get(part), dict):
+                parent[part] = {}
+            parent = parent[part]
+        resolved = transform(value, parent.get(parts[-1], MISSING))
+        if resolved is MISSING:
+            parent.pop(parts[-1], None)
+        else:
+            parent[parts[-1]] = resolved
+
+
+def get_field(data, path):
+    for part in path.split('.'):
+        if not isinstance(data, dict) or part not in data:
+            return MISSING
+        data = data[part]
+    return data
+
+
+def project(data, paths):
+    """Copy of a document with only the selected field paths"""
+    projected = {}
+    for path in paths:
+        value = get_field(data, path)
+        if value is not MISSING:
+            update_fields(projected, {path: value})
+    return projected
+
+
+def type_rank(value):
+    """Firestore orders values of different types by type first"""
+    if value is None:
+        return 0
+    if isinstance(value, bool):
+        return 1
+    if isinstance(value, (int, float)):
+        return 2
+    if isinstance(value, datetime):
+        return 3
+    if isinstance(value, str):
+        return 4
+    if isinstance(value, list):
+        return 8
+    return 9
+
+
+def compare_values(a, b):
+    rank_a, rank_b = type_rank(a), type_rank(b)
+    if rank_a != rank_b:
+        return -1 if rank_a < rank_b else 1
+    if rank_a >= 8:
+        a, b = json.dumps(a, sort_keys=True, default=str), json.dumps(b, sort_keys=True, default=str)
+    if a == b or rank_a == 0:
+        return 0
+    return -1 if a < b else 1
+
+
+class DocumentSnapshot:
+    def __init__(self, reference, data):
+        self.reference = reference
+        self.id = reference.id
+        self.exists = data is not None
+        self._data = data
+        self.create_time = None
+        self.update_time = None
+
+    def to_dict(self):
+        return copy.deepcopy(self._data) if self._data is not None else None
+
+    def get(self, field_path):
+        value = get_field(self._data or {}, field_path)
+        if value is MISSING:
+            raise KeyError(field_path)
+        return copy.deepcopy(value)
+
+
+class DocumentReference:
+    def __init__(self, store, collection, document_id):
+        self._store = store
+        self._collection = collection
+        self.id = document_id
+        self.path = f"{collection}/{document_id}"
+
+    def __eq__(self, other):
+        return isinstance(other, DocumentReference) and other.path == self.path
+
+    def __hash__(self):
+        return hash(self.path)
+
+    @property
+    def parent(self):
+        return CollectionReference(self._store, self._collection)
+
+    def collection(self, name):
+        return CollectionReference(self._store, f"{self.path}/{name}")
+
+    def get(self, field_paths=None, transaction=None):
+        record_reads(1)
+        data = self._store.read(self._collection, self.id)
+        if data is not None and field_paths is not None:
+            data = project(data, field_paths)
+        return DocumentSnapshot(self, data)
+
+    def set(self, document_data, merge=False):
+        return self._store.commit([('set', self, document_data, merge)])
+
+    def update(self, field_updates):
+        return self._store.commit([('update', self, field_updates, None)])
+
+    def create(self, document_data):
+        return self._store.commit([('create', self, document_data, None)])
+
+    def delete(self):
+        return self._store.commit([('delete', self, None, None)])
+
+
+class AggregationResult:
+    def __init__(self, alias, value):
+        self.alias = alias
+        self.value = value
+
+
+class CountQuery:
+    def __init__(self, query, alias=None):
+        self._query = query
+        self._alias = alias or 'count'
+
+    def get(self, transaction=None):
+        record_reads(1)
+        return [[AggregationResult(self._alias, self._query._store.count(self._query))]]
+
+
+class Query:
+    """Subset of the Firestore query API run against a local store"""
+
+    def __init__(self, store, collection, filters=(), orders=(), limit=None, offset=None,
+                 cursor=None, projection=None):
+        self._store = store
+        self._collection = collection
+        self._filters = tuple(filters)
+        self._orders = tuple(orders)
+        self._limit = limit
+        self._offset = offset
+        self._cursor = cursor
+        self._projection = projection
+
+    def _copy(self, **changes):
+        fields = {
+            'filters': self._filters,
+            'orders': self._orders,
+            'limit': self._limit,
+            'offset': self._offset,
+            'cursor': self._cursor,
+            'projection': self._projection
+        }
+        fields.update(changes)
+        return Query(self._store, self._collection, **fields)
+
+    def where(self, field_path=None, op_string=None, value=None, filter=None):
+        if filter is not None:
+            field_path, op_string, value = filter.field_path, filter.op_string, filter.value
+        if isinstance(value, datetime):
+            value = utc(value)
+        elif isinstance(value, (list, tuple)):
+            value = [utc(item) if isinstance(item, datetime) else item for item in value]
+        return self._copy(filters=self._filters + ((field_path, op_string, value),))
+
+    def order_by(self, field_path, direction='ASCENDING'):
+        return self._copy(orders=self._orders + ((field_path, direction),))
+
+    def limit(self, count):
+        return self._copy(limit=count)
+
+    def offset(self, num_to_skip):
+        return self._copy(offset=num_to_skip)
+
+    def select(self, field_paths):
+        return self._copy(projection=list(field_paths))
+
+    def start_after(self, document_fields_or_snapshot):
+        return self._copy(cursor=document_fields_or_snapshot)
+
+    def count(self, alias=None):
+        return CountQuery(self, alias)
+
+    def effective_orders(self):
+        """Explicit orders, then the inequality field, then the document id"""
+        orders = list(self._orders)
+        if not orders:
+            inequality = next((field for field, op, _ in self._filters
+                               if op in ('<', '<=', '>', '>=', '!=', 'not-in')), None)
+            if inequality:
+                orders.append((inequality, 'ASCENDING'))
+        if not any(field == '__name__' for field, _ in orders):
+            orders.append(('__name__', orders[-1][1] if orders else 'ASCENDING'))
+        return orders
+
+    def cursor_values(self, orders):
+        """Values of the start_after cursor for each order field"""
+        cursor = self._cursor
+        if isinstance(cursor, DocumentSnapshot):
+            data, document_id = cursor._data or {}, cursor.id
+        else:
+            data, document_id = cursor, cursor.get('__name__')
+            if isinstance(document_id, DocumentReference):
+                document_id = document_id.id
+            elif isinstance(document_id, str):
+                document_id = document_id.rsplit('/', 1)[-1]
+        values = []
+        for field, _ in orders:
+            if field == '__name__':
+                value = document_id
+            else:
+                value = data[field] if field in data else get_field(data, field)
+            if value is MISSING:
+                value = None
+            values.append(utc(value) if isinstance(value, datetime) else value)
+        return values
+
+    def stream(self, transaction=None):
+        return counting_generator(self._snapshots())
+
+    def _snapshots(self):
+        for document_id, data in self._store.query(self):
+            if self._projection is not None:
+                data = project(data, self._projection)
+            yield DocumentSnapshot(DocumentReference(self._store, self._collection, document_id), data)
+
+    def get(self, transaction=None):
+        return list(self.stream(transaction))
+
+    def on_snapshot(self, callback):
+        return self._store.watch(self, callback)
+
+
+class CollectionReference(Query):
+    def __init__(self, store, collection):
+        super().__init__(store, collection)
+        self.id = collection.rsplit('/', 1)[-1]
+
+    def document(self, document_id=None):
+        return DocumentReference(self._store, self._collection, document_id or uuid.uuid4().hex[:20])
+
+    def add(self, document_data, document_id=None):
+        reference = self.document(document_id)
+        reference.create(document_data)
+        return None, reference
+
+    def list_documents(self):
+        return [snapshot.reference for snapshot in self.select([]).stream()]
+
+
+class WriteBatch:
+    def __init__(self, store):
+        self._store = store
+        self._writes = []
+
+    def __len__(self):
+        return len(self._writes)
+
+    def set(self, reference, document_data, merge=False):
+        self._writes.append(('set', reference, document_data, merge))
+
+    def update(self, reference, field_updates):
+        self._writes.append(('update', reference, field_updates, None))
+
+    def create(self, reference, document_data):
+        self._writes.append(('create', reference, document_data, None))
+
+    def delete(self, reference):
+        self._writes.append(('delete', reference, None, None))
+
+    def commit(self):
+        writes, self._writes = self._writes, []
+        return self._store.commit(writes)
+
+
+class Transaction(WriteBatch):
+    """Writes are buffered and committed with the reads under one store lock"""
+
+    def run(self, func, *args, **kwargs):
+        with self._store.atomic():
+            self._writes = []
+            result = func(self, *args, **kwargs)
+            self.commit()
+        return result
+
+
+class Watch:
+    """Snapshot listener on a local store, like the Watch from Firestore's on_snapshot().
+
+    Only filters are applied. The callback gets the documents that changed
+    rather than the whole result set, and only sees writes made through
+    this process.
+    """
+
+    def __init__(self, store, query, callback):
+        self._store = store
+        self._query = query
+        self._callback = callback
+        self._ids = set()
+        self.is_active = True
+
+    def unsubscribe(self):
+        self.is_active = False
+        self._store.remove_watch(self)
+
+    def notify(self, document_ids, initial=False):
+        """Call back with the changes to the query's results among `document_ids`.
+
+        The initial snapshot is delivered even when empty, as Firestore does.
+        """
+        changes = []
+        for document_id in document_ids:
+            data = self._store.read(self._query._collection, document_id)
+            if data is not None and all(matches(data, *condition) for condition in self._query._filters):
+                change_type = ChangeType.MODIFIED if document_id in self._ids else ChangeType.ADDED
+                self._ids.add(document_id)
+            elif document_id in self._ids:
+                change_type = ChangeType.REMOVED
+                self._ids.discard(document_id)
+            else:
+                continue
+            reference = DocumentReference(self._store, self._query._collection, document_id)
+            changes.append(DocumentChange(change_type, DocumentSnapshot(reference, data), -1, -1))
+        if changes or initial:
+            self._callback([change.document for change in changes], changes, datetime.now(timezone.utc))
+
+
+def transactional(func):
+    """Like firestore.transactional, but also runs on the local stores"""
+    firestore_func = firestore.transactional(func)
+
+    @wraps(func)
+    def wrapper(transaction, *args, **kwargs):
+        if isinstance(transaction, Transaction):
+            return transaction.run(func, *args, **kwargs)
+        return firestore_func(transaction, *args, **kwargs)
+    return wrapper
+
+
+class DocumentStore:
+    """Base for local stores that stand in for the Firestore client.
+
+    Implements the parts of the client API the app uses: documents,
+    queries with filters, ordering, cursors and projections, count
+    aggregations, batches, transactions and field transforms. Subclasses
+    provide storage via read/write/remove/query/count and atomic().
+    """
+
+    def __init__(self):
+        self._watches = []
+        self._watches_lock = threading.Lock()
+
+    def collection(self, collection_id):
+        return CollectionReference(self, collection_id)
+
+    def document(self, document_path):
+        collection, document_id = document_path.rsplit('/', 1)
+        return DocumentReference(self, collection, document_id)
+
+    def batch(self):
+        return WriteBatch(self)
+
+    def transaction(self, **kwargs):
+        return Transaction(self)
+
+    def get_all(self, references, field_paths=None, transaction=None):
+        for reference in references:
+            yield reference.get(field_paths)
+
+    def commit(self, writes):
+        """Apply (op, reference, data, merge) writes atomically"""
+        record_writes(len(writes))
+        written = {}
+        with self.atomic():
+            for op, reference, data, merge in writes:
+                collection, document_id = reference._collection, reference.id
+                written.setdefault(collection, {})[document_id] = None
+                current = self.read(collection, document_id)
+                if op == 'delete':
+                    if current is not None:
+                        self.remove(collection, document_id)
+                    continue
+                if op == 'create' and current is not None:
+                    raise AlreadyExists(f"Document already exists: {reference.path}")
+                if op == 'update':
+                    if current is None:
+                        raise NotFound(f"No document to update: {reference.path}")
+                    update_fields(current, data)
+                elif op == 'set' and merge and current is not None:
+                    merge_fields(current, data)
+                else:
+                    current = {}
+                    merge_fields(current, data)
+                self.write(collection, document_id, current)
+        self.notify_watches(written)
+        return [None] * len(writes)
+
+    def watch(self, query, callback):
+        """Start a snapshot listener; the first callback holds the current results"""
+        watch = Watch(self, query, callback)
+        watch.notify([document_id for document_id, _ in self.query(query._copy(projection=[]))], initial=True)
+        with self._watches_lock:
+            self._watches.append(watch)
+        return watch
+
+    def remove_watch(self, watch):
+        with self._watches_lock:
+            if watch in self._watches:
+                self._watches.remove(watch)
+
+    def notify_watches(self, written):
+        """Tell listeners about committed writes, {collection: {document_id: None}}"""
+        with self._watches_lock:
+            watches = [watch for watch in self._watches if watch._query._collection in written]
+        for watch in watches:
+            try:
+                watch.notify(written[watch._query._collection])
+            except Exception as e:
+                logger.error("Error notifying snapshot listener: %s", e)
+
+    def atomic(self):
+        raise NotImplementedError
+
+    def read(self, collection, document_id):
+        raise NotImplementedError
+
+    def write(self, collection, document_id, data):
+        raise NotImplementedError
+
+    def remove(self, collection, document_id):
+        raise NotImplementedError
+
+    def query(self, query):
+        raise NotImplementedError
+
+    def count(self, query):
+        return sum(1 for _ in self.query(query._copy(projection=[])))
+
+
+def matches(data, field, op, value):
+    """Evaluate one query filter against a document, like Firestore"""
+    actual = get_field(data, field)
+    if actual is MISSING:
+        return False
+    if op == '==':
+        return compare_values(actual, value) == 0
+    if op == '!=':
+        return compare_values(actual, value) != 0
+    if op == 'in':
+        return any(compare_values(actual, item) == 0 for item in value)
+    if op == 'not-in':
+        return all(compare_values(actual, item) != 0 for item in value)
+    if op == 'array_contains':
+        return isinstance(actual, list) and any(compare_values(item, value) == 0 for item in actual)
+    if op == 'array_contains_any':
+        return isinstance(actual, list) and any(compare_values(item, option) == 0
+                                                for item in actual for option in value)
+    # Range filters only match values of the same type
+    if type_rank(actual) != type_rank(value):
+        return False
+    result = compare_values(actual, value)
+    return {'<': result < 0, '<=': result <= 0, '>': result > 0, '>=': result >= 0}[op]
+
+
+class MemoryStore(DocumentStore):
+    """In-process store for tests, benchmarks and offline development"""
+
+    def __init__(self):
+        super().__init__()
+        self._collections = {}
+        self._lock = threading.RLock()
+        self._undo = None
+
+    @contextmanager
+    def atomic(self):
+        with self._lock:
+            outer = self._undo is None
+            if outer:
+                self._undo = []
+            try:
+                yield
+            except BaseException:
+                if outer:
+                    # Put back the previous versions of everything written
+                    for collection, document_id, previous in reversed(self._undo):
+                        documents = self._collections.setdefault(collection, {})
+                        if previous is None:
+                            documents.pop(document_id, None)
+                        else:
+                            documents[document_id] = previous
+                raise
+            finally:
+                if outer:
+                    self._undo = None
+
+    def read(self, collection, document_id):
+        with self._lock:
+            data = self._collections.get(collection, {}).get(document_id)
+            return copy.deepcopy(data) if data is not None else None
+
+    def write(self, collection, document_id, data):
+        with self._lock:
+            documents = self._collections.setdefault(collection, {})
+            if self._undo is not None:
+                self._undo.append((collection, document_id, documents.get(document_id)))
+            documents[document_id] = data
+
+    def remove(self, collection, document_id):
+        with self._lock:
+            documents = self._collections.get(collection, {})
+            if self._undo is not None and document_id in documents:
+                self._undo.append((collection, document_id, documents[document_id]))
+            documents.pop(document_id, None)
+
+    def collections(self):
+        return [CollectionReference(self, name) for name in self._collections if '/' not in name]
+
+    def query(self, query):
+        orders = query.effective_orders()
+
+        def sort_values(document_id, data):
+            return [document_id if field == '__name__' else get_field(data, field) for field, _ in orders]
+
+        def compare(a, b):
+            for (field, direction), left, right in zip(orders, a[0], b[0]):
+                result = compare_values(left, right)
+                if result:
+                    return -result if direction == 'DESCENDING' else result
+            return 0
+
+        with self._lock:
+            documents = [
+                (sort_values(document_id, data), document_id, data)
+                for document_id, data in self._collections.get(query._collection, {}).items()
+                if all(matches(data, *condition) for condition in query._filters)
+                and all(field == '__name__' or get_field(data, field) is not MISSING for field, _ in orders)
+            ]
+            documents.sort(key=cmp_to_key(compare))
+            if query._cursor is not None:
+                cursor = (query.cursor_values(orders),)
+                documents = [document for document in documents if compare(document, cursor) > 0]
+            documents = documents[query._offset or 0:]
+            if query._limit is not None:
+                documents = documents[:query._limit]
+            # Snapshots copy on to_dict(), so stored documents are never handed out
+            return [(document_id, data) for _, document_id, data in documents]
+
+    def count(self, query):
+        return len(self.query(query._copy(projection=[])))
+
+
+def encode_document(data):
+    """JSON for a document; datetimes become {"$date": iso} so they sort as text,
+    and bytes become {"$bytes": base64}"""
+    def encode(value):
+        if isinstance(value, datetime):
+            return {'$date': utc(value).strftime('%Y-%m-%dT%H:%M:%S.%f+00:00')}
+        if isinstance(value, bytes):
+            return {'$bytes': base64.b64encode(value).decode()}
+        raise TypeError(f"Cannot store {type(value).__name__}")
+    return json.dumps(data, default=encode, separators=(',', ':'), ensure_ascii=False)
+
+
+def decode_document(text):
+    def decode(value):
+        if len(value) == 1 and '$date' in value:
+            return datetime.fromisoformat(value['$date'])
+        if len(value) == 1 and '$bytes' in value:
+            return base64.b64decode(value['$bytes'])
+        return value
+    return json.loads(text, object_hook=decode)
+
+
+def sql_value(value):
+    """Query parameter matching how encode_document stores the value"""
+    if isinstance(value, datetime):
+        return encode_document(value)
+    if isinstance(value, (dict, list)):
+        return encode_document(value)
+    return value
+
+
+def path_sql(field):
+    """Quoted JSON path literal for a dotted field path"""
+    path = '$' + ''.join('."' + part.replace('"', '') + '"' for part in field.split('.'))
+    return "'" + path.replace("'", "''") + "'"
+
+
+def field_sql(field):
+    """Column expression for a field; indexes use the same text so SQLite can match them"""
+    if field == '__name__':
+        return 'id'
+    return f"json_extract(data, {path_sql(field)})"
+
+
+def table_sql(collection):
+    return '"' + collection.replace('"', '') + '"'
+
+
+def terms_table_sql(collection, field):
+    """Lookup table for an array field in SQLITE_ARRAY_INDEXES"""
+    return table_sql(f"{collection}#{field}")
+
+
+class SqliteStore(DocumentStore):
+    """Self-hosted store: one SQLite table per collection, in WAL mode.
+
+    Documents are stored as JSON and the fields the app filters and sorts
+    on get expression indexes (SQLITE_INDEXES). Each thread has its own
+    connection; writes take an IMMEDIATE transaction so several processes
+    can share the database file.
+    """
+
+    def __init__(self, path=SQLITE_PATH):
+        super().__init__()
+        self.path = path
+        self._local = threading.local()
+        self._tables = set()
+
+    def connection(self):
+        connection = getattr(self._local, 'connection', None)
+        if connection is None:
+            connection = sqlite3.connect(self.path, timeout=30, isolation_level=None, check_same_thread=False)
+            connection.execute('PRAGMA journal_mode=WAL')
+            connection.execute('PRAGMA synchronous=NORMAL')
+            self._local.connection = connection
+            self._local.depth = 0
+        return connection
+
+    def table(self, collection):
+        """Quoted table name, creating the table and its indexes on first use"""
+        name = table_sql(collection)
+        if collection in self._tables:
+            return name
+        # No Python lock here: the DDL is idempotent, and a thread waiting on a
+        # lock while another holds the SQLite write lock would deadlock
+        connection = self.connection()
+        connection.execute(f"CREATE TABLE IF NOT EXISTS {name} (id TEXT PRIMARY KEY, data TEXT NOT NULL)")
+        for fields in SQLITE_INDEXES.get(collection, []):
+            index = table_sql(f"{collection}__{'__'.join(fields)}")
+            columns = ', '.join(field_sql(field) for field in fields)
+            connection.execute(f"CREATE INDEX IF NOT EXISTS {index} ON {name} ({columns})")
+        for field in SQLITE_ARRAY_INDEXES.get(collection, ()):
+            terms = terms_table_sql(collection, field)
+            connection.execute(f"CREATE TABLE IF NOT EXISTS {terms} "
+                               f"(value, id TEXT NOT NULL, PRIMARY KEY (value, id)) WITHOUT ROWID")
+            connection.execute(f"CREATE INDEX IF NOT EXISTS {table_sql(f'{collection}#{field}__id')} ON {terms} (id)")
+            # Fill a new lookup table from documents written before it existed
+            connection.execute(f"INSERT OR IGNORE INTO {terms} (value, id) "
+                               f"SELECT item.value, doc.id FROM {name} doc, json_each(doc.data, {path_sql(field)}) item "
+                               f"WHERE NOT EXISTS (SELECT 1 FROM {terms})")
+        self._tables.add(collection)
+        return name
+
+    @contextmanager
+    def atomic(self):
+        connection = self.connection()
+        outer = self._local.depth == 0
+        if outer:
+            connection.execute('BEGIN IMMEDIATE')
+        self._local.depth += 1
+        try:
+            yield
+        except BaseException:
+            self._local.depth -= 1
+            if outer:
+                connection.execute('ROLLBACK')
+                # The rollback also undid any tables created in it
+                self._tables.clear()
+            raise
+        self._local.depth -= 1
+        if outer:
+            connection.execute('COMMIT')
+
+    def read(self, collection, document_id):
+        row = self.connection().execute(
+            f"SELECT data FROM {self.table(collection)} WHERE id = ?", (document_id,)).fetchone()
+        return decode_document(row[0]) if row else None
+
+    def write(self, collection, document_id, data):
+        self.connection().execute(
+            f"INSERT OR REPLACE INTO {self.table(collection)} (id, data) VALUES (?, ?)",
+            (document_id, encode_document(data)))
+        for field in SQLITE_ARRAY_INDEXES.get(collection, ()):
+            values = get_field(data, field)
+            self.write_terms(collection, field, document_id, values if isinstance(values, list) else [])
+
+    def write_terms(self, collection, field, document_id, values):
+        terms = terms_table_sql(collection, field)
+        connection = self.connection()
+        connection.execute(f"DELETE FROM {terms} WHERE id = ?", (document_id,))
+        connection.executemany(f"INSERT OR IGNORE INTO {terms} (value, id) VALUES (?, ?)",
+                               [(sql_value(value), document_id) for value in values])
+
+    def remove(self, collection, document_id):
+        self.connection().execute(f"DELETE FROM {self.table(collection)} WHERE id = ?", (document_id,))
+        for field in SQLITE_ARRAY_INDEXES.get(collection, ()):
+            self.write_terms(collection, field, document_id, [])
+
+    def collections(self):
+        rows = self.connection().execute("SELECT name FROM sqlite_master WHERE type = 'table'").fetchall()
+        return [CollectionReference(self, name) for name, in rows if '/' not in name and '#' not in name]
+
+    def build_query(self, query, columns):
+        """SQL and parameters for a query's filters, ordering, cursor and limits"""
+        conditions, params = [], []
+        for field, op, value in query._filters:
+            column = field_sql(field)
+            if op == '==' and value is None:
+                conditions.append(f"json_type(data, {path_sql(field)}) = 'null'")
+            elif op in ('==', '!=', '<', '<=', '>', '>='):
+                conditions.append(f"{column} {'=' if op == '==' else op} ?")
+                params.append(sql_value(value))
+            elif op in ('in', 'not-in'):
+                placeholders = ', '.join('?' for _ in value) or 'NULL'
+                conditions.append(f"{column} {'IN' if op == 'in' else 'NOT IN'} ({placeholders})")
+                params.extend(sql_value(item) for item in value)
+            elif op in ('array_contains', 'array_contains_any'):
+                options = value if op == 'array_contains_any' else [value]
+                placeholders = ', '.join('?' for _ in options) or 'NULL'
+                if field in SQLITE_ARRAY_INDEXES.get(query._collection, ()):
+                    conditions.append(f"id IN (SELECT id FROM {terms_table_sql(query._collection, field)} "
+                                      f"WHERE value IN ({placeholders}))")
+                else:
+                    conditions.append(
+                        f"EXISTS (SELECT 1 FROM json_each(data, {path_sql(field)}) WHERE value IN ({placeholders}))")
+                params.extend(sql_value(item) for item in options)
+            else:
+                raise ValueError(f"Unsupported filter operator: {op}")
+
+        orders = query.effective_orders()
+        for field, _ in orders:
+            if field != '__name__':
+                conditions.append(f"{field_sql(field)} IS NOT NULL")
+
+        if query._cursor is not None:
+            # Keyset condition: (a, b, id) strictly after the cursor in sort order
+            values = query.cursor_values(orders)
+            alternatives = []
+            for index, (field, direction) in enumerate(orders):
+                terms = [f"{field_sql(previous)} = ?" for previous, _ in orders[:index]]
+                terms.append(f"{field_sql(field)} {'<' if direction == 'DESCENDING' else '>'} ?")
+                alternatives.append('(' + ' AND '.join(terms) + ')')
+                params.extend(sql_value(value) for value in values[:index + 1])
+            conditions.append('(' + ' OR '.join(alternatives) + ')')
+
+        sql = f"SELECT {columns} FROM {self.table(query._collection)}"
+        if conditions:
+            sql += ' WHERE ' + ' AND '.join(conditions)
+        return sql, params, orders
+
+    def query(self, query):
+        sql, params, orders = self.build_query(query, 'id, data')
+        sql += ' ORDER BY ' + ', '.join(
+            f"{field_sql(field)} {'DESC' if direction == 'DESCENDING' else 'ASC'}" for field, direction in orders)
+        if query._limit is not None or query._offset:
+            sql += ' LIMIT ? OFFSET ?'
+            params += [query._limit if query._limit is not None else -1, query._offset or 0]
+        rows = self.connection().execute(sql, params).fetchall()
+        return [(document_id, decode_document(data)) for document_id, data in rows]
+
+    def count(self, query):
+        sql, params, _ = self.build_query(query, 'id')
+        if query._limit is not None:
+            sql += ' LIMIT ?'
+            params.append(query._limit)
+        return self.connection().execute(f"SELECT COUNT(*) FROM ({sql})", params).fetchone()[0]
+
+
+def create_store(backend=STORAGE_BACKEND):
+    """Local store for STORAGE_BACKEND=sqlite or memory, else None for Firestore"""
+    if backend == 'sqlite':
+        return SqliteStore()
+    if backend == 'memory':
+        return MemoryStore()
+    return None
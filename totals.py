@@ -0,0 +1,236 @@
+# totals.py
+import math
+from decimal import Decimal, InvalidOperation, ROUND_HALF_UP
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+# Quantities are kept to 3 decimals and tax rates to hundredths of a percent,
+# so every amount is integer arithmetic on paise
+QUANTITY_SCALE = 1000
+TAX_RATE_SCALE = 10000
+# Invoices recomputed per call when checking the whole store
+TOTALS_CHUNK_SIZE = 5000
+INT64_MAX = 2 ** 63 - 1
+# Below this, float values scaled to paise are exact enough to round directly
+FAST_PATH_LIMIT = 2 ** 40
+
+
+def to_decimal(value, field='amount'):
+    """Parse a non-negative number from JSON or a string like '1,250.00' or '₹99'"""
+    if value is None or value == '' or isinstance(value, bool):
+        raise ValueError(f"Invalid {field}: {value!r}")
+    try:
+        # repr() keeps floats like 0.285 as typed rather than their binary expansion
+        number = Decimal(repr(value) if isinstance(value, float) else str(value).replace(',', '').replace('₹', '').strip())
+    except InvalidOperation:
+        raise ValueError(f"Invalid {field}: {value!r}")
+    if not number.is_finite() or number < 0:
+        raise ValueError(f"Invalid {field}: {value!r}")
+    return number
+
+
+def _scaled(value, scale, field):
+    """`value * scale` rounded half up to an integer"""
+    # Floats well away from a rounding boundary skip Decimal, which is
+    # most of the cost of checking millions of line items
+    if type(value) is int and value >= 0:
+        return value * scale
+    if type(value) is float and 0 <= value < FAST_PATH_LIMIT:
+        scaled = value * scale
+        rounded = math.floor(scaled + 0.5)
+        if abs(scaled - rounded) < 0.49:
+            return rounded
+    return int((to_decimal(value, field) * scale).quantize(Decimal(1), rounding=ROUND_HALF_UP))
+
+
+def to_paise(value, field='amount'):
+    return _scaled(value, 100, field)
+
+
+def to_milli(quantity):
+    return _scaled(quantity, QUANTITY_SCALE, 'quantity')
+
+
+def to_rate_units(tax_rate):
+    """Tax rate percentage in hundredths of a percent, e.g. 18 -> 1800"""
+    return _scaled(tax_rate, TAX_RATE_SCALE // 100, 'tax rate')
+
+
+def from_rate_units(rate_units):
+    return rate_units / (TAX_RATE_SCALE // 100)
+
+
+def from_paise(paise):
+    return paise / 100
+
+
+def line_amount(quantity_milli, rate_paise):
+    """quantity x rate in paise, rounding half up"""
+    return (quantity_milli * rate_paise + QUANTITY_SCALE // 2) // QUANTITY_SCALE
+
+
+def tax_amount(subtotal_paise, rate_units):
+    return (subtotal_paise * rate_units + TAX_RATE_SCALE // 2) // TAX_RATE_SCALE
+
+
+def compute_totals(items, tax_rate=None, tax=None):
+    """Line amounts, subtotal, tax and total for an invoice, computed in paise.
+
+    Tax comes from `tax_rate` (a percentage) when given, otherwise `tax` is
+    taken as a fixed amount. Returns the fields to store on the invoice.
+    """
+    if not isinstance(items, list):
+        raise ValueError("items must be a list")
+    priced = []
+    subtotal = 0
+    for item in items:
+        if not isinstance(item, dict):
+            raise ValueError("Each item must be an object")
+        quantity = item.get('quantity')
+        amount = line_amount(to_milli(1 if quantity in (None, '') else quantity),
+                             to_paise(item.get('rate') or 0, 'rate'))
+        subtotal += amount
+        priced.append({**item, 'amount': from_paise(amount)})
+
+    totals = {'items': priced, 'subtotal': from_paise(subtotal)}
+    if tax_rate not in (None, ''):
+        rate_units = to_rate_units(tax_rate)
+        tax_paise = tax_amount(subtotal, rate_units)
+        totals['taxRate'] = from_rate_units(rate_units)
+    else:
+        tax_paise = to_paise(tax or 0, 'tax')
+    totals['tax'] = from_paise(tax_paise)
+    totals['total'] = from_paise(subtotal + tax_paise)
+    return totals
+
+
+def scale_column(values, scale, field):
+    """_scaled() over a column of values, as a numpy array when numpy is installed"""
+    if numpy is None:
+        return [_scaled(value, scale, field) for value in values]
+    try:
+        column = numpy.asarray(values, dtype=numpy.float64)
+    except (TypeError, ValueError):
+        column = None
+    if column is None or not ((column >= 0) & (column < FAST_PATH_LIMIT)).all():
+        return numpy.asarray([_scaled(value, scale, field) for value in values], dtype=numpy.int64)
+    scaled = column * scale
+    rounded = numpy.floor(scaled + 0.5)
+    result = rounded.astype(numpy.int64)
+    # Values near a rounding boundary are redone exactly
+    for index in numpy.flatnonzero(numpy.abs(scaled - rounded) >= 0.49):
+        result[index] = _scaled(values[index], scale, field)
+    return result
+
+
+def invoice_columns(invoices, tax_rates=None):
+    """Flatten a chunk of invoices into integer columns for recompute_totals().
+
+    Returns (owners, quantities, rates, amounts, rate_units, stored) where
+    the first four have one entry per line item, owners giving the index of
+    its invoice; rate_units is -1 for an invoice without a tax rate and
+    stored holds each invoice's subtotal, tax and total in paise.
+    Raises ValueError if any invoice has malformed items or amounts.
+    """
+    owners, quantities, rates, amounts = [], [], [], []
+    for index, invoice in enumerate(invoices):
+        items = invoice.get('items') or []
+        if not isinstance(items, list) or not all(isinstance(item, dict) for item in items):
+            raise ValueError("Each item must be an object")
+        for item in items:
+            quantity = item.get('quantity')
+            owners.append(index)
+            quantities.append(1 if quantity in (None, '') else quantity)
+            rates.append(item.get('rate') or 0)
+            amounts.append(item.get('amount') or 0)
+
+    rate_units = []
+    for index, invoice in enumerate(invoices):
+        tax_rate = tax_rates[index] if tax_rates and tax_rates[index] is not None else invoice.get('taxRate')
+        rate_units.append(-1 if tax_rate in (None, '') else to_rate_units(tax_rate))
+    stored = [scale_column([invoice.get(field) or 0 for invoice in invoices], 100, field)
+              for field in ('subtotal', 'tax', 'total')]
+    return (owners, scale_column(quantities, QUANTITY_SCALE, 'quantity'), scale_column(rates, 100, 'rate'),
+            scale_column(amounts, 100, 'amount'), rate_units, stored)
+
+
+def _recompute_python(count, owners, quantities, rates, rate_units, stored_tax):
+    amounts = [line_amount(quantity, rate) for quantity, rate in zip(quantities, rates)]
+    subtotals = [0] * count
+    for owner, amount in zip(owners, amounts):
+        subtotals[owner] += amount
+    taxes = [tax_amount(subtotal, units) if units >= 0 else tax
+             for subtotal, units, tax in zip(subtotals, rate_units, stored_tax)]
+    return amounts, subtotals, taxes
+
+
+def _recompute_numpy(count, owners, quantities, rates, rate_units, stored_tax):
+    amounts = line_amount(quantities, rates)
+    subtotals = numpy.zeros(count, dtype=numpy.int64)
+    numpy.add.at(subtotals, numpy.asarray(owners, dtype=numpy.int64), amounts)
+    units = numpy.asarray(rate_units, dtype=numpy.int64)
+    taxes = numpy.where(units >= 0, tax_amount(subtotals, numpy.maximum(units, 0)), stored_tax)
+    return amounts, subtotals, taxes
+
+
+def recompute_totals(invoices, tax_rates=None):
+    """Check the totals of a chunk of invoices, returning those that are wrong.
+
+    Line amounts, subtotals and taxes are computed for the whole chunk at
+    once, with numpy when it is installed. `tax_rates` optionally gives a new
+    rate per invoice (None keeps its own). Invoices without a taxRate keep
+    their stored tax amount. Returns [(index, totals, problems)] where totals
+    are the corrected fields and problems names the fields that differed.
+    Raises ValueError if any invoice in the chunk can't be parsed.
+    """
+    if not invoices:
+        return []
+    count = len(invoices)
+    owners, quantities, rates, stored_amounts, rate_units, stored = invoice_columns(invoices, tax_rates)
+    # int64 products overflow only for absurd values; fall back to Python ints
+    largest = int(max(quantities)) * int(max(rates)) * len(owners) * max(max(rate_units), 1) if owners else 0
+    fits = largest < INT64_MAX
+    if numpy is not None and fits:
+        amounts, subtotals, taxes = _recompute_numpy(count, owners, quantities, rates, rate_units, stored[1])
+        wrong_items = set(numpy.asarray(owners)[amounts != stored_amounts].tolist())
+        amounts, subtotals, taxes = amounts.tolist(), subtotals.tolist(), taxes.tolist()
+        stored = [column.tolist() for column in stored]
+    else:
+        if numpy is not None:
+            quantities, rates, stored_amounts = quantities.tolist(), rates.tolist(), stored_amounts.tolist()
+            stored = [column.tolist() for column in stored]
+        amounts, subtotals, taxes = _recompute_python(count, owners, quantities, rates, rate_units, stored[1])
+        wrong_items = {owner for owner, amount, stored_amount in zip(owners, amounts, stored_amounts)
+                       if amount != stored_amount}
+
+    results = []
+    item_start = 0
+    for index, invoice in enumerate(invoices):
+        items = invoice.get('items') or []
+        item_end = item_start + len(items)
+        subtotal, tax = subtotals[index], taxes[index]
+        problems = [field for field, expected, actual in (
+            ('subtotal', subtotal, stored[0][index]),
+            ('tax', tax, stored[1][index]),
+            ('total', subtotal + tax, stored[2][index]),
+        ) if expected != actual]
+        if index in wrong_items:
+            problems.insert(0, 'items')
+        new_rate = tax_rates[index] if tax_rates else None
+        if problems or new_rate is not None:
+            totals = {
+                'items': [{**item, 'amount': from_paise(amount)}
+                          for item, amount in zip(items, amounts[item_start:item_end])],
+                'subtotal': from_paise(subtotal),
+                'tax': from_paise(tax),
+                'total': from_paise(subtotal + tax)
+            }
+            if rate_units[index] >= 0:
+                totals['taxRate'] = from_rate_units(rate_units[index])
+            if problems or totals.get('taxRate') != invoice.get('taxRate'):
+                results.append((index, totals, problems))
+        item_start = item_end
+    return results